@@ -0,0 +1,57 @@
+"""
+Import-time benchmark for bot.py.
+
+Runs `python -X importtime -c "import bot"` in a fresh interpreter and
+reports the total import time, the slowest top-level packages and whether
+pandas was imported. Run from the bot folder:
+
+    python bench_import.py [rounds]
+"""
+import subprocess
+import sys
+
+
+def import_times(module):
+    """Returns {top-level package: cumulative microseconds} for one cold import of module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"import {module} failed")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Top-level entries are the ones that are not indented
+        if name.startswith(" ") and not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    runs = [import_times("bot") for _ in range(rounds)]
+    best = min(runs, key=lambda times: times.get("bot", 0))
+
+    slowest = sorted(((us, name) for name, us in best.items() if name != "bot"), reverse=True)[:10]
+    lines = [
+        f"bot.py import time (best of {rounds})",
+        f"  import bot:                   {best.get('bot', 0) / 1000:8.1f} ms",
+        f"  pandas imported:              {'yes' if 'pandas' in best else 'no'}",
+        "  slowest packages:",
+    ]
+    lines += [f"    {name:<26} {us / 1000:8.1f} ms" for us, name in slowest]
+    report = "\n".join(lines)
+    print(report)
+    with open("bench_output.txt", "a", encoding="utf-8") as f:
+        f.write(report + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+The question loaders as they were before the question bank snapshot and the
+column-wise loaders: a verbatim copy of load_mazen_test_data() and
+load_all_questions() with their DataFrame.iterrows() parsing. Kept only so
+bench_startup.py can time the old startup path; the bot never imports it.
+"""
+import logging
+import os
+
+import pandas as pd
+
+
+def load_mazen_test_data():
+    mazen_texts = {}
+    mazen_srd = {}
+    
+    # Load texts from textlevels.csv
+    try:
+        df = pd.read_csv('textlevels.csv', encoding='utf-8')
+        df.columns = [c.strip().lower() for c in df.columns]
+        for _, row in df.iterrows():
+            id_val, level, text = row['id'], row['level'], row['text']
+            if id_val not in mazen_texts:
+                mazen_texts[id_val] = {}
+            mazen_texts[id_val][level] = text
+        logging.info(f"Successfully loaded Mazen test texts for {len(mazen_texts)} IDs.")
+    except FileNotFoundError:
+        logging.error("Error: textlevels.csv not found.")
+    except Exception as e:
+        logging.error(f"An error occurred while loading textlevels.csv: {e}")
+
+    # Load narrative questions from idxsrd.csv files
+    for i in range(1, 7):  # Assuming ids 1 to 6
+        file_path = f'id{i}srd.csv'
+        try:
+            df = pd.read_csv(file_path, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, keep_default_na=False)
+            df.columns = [str(c).strip().lower() for c in df.columns]
+            srd_questions = []
+            for _, row in df.iterrows():
+                srd_questions.append({
+                    "question": row['question'],
+                    "answer": row['answer']
+                })
+            mazen_srd[i] = srd_questions
+            logging.info(f"Successfully loaded {len(srd_questions)} narrative questions for id{i}.")
+        except FileNotFoundError:
+            # It's okay if some files don't exist, just means the test ends there.
+            logging.warning(f"Narrative question file not found: {file_path}")
+        except Exception as e:
+            logging.error(f"An error occurred while loading {file_path}: {e}")
+            
+    return mazen_texts, mazen_srd
+
+def load_all_questions():
+    levels = ['easy', 'medium', 'hard']
+    question_sets = {}
+    
+    for level in levels:
+        file_path = f"{level.capitalize()}_Level.csv"
+        try:
+            df = pd.read_csv(file_path, encoding='utf-8', dtype={'Correct_Answer': str})
+            questions = []
+            for index, row in df.iterrows():
+                try:
+                    correct_option_str = row['Correct_Answer'].replace('Option_', '')
+                    correct_index = ['A', 'B', 'C', 'D'].index(correct_option_str)
+                    questions.append({
+                        "q": row['Question'],
+                        "options": [row['Option_A'], row['Option_B'], row['Option_C'], row['Option_D']],
+                        "correct": correct_index,
+                        "expl": row['Explanation_Feedback']
+                    })
+                except Exception as e:
+                    logging.error(f"Error processing row {index+2} in {file_path}: {e}")
+            question_sets[level] = questions
+            logging.info(f"Successfully loaded {len(questions)} questions for level: {level}")
+        except FileNotFoundError:
+            logging.error(f"Error: The file {file_path} was not found.")
+            question_sets[level] = []
+        except Exception as e:
+            logging.error(f"An error occurred while loading {file_path}: {e}")
+            question_sets[level] = []
+
+    # Load video 1 quiz
+    try:
+        video1_file_path = os.path.join('video1', 'exam.csv')
+        df = pd.read_csv(video1_file_path, encoding='utf-8')
+        questions = []
+        for index, row in df.iterrows():
+            try:
+                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
+                correct_answer_text = row['correct_answer']
+                correct_index = options.index(correct_answer_text)
+
+                option_explanations = [
+                    row.get('explanation_a', ''),
+                    row.get('explanation_b', ''),
+                    row.get('explanation_c', ''),
+                    row.get('explanation_d', '')
+                ]
+                
+                questions.append({
+                    "q": row['question'],
+                    "options": options,
+                    "correct": correct_index,
+                    "expl": row.get('correct_explanation', ''),
+                    "idea_expl": row.get('concept_explanation', ''),
+                    "option_explanations": option_explanations
+                })
+            except Exception as e:
+                logging.error(f"Error processing row {index+2} in {video1_file_path}: {e}")
+        question_sets['video1'] = questions
+        logging.info(f"Successfully loaded {len(questions)} questions for level: video1")
+    except FileNotFoundError:
+        logging.error(f"Error: The file {video1_file_path} was not found.")
+        question_sets['video1'] = []
+    except Exception as e:
+        logging.error(f"An error occurred while loading {video1_file_path}: {e}")
+        question_sets['video1'] = []
+
+    # Load video 2 mini quiz
+    try:
+        video2_mini_file_path = os.path.join('video2', 'mini_exam.csv')
+        df = pd.read_csv(video2_mini_file_path, encoding='utf-8')
+        questions = []
+        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
+        for index, row in df.iterrows():
+            try:
+                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
+                correct_answer_col_name = row['correct_answer']
+                correct_index = option_cols.index(correct_answer_col_name)
+
+                option_explanations = [
+                    row.get('explanation_a', ''),
+                    row.get('explanation_b', ''),
+                    row.get('explanation_c', ''),
+                    row.get('explanation_d', '')
+                ]
+                
+                questions.append({
+                    "q": row['question'],
+                    "options": options,
+                    "correct": correct_index,
+                    "expl": row.get('correct_explanation', ''),
+                    "idea_expl": row.get('concept_explanation', ''),
+                    "option_explanations": option_explanations
+                })
+            except Exception as e:
+                logging.error(f"Error processing row {index+2} in {video2_mini_file_path}: {e}")
+        question_sets['video2_mini'] = questions
+        logging.info(f"Successfully loaded {len(questions)} questions for level: video2_mini")
+    except FileNotFoundError:
+        # This is expected for now for the main video2 quiz
+        question_sets['video2_mini'] = []
+    except Exception as e:
+        logging.error(f"An error occurred while loading {video2_mini_file_path}: {e}")
+        question_sets['video2_mini'] = []
+
+    # Load video 2 main quiz
+    try:
+        video2_file_path = os.path.join('video2', 'exam.csv')
+        df = pd.read_csv(video2_file_path, encoding='utf-8')
+        questions = []
+        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
+        for index, row in df.iterrows():
+            try:
+                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
+                correct_answer_col_name = row['correct_answer']
+                correct_index = option_cols.index(correct_answer_col_name)
+
+                option_explanations = [
+                    row.get('explanation_a', ''),
+                    row.get('explanation_b', ''),
+                    row.get('explanation_c', ''),
+                    row.get('explanation_d', '')
+                ]
+                
+                questions.append({
+                    "q": row['question'],
+                    "options": options,
+                    "correct": correct_index,
+                    "expl": row.get('correct_explanation', ''),
+                    "idea_expl": row.get('concept_explanation', ''),
+                    "option_explanations": option_explanations
+                })
+            except Exception as e:
+                logging.error(f"Error processing row {index+2} in {video2_file_path}: {e}")
+        question_sets['video2'] = questions
+        logging.info(f"Successfully loaded {len(questions)} questions for level: video2")
+    except FileNotFoundError:
+        question_sets['video2'] = []
+    except Exception as e:
+        logging.error(f"An error occurred while loading {video2_file_path}: {e}")
+        question_sets['video2'] = []
+
+    # Load video 3 main quiz
+    try:
+        video3_file_path = os.path.join('video3', 'exam.csv')
+        df = pd.read_csv(video3_file_path, encoding='utf-8')
+        questions = []
+        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
+        for index, row in df.iterrows():
+            try:
+                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
+                correct_answer_col_name = row['correct_answer']
+                correct_index = option_cols.index(correct_answer_col_name)
+
+                option_explanations = [
+                    row.get('explanation_a', ''),
+                    row.get('explanation_b', ''),
+                    row.get('explanation_c', ''),
+                    row.get('explanation_d', '')
+                ]
+                
+                questions.append({
+                    "q": row['question'],
+                    "options": options,
+                    "correct": correct_index,
+                    "expl": row.get('correct_explanation', ''),
+                    "idea_expl": row.get('concept_explanation', ''),
+                    "option_explanations": option_explanations
+                })
+            except Exception as e:
+                logging.error(f"Error processing row {index+2} in {video3_file_path}: {e}")
+        question_sets['video3'] = questions
+        logging.info(f"Successfully loaded {len(questions)} questions for level: video3")
+    except FileNotFoundError:
+        question_sets['video3'] = []
+    except Exception as e:
+        logging.error(f"An error occurred while loading {video3_file_path}: {e}")
+        question_sets['video3'] = []
+
+    # Load video 4 main quiz
+    try:
+        video4_file_path = os.path.join('video4', 'exam.csv')
+        df = pd.read_csv(video4_file_path, encoding='utf-8')
+        questions = []
+        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
+        for index, row in df.iterrows():
+            try:
+                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
+                correct_answer_col_name = row['correct_answer']
+                correct_index = option_cols.index(correct_answer_col_name)
+
+                option_explanations = [
+                    row.get('explanation_a', ''),
+                    row.get('explanation_b', ''),
+                    row.get('explanation_c', ''),
+                    row.get('explanation_d', '')
+                ]
+                
+                questions.append({
+                    "q": row['question'],
+                    "options": options,
+                    "correct": correct_index,
+                    "expl": row.get('correct_explanation', ''),
+                    "idea_expl": row.get('concept_explanation', ''),
+                    "option_explanations": option_explanations
+                })
+            except Exception as e:
+                logging.error(f"Error processing row {index+2} in {video4_file_path}: {e}")
+        question_sets['video4'] = questions
+        logging.info(f"Successfully loaded {len(questions)} questions for level: video4")
+    except FileNotFoundError:
+        question_sets['video4'] = []
+    except Exception as e:
+        logging.error(f"An error occurred while loading {video4_file_path}: {e}")
+        question_sets['video4'] = []
+        
+    # Load Mazen test multiple choice quizzes
+    for i in range(1, 7): # Assuming ids 1 to 6
+        file_path = f"id{i}.csv"
+        level_name = f"mazin_id{i}"
+        try:
+            df = pd.read_csv(file_path, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, usecols=range(12), keep_default_na=False)
+            df.columns = [str(c).strip().lower() for c in df.columns]
+            questions = []
+            for index, row in df.iterrows():
+                try:
+                    options = [str(row.get('option_a', '')), str(row.get('option_b', '')), str(row.get('option_c', '')), str(row.get('option_d', ''))]
+                    correct_option_char = str(row.get('correct_answer', '')).strip().upper()
+                    # Try to extract first character if it's a full text
+                    if len(correct_option_char) > 1:
+                        # If it's a full text, try to find which option matches
+                        option_texts = [
+                            str(row.get('option_a', '')).strip(),
+                            str(row.get('option_b', '')).strip(),
+                            str(row.get('option_c', '')).strip(),
+                            str(row.get('option_d', '')).strip()
+                        ]
+                        # Try to find matching option
+                        correct_index = None
+                        for idx, opt_text in enumerate(option_texts):
+                            if opt_text == correct_option_char or opt_text.upper() == correct_option_char:
+                                correct_index = idx
+                                break
+                        # If not found, try first character
+                        if correct_index is None and len(correct_option_char) > 0:
+                            first_char = correct_option_char[0]
+                            if first_char in ['A', 'B', 'C', 'D']:
+                                correct_index = ['A', 'B', 'C', 'D'].index(first_char)
+                        if correct_index is None:
+                            raise ValueError(f"Could not determine correct answer from: {correct_option_char}")
+                    else:
+                        correct_index = ['A', 'B', 'C', 'D'].index(correct_option_char)
+
+                    option_explanations = [
+                        str(row.get('explanation_a', '')),
+                        str(row.get('explanation_b', '')),
+                        str(row.get('explanation_c', '')),
+                        str(row.get('explanation_d', ''))
+                    ]
+                    
+                    questions.append({
+                        "q": str(row.get('question', '')),
+                        "options": options,
+                        "correct": correct_index,
+                        "expl": str(row.get('correct_explanation', '')),
+                        "idea_expl": str(row.get('concept_explanation', '')),
+                        "option_explanations": option_explanations
+                    })
+                except Exception as e:
+                    logging.error(f"Error processing row {index+2} in {file_path}: {e}")
+            question_sets[level_name] = questions
+            logging.info(f"Successfully loaded {len(questions)} questions for Mazen test level: {level_name}")
+        except FileNotFoundError:
+            logging.warning(f"Mazen test quiz file not found: {file_path}")
+            question_sets[level_name] = []
+        except KeyError as e:
+            logging.error(f"Column {e} not found in {file_path}. Check CSV format.")
+            question_sets[level_name] = []
+        except Exception as e:
+            logging.error(f"An error occurred while loading {file_path}: {e}")
+            question_sets[level_name] = []
+            
+    return question_sets
@@ -0,0 +1,70 @@
+"""
+Answer-commit throughput benchmark.
+
+Replays the per-click write of the ans_ branch (record_answer_and_state)
+against a scratch database, once with SQLite's defaults
+(rollback journal, synchronous=FULL), once with SQLITE_PROFILE and once
+with SQLITE_PROFILE plus the progress write-behind buffer. Run from the
+bot folder:
+
+    python bench_sqlite.py [commits]
+"""
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import bot
+
+# What the bot used before init_db applied SQLITE_PROFILE
+SQLITE_DEFAULTS = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+
+def commits_per_second(profile, commits, users=30, write_behind=False):
+    db_file = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = sqlite3.connect(db_file, check_same_thread=False)
+    bot.init_db(conn, profile)
+    for user_id in range(users):
+        bot.get_user_state(user_id, f"user {user_id}", conn)
+
+    bot.progress_buffer.write_through = not write_behind
+    start = time.perf_counter()
+    for i in range(commits):
+        user_id = i % users
+        bot.record_answer_and_state(user_id, f"user {user_id}", "easy", 0, i // users, i % 4, i % 2 == 0,
+                                    i // users + 1, i // 2, conn)
+        # one flush per full round of the class, like the flush job during an exam
+        if write_behind and user_id == users - 1:
+            bot.flush_user_progress(conn)
+    bot.flush_user_progress(conn)
+    elapsed = time.perf_counter() - start
+    bot.progress_buffer.write_through = True
+    conn.close()
+    return commits / elapsed
+
+
+def main():
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    logging.disable(logging.CRITICAL)
+
+    before = commits_per_second(SQLITE_DEFAULTS, commits)
+    after = commits_per_second(None, commits)
+    buffered = commits_per_second(None, commits, write_behind=True)
+
+    lines = [
+        f"answer save throughput ({commits} answer clicks)",
+        f"  SQLite defaults (before):     {before:8.0f} commits/s",
+        f"  SQLITE_PROFILE (after):       {after:8.0f} commits/s",
+        f"  SQLITE_PROFILE + write-behind:{buffered:8.0f} saves/s",
+        f"  speedup:                      {after / before if before else 0:8.1f}x / {buffered / before if before else 0:.1f}x",
+    ]
+    report = "\n".join(lines)
+    print(report)
+    with open("bench_output.txt", "a", encoding="utf-8") as f:
+        f.write(report + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
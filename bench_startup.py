@@ -0,0 +1,74 @@
+"""
+Startup benchmark for the question bank.
+
+Compares parsing every CSV the old way (row-by-row iterrows loaders, copied
+in bench_legacy_loaders.py) with the current column-wise loaders and with
+loading the compiled snapshot. Run from the bot folder:
+
+    python bench_startup.py [rounds]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import bench_legacy_loaders
+import bot
+
+
+def timed(func, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    logging.disable(logging.CRITICAL)
+
+    snapshot_file = os.path.join(tempfile.mkdtemp(), "question_bank.snapshot")
+
+    def parse_csvs_iterrows():
+        bench_legacy_loaders.load_all_questions()
+        bench_legacy_loaders.load_mazen_test_data()
+
+    def parse_csvs():
+        bot.load_all_questions()
+        bot.load_mazen_test_data()
+
+    def build_snapshot():
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
+        bot.load_question_bank(snapshot_file)
+
+    def warm_snapshot():
+        bot.load_question_bank(snapshot_file)
+
+    before = timed(parse_csvs_iterrows, rounds)
+    columns = timed(parse_csvs, rounds)
+    build = timed(build_snapshot, rounds)
+    after = timed(warm_snapshot, rounds)
+    size = os.path.getsize(snapshot_file)
+
+    lines = [
+        f"question bank startup (best of {rounds})",
+        f"  parse all CSVs (before):      {before * 1000:8.1f} ms",
+        f"  parse all CSVs column-wise:   {columns * 1000:8.1f} ms",
+        f"  cold start + write snapshot:  {build * 1000:8.1f} ms",
+        f"  warm start from snapshot:     {after * 1000:8.1f} ms",
+        f"  speedup:                      {before / after if after else 0:8.1f}x",
+        f"  snapshot size:                {size / 1024:8.1f} KB",
+    ]
+    report = "\n".join(lines)
+    print(report)
+    with open("bench_output.txt", "a", encoding="utf-8") as f:
+        f.write(report + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,14 @@ import json
 import os
 import random
 import sqlite3
-import pandas as pd
+import csv
 import html
 import time
 from telegram.helpers import escape_markdown
 import zipfile
+import gzip
+import shutil
+import tempfile
 from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply, ReplyKeyboardMarkup, KeyboardButton
@@ -17,6 +20,7 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
 import asyncio
 import time
+from collections import OrderedDict
 
 # ------------------- إعدادات البوت الآمنة -------------------
 # يتم تحميل القيم من ملف .env أو من متغيرات بيئة الخادم
@@ -39,6 +43,12 @@ MAINTENANCE_MODE = os.getenv("MAINTENANCE_MODE", "false").lower() in ("1", "true
 DB_FILE = "user_progress.db"
 MENUS_FILE = "menus.json"
 EXAMS_FILE = "exams.json"  # Kept for backward compatibility, but data is now in database
+# عدد الاختبارات المحفوظة في الذاكرة بعد تحليلها (الأقدم استخداماً يُحذف أولاً)
+DYNAMIC_EXAM_CACHE_SIZE = int(os.getenv("DYNAMIC_EXAM_CACHE_SIZE", "20") or 20)
+# عدد ملفات الاختبارات التي تُنزّل من تيليجرام بالتوازي عند الإقلاع
+EXAM_PREFETCH_CONCURRENCY = int(os.getenv("EXAM_PREFETCH_CONCURRENCY", "4") or 4)
+# عدد الطلاب الذين تُحفظ إنجازاتهم في الذاكرة
+BADGE_CACHE_USERS = int(os.getenv("BADGE_CACHE_USERS", "2000") or 2000)
 
 # إعداد السجلات
 logging.basicConfig(
@@ -71,6 +81,7 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                 return
 
             if os.path.exists(DB_FILE):
+                checkpoint_db(mode="TRUNCATE")
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/octet-stream')
                 self.send_header('Content-Disposition', f'attachment; filename="{os.path.basename(DB_FILE)}"')
@@ -90,7 +101,7 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         mazen_rows_html = ""
         try:
             if os.path.exists(DB_FILE):
-                conn = sqlite3.connect(DB_FILE)
+                conn = configure_db(sqlite3.connect(DB_FILE))
                 cursor = conn.cursor()
                 
                 # Fetch User Progress (الجدول القديم)
@@ -118,7 +129,7 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                         """
                 
                 # Fetch Lab Results (الجدول الجديد)
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='lab_results'")
+                cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name='lab_results'")
                 if cursor.fetchone():
                     cursor.execute("SELECT user_id, first_name, video1, video2, video2_mini, video3, video4 FROM lab_results")
                     lab_rows = cursor.fetchall()
@@ -150,7 +161,7 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                     lab_rows_html = "<tr><td colspan='7' style='text-align:center'>جدول النتائج غير موجود</td></tr>"
                 
                 # Fetch Mazen Results
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='mazen_results'")
+                cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name='mazen_results'")
                 if cursor.fetchone():
                     cursor.execute("SELECT user_id, first_name, id1, id2, id3, id4, id5, id6 FROM mazen_results")
                     mazen_rows = cursor.fetchall()
@@ -275,10 +286,191 @@ def start_web_server():
     print(f"Web Dashboard listening on port {port}")
     server.serve_forever()
 
+# ------------------- تحويل جداول CSV إلى أسئلة -------------------
+# Every loader (static banks, Mazen files, dynamic exams) goes through these
+# column-wise converters instead of walking the DataFrame with iterrows().
+# Rows that cannot be converted are reported once per file.
+
+OPTION_LETTERS = ['A', 'B', 'C', 'D']
+OPTION_COLUMNS = ['option_a', 'option_b', 'option_c', 'option_d']
+OPTION_EXPLANATION_COLUMNS = ['explanation_a', 'explanation_b', 'explanation_c', 'explanation_d']
+
+# read_csv options used for admin-uploaded / Mazen MCQ and narrative files
+MCQ_CSV_OPTIONS = {'encoding': 'utf-8-sig', 'on_bad_lines': 'skip', 'dtype': str, 'usecols': range(12), 'keep_default_na': False}
+NARRATIVE_CSV_OPTIONS = {'encoding': 'utf-8-sig', 'on_bad_lines': 'skip', 'dtype': str, 'keep_default_na': False}
+
+def normalize_frame_columns(df):
+    """Strips and lower-cases column names in place."""
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    return df
+
+def frame_column_values(df, column, default=None):
+    """Returns a column as a plain list, or [default] * rows if it is missing."""
+    if column not in df.columns:
+        return [default] * len(df)
+    return df[column].tolist()
+
+def frame_text_column(df, column):
+    """Returns a column as a list of str (empty cells become ''), or '' per row if missing."""
+    if column not in df.columns:
+        return [''] * len(df)
+    return df[column].fillna('').astype(str).tolist()
+
+def resolve_correct_answers(df, allow_first_letter=False):
+    """
+    Resolves correct_answer for every row at once. Accepts a letter ('B'),
+    an option column name ('Option_B' / 'option_b') or the full option text.
+    With allow_first_letter, anything else is matched on its first letter.
+    Returns a Series of option indexes, -1 where the answer is unresolved.
+    """
+    answers = df['correct_answer'].fillna('').astype(str).str.strip().str.upper()
+    letter_index = {letter: i for i, letter in enumerate(OPTION_LETTERS)}
+
+    letters = answers.str.replace(r'^OPTION_', '', regex=True)
+    correct = letters.where(letters.str.len() == 1).map(letter_index)
+    for i, column in enumerate(OPTION_COLUMNS):
+        option_text = df[column].fillna('').astype(str).str.strip().str.upper()
+        correct = correct.mask(correct.isna() & (answers != '') & (option_text == answers), i)
+    if allow_first_letter:
+        correct = correct.fillna(answers.str[:1].map(letter_index))
+    return correct.fillna(-1).astype(int)
+
+def report_bad_rows(source, bad_rows, reason):
+    if not bad_rows:
+        return
+    shown = ', '.join(str(r) for r in bad_rows[:20])
+    more = f" (+{len(bad_rows) - 20} more)" if len(bad_rows) > 20 else ""
+    logging.error(f"Skipped {len(bad_rows)} row(s) in {source} ({reason}): rows {shown}{more}")
+
+def frame_to_mcq_questions(df, source, allow_first_letter=False, expl_column='correct_explanation', with_details=True, extra=None):
+    """
+    Converts a whole MCQ DataFrame to the question structure used by
+    send_question_view. with_details adds idea_expl/option_explanations;
+    extra is merged into every question (e.g. {"id": unit_id}).
+    """
+    normalize_frame_columns(df)
+    missing = [c for c in OPTION_COLUMNS + ['correct_answer'] if c not in df.columns]
+    if missing:
+        raise KeyError(', '.join(missing))
+
+    correct = resolve_correct_answers(df, allow_first_letter).tolist()
+    texts = frame_text_column(df, 'question')
+    options = list(zip(*(frame_text_column(df, c) for c in OPTION_COLUMNS)))
+    explanations = frame_text_column(df, expl_column)
+    if with_details:
+        ideas = frame_text_column(df, 'concept_explanation')
+        option_explanations = list(zip(*(frame_text_column(df, c) for c in OPTION_EXPLANATION_COLUMNS)))
+
+    questions = []
+    bad_rows = []
+    for i, correct_index in enumerate(correct):
+        if correct_index < 0:
+            bad_rows.append(i + 2)
+            continue
+        question = {
+            "q": texts[i],
+            "options": list(options[i]),
+            "correct": correct_index,
+            "expl": explanations[i]
+        }
+        if with_details:
+            question["idea_expl"] = ideas[i]
+            question["option_explanations"] = list(option_explanations[i])
+        if extra:
+            question.update(extra)
+        questions.append(question)
+
+    report_bad_rows(source, bad_rows, "could not determine correct_answer")
+    return questions
+
+def frame_to_narrative_questions(df, extra=None):
+    """Converts a question/answer DataFrame to narrative question dicts."""
+    normalize_frame_columns(df)
+    questions = [
+        {"question": question, "answer": answer}
+        for question, answer in zip(frame_text_column(df, 'question'), frame_text_column(df, 'answer'))
+    ]
+    if extra:
+        for question in questions:
+            question.update(extra)
+    return questions
+
+def frame_to_texts(df, texts=None):
+    """Groups an id/level/text DataFrame into {id: {level: text}}."""
+    normalize_frame_columns(df)
+    texts = {} if texts is None else texts
+    for id_val, level, text in zip(frame_column_values(df, 'id', 1), frame_column_values(df, 'level', 1), frame_text_column(df, 'text')):
+        texts.setdefault(id_val, {})[level] = text
+    return texts
+
+# ------------------- قراءة ملفات CSV الصغيرة (csv fast path) -------------------
+# pandas is imported lazily by the functions that need it. Small files with a
+# simple shape (phrases, textlevels.csv, idXsrd.csv) are read with the csv
+# module instead, so a warm start never has to import pandas at all.
+
+# Files up to this size are read with the csv module
+SMALL_CSV_MAX_BYTES = int(os.getenv("SMALL_CSV_MAX_BYTES", str(256 * 1024)) or 256 * 1024)
+
+def is_small_csv(file_path):
+    """True if file_path is small enough for the csv fast path (raises FileNotFoundError if missing)."""
+    return os.path.getsize(file_path) <= SMALL_CSV_MAX_BYTES
+
+def read_csv_rows(file_path, encoding='utf-8-sig'):
+    """
+    Reads a CSV with the csv module as a list of {column: str} dicts, with
+    stripped, lower-cased column names. Like the pandas loaders, blank lines
+    and rows with too many fields are skipped and short rows are padded with ''.
+    """
+    with open(file_path, encoding=encoding, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            return []
+        columns = [c.strip().lower() for c in header]
+        rows = []
+        bad_rows = []
+        for line in reader:
+            if not line:
+                continue
+            if len(line) > len(columns):
+                bad_rows.append(reader.line_num)
+                continue
+            rows.append(dict(zip(columns, line + [''] * (len(columns) - len(line)))))
+    report_bad_rows(file_path, bad_rows, "too many fields")
+    return rows
+
+def csv_number(value, default):
+    """Parses an id/level cell the way pandas would infer it: int if possible, else the raw text."""
+    value = (value or '').strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            number = float(value)
+            return int(number) if number.is_integer() else number
+        except ValueError:
+            return value
+
+def rows_to_narrative_questions(rows):
+    """csv fast path counterpart of frame_to_narrative_questions."""
+    return [{"question": row.get('question', ''), "answer": row.get('answer', '')} for row in rows]
+
+def rows_to_texts(rows, texts=None):
+    """csv fast path counterpart of frame_to_texts."""
+    texts = {} if texts is None else texts
+    for row in rows:
+        texts.setdefault(csv_number(row.get('id'), 1), {})[csv_number(row.get('level'), 1)] = row.get('text', '')
+    return texts
+
 # ------------------- دوال تحميل الأسئلة والعبارات -------------------
 
 def load_phrases(file_path):
     try:
+        if is_small_csv(file_path):
+            return [row['phrase_text'] for row in read_csv_rows(file_path) if row['phrase_text']]
+        import pandas as pd
         df = pd.read_csv(file_path, encoding='utf-8')
         return df['Phrase_Text'].tolist()
     except FileNotFoundError:
@@ -288,330 +480,302 @@ def load_phrases(file_path):
         logging.error(f"Error loading phrase file {file_path}: {e}")
         return []
 
-def load_mazen_test_data():
+def load_mazen_texts(file_path='textlevels.csv'):
+    """Loads the Mazen test reading texts as {id: {level: text}}; None when the file is missing or unreadable."""
     mazen_texts = {}
-    mazen_srd = {}
-    
-    # Load texts from textlevels.csv
     try:
-        df = pd.read_csv('textlevels.csv', encoding='utf-8')
-        df.columns = [c.strip().lower() for c in df.columns]
-        for _, row in df.iterrows():
-            id_val, level, text = row['id'], row['level'], row['text']
-            if id_val not in mazen_texts:
-                mazen_texts[id_val] = {}
-            mazen_texts[id_val][level] = text
+        if is_small_csv(file_path):
+            rows_to_texts(read_csv_rows(file_path), mazen_texts)
+        else:
+            import pandas as pd
+            frame_to_texts(pd.read_csv(file_path, encoding='utf-8'), mazen_texts)
         logging.info(f"Successfully loaded Mazen test texts for {len(mazen_texts)} IDs.")
+        return mazen_texts
+    except FileNotFoundError:
+        logging.error(f"Error: {file_path} not found.")
+    except Exception as e:
+        logging.error(f"An error occurred while loading {file_path}: {e}")
+    return None
+
+def load_mazen_srd_questions(file_path):
+    """Loads one idXsrd.csv file; returns None when it is missing or unreadable."""
+    try:
+        if is_small_csv(file_path):
+            srd_questions = rows_to_narrative_questions(read_csv_rows(file_path))
+        else:
+            import pandas as pd
+            srd_questions = frame_to_narrative_questions(pd.read_csv(file_path, **NARRATIVE_CSV_OPTIONS))
+        logging.info(f"Successfully loaded {len(srd_questions)} narrative questions from {file_path}.")
+        return srd_questions
     except FileNotFoundError:
-        logging.error("Error: textlevels.csv not found.")
+        # It's okay if some files don't exist, just means the test ends there.
+        logging.warning(f"Narrative question file not found: {file_path}")
     except Exception as e:
-        logging.error(f"An error occurred while loading textlevels.csv: {e}")
+        logging.error(f"An error occurred while loading {file_path}: {e}")
+    return None
+
+def load_mazen_test_data():
+    mazen_texts = load_mazen_texts('textlevels.csv') or {}
+    mazen_srd = {}
 
     # Load narrative questions from idxsrd.csv files
     for i in range(1, 7):  # Assuming ids 1 to 6
-        file_path = f'id{i}srd.csv'
-        try:
-            df = pd.read_csv(file_path, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, keep_default_na=False)
-            df.columns = [str(c).strip().lower() for c in df.columns]
-            srd_questions = []
-            for _, row in df.iterrows():
-                srd_questions.append({
-                    "question": row['question'],
-                    "answer": row['answer']
-                })
+        srd_questions = load_mazen_srd_questions(f'id{i}srd.csv')
+        if srd_questions is not None:
             mazen_srd[i] = srd_questions
-            logging.info(f"Successfully loaded {len(srd_questions)} narrative questions for id{i}.")
-        except FileNotFoundError:
-            # It's okay if some files don't exist, just means the test ends there.
-            logging.warning(f"Narrative question file not found: {file_path}")
-        except Exception as e:
-            logging.error(f"An error occurred while loading {file_path}: {e}")
-            
-    return mazen_texts, mazen_srd
 
-def load_all_questions():
-    levels = ['easy', 'medium', 'hard']
-    question_sets = {}
-    
-    for level in levels:
-        file_path = f"{level.capitalize()}_Level.csv"
-        try:
-            df = pd.read_csv(file_path, encoding='utf-8', dtype={'Correct_Answer': str})
-            questions = []
-            for index, row in df.iterrows():
-                try:
-                    correct_option_str = row['Correct_Answer'].replace('Option_', '')
-                    correct_index = ['A', 'B', 'C', 'D'].index(correct_option_str)
-                    questions.append({
-                        "q": row['Question'],
-                        "options": [row['Option_A'], row['Option_B'], row['Option_C'], row['Option_D']],
-                        "correct": correct_index,
-                        "expl": row['Explanation_Feedback']
-                    })
-                except Exception as e:
-                    logging.error(f"Error processing row {index+2} in {file_path}: {e}")
-            question_sets[level] = questions
-            logging.info(f"Successfully loaded {len(questions)} questions for level: {level}")
-        except FileNotFoundError:
-            logging.error(f"Error: The file {file_path} was not found.")
-            question_sets[level] = []
-        except Exception as e:
-            logging.error(f"An error occurred while loading {file_path}: {e}")
-            question_sets[level] = []
+    return mazen_texts, mazen_srd
 
-    # Load video 1 quiz
+def load_level_questions(file_path):
+    """Loads an Easy/Medium/Hard level file (Correct_Answer is 'Option_X'); None if it cannot be read."""
     try:
-        video1_file_path = os.path.join('video1', 'exam.csv')
-        df = pd.read_csv(video1_file_path, encoding='utf-8')
-        questions = []
-        for index, row in df.iterrows():
-            try:
-                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
-                correct_answer_text = row['correct_answer']
-                correct_index = options.index(correct_answer_text)
-
-                option_explanations = [
-                    row.get('explanation_a', ''),
-                    row.get('explanation_b', ''),
-                    row.get('explanation_c', ''),
-                    row.get('explanation_d', '')
-                ]
-                
-                questions.append({
-                    "q": row['question'],
-                    "options": options,
-                    "correct": correct_index,
-                    "expl": row.get('correct_explanation', ''),
-                    "idea_expl": row.get('concept_explanation', ''),
-                    "option_explanations": option_explanations
-                })
-            except Exception as e:
-                logging.error(f"Error processing row {index+2} in {video1_file_path}: {e}")
-        question_sets['video1'] = questions
-        logging.info(f"Successfully loaded {len(questions)} questions for level: video1")
+        import pandas as pd
+        df = pd.read_csv(file_path, encoding='utf-8', dtype={'Correct_Answer': str})
+        questions = frame_to_mcq_questions(df, file_path, expl_column='explanation_feedback', with_details=False)
+        logging.info(f"Successfully loaded {len(questions)} questions from {file_path}")
+        return questions
     except FileNotFoundError:
-        logging.error(f"Error: The file {video1_file_path} was not found.")
-        question_sets['video1'] = []
+        logging.error(f"Error: The file {file_path} was not found.")
     except Exception as e:
-        logging.error(f"An error occurred while loading {video1_file_path}: {e}")
-        question_sets['video1'] = []
+        logging.error(f"An error occurred while loading {file_path}: {e}")
+    return None
 
-    # Load video 2 mini quiz
+def load_video_questions(file_path, required=False):
+    """
+    Loads a videoN exam file. correct_answer holds the option text (video1)
+    or the option column name (video2+); both are resolved by the engine.
+    Returns None if the file is missing or cannot be read.
+    """
     try:
-        video2_mini_file_path = os.path.join('video2', 'mini_exam.csv')
-        df = pd.read_csv(video2_mini_file_path, encoding='utf-8')
-        questions = []
-        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
-        for index, row in df.iterrows():
-            try:
-                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
-                correct_answer_col_name = row['correct_answer']
-                correct_index = option_cols.index(correct_answer_col_name)
-
-                option_explanations = [
-                    row.get('explanation_a', ''),
-                    row.get('explanation_b', ''),
-                    row.get('explanation_c', ''),
-                    row.get('explanation_d', '')
-                ]
-                
-                questions.append({
-                    "q": row['question'],
-                    "options": options,
-                    "correct": correct_index,
-                    "expl": row.get('correct_explanation', ''),
-                    "idea_expl": row.get('concept_explanation', ''),
-                    "option_explanations": option_explanations
-                })
-            except Exception as e:
-                logging.error(f"Error processing row {index+2} in {video2_mini_file_path}: {e}")
-        question_sets['video2_mini'] = questions
-        logging.info(f"Successfully loaded {len(questions)} questions for level: video2_mini")
+        import pandas as pd
+        df = pd.read_csv(file_path, encoding='utf-8')
+        questions = frame_to_mcq_questions(df, file_path)
+        logging.info(f"Successfully loaded {len(questions)} questions from {file_path}")
+        return questions
     except FileNotFoundError:
-        # This is expected for now for the main video2 quiz
-        question_sets['video2_mini'] = []
+        # Video quizzes are optional until their folder is extracted
+        if required:
+            logging.error(f"Error: The file {file_path} was not found.")
     except Exception as e:
-        logging.error(f"An error occurred while loading {video2_mini_file_path}: {e}")
-        question_sets['video2_mini'] = []
+        logging.error(f"An error occurred while loading {file_path}: {e}")
+    return None
 
-    # Load video 2 main quiz
+def load_mazen_mcq_questions(file_path):
+    """Loads an idN.csv Mazen multiple choice file (letter or full-text answers); None if it cannot be read."""
     try:
-        video2_file_path = os.path.join('video2', 'exam.csv')
-        df = pd.read_csv(video2_file_path, encoding='utf-8')
-        questions = []
-        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
-        for index, row in df.iterrows():
-            try:
-                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
-                correct_answer_col_name = row['correct_answer']
-                correct_index = option_cols.index(correct_answer_col_name)
-
-                option_explanations = [
-                    row.get('explanation_a', ''),
-                    row.get('explanation_b', ''),
-                    row.get('explanation_c', ''),
-                    row.get('explanation_d', '')
-                ]
-                
-                questions.append({
-                    "q": row['question'],
-                    "options": options,
-                    "correct": correct_index,
-                    "expl": row.get('correct_explanation', ''),
-                    "idea_expl": row.get('concept_explanation', ''),
-                    "option_explanations": option_explanations
-                })
-            except Exception as e:
-                logging.error(f"Error processing row {index+2} in {video2_file_path}: {e}")
-        question_sets['video2'] = questions
-        logging.info(f"Successfully loaded {len(questions)} questions for level: video2")
+        import pandas as pd
+        df = pd.read_csv(file_path, **MCQ_CSV_OPTIONS)
+        questions = frame_to_mcq_questions(df, file_path, allow_first_letter=True)
+        logging.info(f"Successfully loaded {len(questions)} questions for Mazen test file: {file_path}")
+        return questions
     except FileNotFoundError:
-        question_sets['video2'] = []
+        logging.warning(f"Mazen test quiz file not found: {file_path}")
+    except KeyError as e:
+        logging.error(f"Column {e} not found in {file_path}. Check CSV format.")
     except Exception as e:
-        logging.error(f"An error occurred while loading {video2_file_path}: {e}")
-        question_sets['video2'] = []
+        logging.error(f"An error occurred while loading {file_path}: {e}")
+    return None
+
+def question_bank_sources():
+    """
+    Lists every file that makes up the question bank as
+    (section, key, file_path, loader) tuples.
+    """
+    sources = []
+    for level in ['easy', 'medium', 'hard']:
+        sources.append(('questions', level, f"{level.capitalize()}_Level.csv", load_level_questions))
+    sources.append(('questions', 'video1', os.path.join('video1', 'exam.csv'), lambda path: load_video_questions(path, required=True)))
+    sources.append(('questions', 'video2_mini', os.path.join('video2', 'mini_exam.csv'), load_video_questions))
+    for n in range(2, 5):
+        sources.append(('questions', f'video{n}', os.path.join(f'video{n}', 'exam.csv'), load_video_questions))
+    for i in range(1, 7):  # Assuming ids 1 to 6
+        sources.append(('questions', f'mazin_id{i}', f"id{i}.csv", load_mazen_mcq_questions))
+    sources.append(('mazen_texts', None, 'textlevels.csv', load_mazen_texts))
+    for i in range(1, 7):
+        sources.append(('mazen_srd', i, f'id{i}srd.csv', load_mazen_srd_questions))
+    return sources
+
+def load_all_questions():
+    question_sets = {}
+    for section, key, file_path, loader in question_bank_sources():
+        if section == 'questions':
+            question_sets[key] = loader(file_path) or []
+    return question_sets
+
+# ------------------- لقطة بنك الأسئلة (Question bank snapshot) -------------------
+# The parsed question bank is pickled next to the CSVs together with a
+# fingerprint of every source file, so a restart only re-parses files whose
+# content actually changed.
+
+QUESTION_BANK_SNAPSHOT_FILE = os.getenv("QUESTION_BANK_SNAPSHOT_FILE", "question_bank.snapshot")
+# Bump whenever the structure produced by the loaders changes.
+QUESTION_BANK_SNAPSHOT_VERSION = 2
+# كل كم ثانية نفحص ملفات الأسئلة والعبارات بحثاً عن تعديلات (0 = بدون مراقبة)
+QUESTION_RELOAD_INTERVAL = int(os.getenv("QUESTION_RELOAD_INTERVAL", "30") or 0)
 
-    # Load video 3 main quiz
+def question_source_fingerprint(file_path, previous=None):
+    """
+    Returns (size, mtime_ns, sha1) for a source file, or None if it is missing.
+    The file is only hashed when size/mtime differ from the previous fingerprint.
+    """
     try:
-        video3_file_path = os.path.join('video3', 'exam.csv')
-        df = pd.read_csv(video3_file_path, encoding='utf-8')
-        questions = []
-        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
-        for index, row in df.iterrows():
-            try:
-                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
-                correct_answer_col_name = row['correct_answer']
-                correct_index = option_cols.index(correct_answer_col_name)
-
-                option_explanations = [
-                    row.get('explanation_a', ''),
-                    row.get('explanation_b', ''),
-                    row.get('explanation_c', ''),
-                    row.get('explanation_d', '')
-                ]
-                
-                questions.append({
-                    "q": row['question'],
-                    "options": options,
-                    "correct": correct_index,
-                    "expl": row.get('correct_explanation', ''),
-                    "idea_expl": row.get('concept_explanation', ''),
-                    "option_explanations": option_explanations
-                })
-            except Exception as e:
-                logging.error(f"Error processing row {index+2} in {video3_file_path}: {e}")
-        question_sets['video3'] = questions
-        logging.info(f"Successfully loaded {len(questions)} questions for level: video3")
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    if previous and previous[0] == st.st_size and previous[1] == st.st_mtime_ns:
+        return previous
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return (st.st_size, st.st_mtime_ns, sha1.hexdigest())
+
+def read_question_bank_snapshot(snapshot_file=QUESTION_BANK_SNAPSHOT_FILE):
+    """Returns the cached source entries, or {} if the snapshot is missing, stale or corrupt."""
+    import pickle
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+        if not isinstance(snapshot, dict) or snapshot.get('version') != QUESTION_BANK_SNAPSHOT_VERSION:
+            logging.info("Question bank snapshot version changed, rebuilding.")
+            return {}
+        return snapshot.get('sources', {})
     except FileNotFoundError:
-        question_sets['video3'] = []
+        return {}
     except Exception as e:
-        logging.error(f"An error occurred while loading {video3_file_path}: {e}")
-        question_sets['video3'] = []
+        logging.warning(f"Could not read question bank snapshot {snapshot_file}: {e}")
+        return {}
 
-    # Load video 4 main quiz
+def write_question_bank_snapshot(entries, snapshot_file=QUESTION_BANK_SNAPSHOT_FILE):
+    """Atomically writes the snapshot (temp file + rename)."""
+    import pickle
+    tmp_file = f"{snapshot_file}.tmp"
     try:
-        video4_file_path = os.path.join('video4', 'exam.csv')
-        df = pd.read_csv(video4_file_path, encoding='utf-8')
-        questions = []
-        option_cols = ['option_a', 'option_b', 'option_c', 'option_d']
-        for index, row in df.iterrows():
-            try:
-                options = [row['option_a'], row['option_b'], row['option_c'], row['option_d']]
-                correct_answer_col_name = row['correct_answer']
-                correct_index = option_cols.index(correct_answer_col_name)
-
-                option_explanations = [
-                    row.get('explanation_a', ''),
-                    row.get('explanation_b', ''),
-                    row.get('explanation_c', ''),
-                    row.get('explanation_d', '')
-                ]
-                
-                questions.append({
-                    "q": row['question'],
-                    "options": options,
-                    "correct": correct_index,
-                    "expl": row.get('correct_explanation', ''),
-                    "idea_expl": row.get('concept_explanation', ''),
-                    "option_explanations": option_explanations
-                })
-            except Exception as e:
-                logging.error(f"Error processing row {index+2} in {video4_file_path}: {e}")
-        question_sets['video4'] = questions
-        logging.info(f"Successfully loaded {len(questions)} questions for level: video4")
-    except FileNotFoundError:
-        question_sets['video4'] = []
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'version': QUESTION_BANK_SNAPSHOT_VERSION, 'sources': entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, snapshot_file)
     except Exception as e:
-        logging.error(f"An error occurred while loading {video4_file_path}: {e}")
-        question_sets['video4'] = []
-        
-    # Load Mazen test multiple choice quizzes
-    for i in range(1, 7): # Assuming ids 1 to 6
-        file_path = f"id{i}.csv"
-        level_name = f"mazin_id{i}"
-        try:
-            df = pd.read_csv(file_path, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, usecols=range(12), keep_default_na=False)
-            df.columns = [str(c).strip().lower() for c in df.columns]
-            questions = []
-            for index, row in df.iterrows():
-                try:
-                    options = [str(row.get('option_a', '')), str(row.get('option_b', '')), str(row.get('option_c', '')), str(row.get('option_d', ''))]
-                    correct_option_char = str(row.get('correct_answer', '')).strip().upper()
-                    # Try to extract first character if it's a full text
-                    if len(correct_option_char) > 1:
-                        # If it's a full text, try to find which option matches
-                        option_texts = [
-                            str(row.get('option_a', '')).strip(),
-                            str(row.get('option_b', '')).strip(),
-                            str(row.get('option_c', '')).strip(),
-                            str(row.get('option_d', '')).strip()
-                        ]
-                        # Try to find matching option
-                        correct_index = None
-                        for idx, opt_text in enumerate(option_texts):
-                            if opt_text == correct_option_char or opt_text.upper() == correct_option_char:
-                                correct_index = idx
-                                break
-                        # If not found, try first character
-                        if correct_index is None and len(correct_option_char) > 0:
-                            first_char = correct_option_char[0]
-                            if first_char in ['A', 'B', 'C', 'D']:
-                                correct_index = ['A', 'B', 'C', 'D'].index(first_char)
-                        if correct_index is None:
-                            raise ValueError(f"Could not determine correct answer from: {correct_option_char}")
-                    else:
-                        correct_index = ['A', 'B', 'C', 'D'].index(correct_option_char)
+        logging.warning(f"Could not write question bank snapshot {snapshot_file}: {e}")
 
-                    option_explanations = [
-                        str(row.get('explanation_a', '')),
-                        str(row.get('explanation_b', '')),
-                        str(row.get('explanation_c', '')),
-                        str(row.get('explanation_d', ''))
-                    ]
-                    
-                    questions.append({
-                        "q": str(row.get('question', '')),
-                        "options": options,
-                        "correct": correct_index,
-                        "expl": str(row.get('correct_explanation', '')),
-                        "idea_expl": str(row.get('concept_explanation', '')),
-                        "option_explanations": option_explanations
-                    })
-                except Exception as e:
-                    logging.error(f"Error processing row {index+2} in {file_path}: {e}")
-            question_sets[level_name] = questions
-            logging.info(f"Successfully loaded {len(questions)} questions for Mazen test level: {level_name}")
-        except FileNotFoundError:
-            logging.warning(f"Mazen test quiz file not found: {file_path}")
-            question_sets[level_name] = []
-        except KeyError as e:
-            logging.error(f"Column {e} not found in {file_path}. Check CSV format.")
-            question_sets[level_name] = []
-        except Exception as e:
-            logging.error(f"An error occurred while loading {file_path}: {e}")
-            question_sets[level_name] = []
-            
-    return question_sets
+def load_question_bank(snapshot_file=QUESTION_BANK_SNAPSHOT_FILE):
+    """
+    Loads questions, mazen_texts and mazen_srd, reusing the snapshot for every
+    source file whose size and sha1 are unchanged.
+    Returns {'questions': ..., 'mazen_texts': ..., 'mazen_srd': ...}.
+    """
+    cached = read_question_bank_snapshot(snapshot_file)
+    entries = {}
+    bank = {'questions': {}, 'mazen_texts': {}, 'mazen_srd': {}}
+    parsed, reused, dirty = 0, 0, False
+
+    for section, key, file_path, loader in question_bank_sources():
+        entry_key = f"{section}:{key}:{file_path}"
+        previous = cached.get(entry_key)
+        fingerprint = question_source_fingerprint(file_path, previous['fingerprint'] if previous else None)
+
+        if previous and fingerprint and previous['fingerprint'][0] == fingerprint[0] and previous['fingerprint'][2] == fingerprint[2]:
+            data = previous['data']
+            # Same content with a new mtime (e.g. fresh checkout); remember the new mtime
+            if previous['fingerprint'] != fingerprint:
+                dirty = True
+            reused += 1
+        else:
+            data = loader(file_path)
+            parsed += 1
+            dirty = True
+
+        # Missing files and failed loads (None) are not cached, so they are
+        # parsed again on the next start instead of being served empty
+        if fingerprint and data is not None:
+            entries[entry_key] = {'fingerprint': fingerprint, 'data': data}
+        elif previous:
+            dirty = True
+
+        if section == 'questions':
+            bank['questions'][key] = data if data is not None else []
+        elif section == 'mazen_texts':
+            bank['mazen_texts'] = data if data is not None else {}
+        elif section == 'mazen_srd' and data is not None:
+            bank['mazen_srd'][key] = data
+
+    if dirty:
+        write_question_bank_snapshot(entries, snapshot_file)
+    logging.info(f"Question bank ready: {reused} source(s) from snapshot, {parsed} parsed.")
+    return bank
+
+# ------------------- إعادة تحميل الأسئلة أثناء التشغيل (Hot reload) -------------------
+# A repeating job polls the size/mtime of every question and phrase file. When
+# one changed, load_question_bank runs in a worker thread (re-parsing only the
+# changed sources) and the results replace the bot_data entries in one step on
+# the event loop. Running quizzes keep the list they started with (see
+# get_session_questions).
+
+# bot_data key -> phrase file
+PHRASE_FILES = {
+    'correct_phrases': 'Correct_Phrases.csv',
+    'wrong_phrases': 'Wrong_Phrases.csv',
+    'thinking_phrases': 'Thinking_Phrases.csv',
+}
+QUESTION_CONTENT_KEYS = ('questions', 'mazen_texts', 'mazen_srd') + tuple(PHRASE_FILES)
+
+def question_content_files():
+    return [source[2] for source in question_bank_sources()] + list(PHRASE_FILES.values())
+
+def file_stamps(paths):
+    """Returns {path: (size, mtime_ns)} (None for missing files) - cheap change detection."""
+    stamps = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps[path] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+def load_question_content(snapshot_file=QUESTION_BANK_SNAPSHOT_FILE):
+    """Loads everything that can be hot reloaded: the question bank, Mazen data and phrases."""
+    # Stamped before loading, so a file edited mid-load is seen as changed on the next poll
+    stamps = file_stamps(question_content_files())
+    content = load_question_bank(snapshot_file)
+    for key, file_path in PHRASE_FILES.items():
+        content[key] = load_phrases(file_path)
+    content['stamps'] = stamps
+    return content
+
+def apply_question_content(bot_data, content):
+    """Replaces (never mutates) the question content in bot_data and bumps question_bank_version."""
+    for key in QUESTION_CONTENT_KEYS:
+        bot_data[key] = content[key]
+    bot_data['question_content_stamps'] = content['stamps']
+    bot_data['question_bank_version'] = bot_data.get('question_bank_version', 0) + 1
+
+question_reload_lock = asyncio.Lock()
+
+async def reload_question_content(bot_data, force=False):
+    """
+    Re-parses changed question/phrase files in a worker thread and swaps them
+    into bot_data. Returns the list of changed files ([] if nothing changed).
+    """
+    async with question_reload_lock:
+        old_stamps = bot_data.get('question_content_stamps') or {}
+        changed = [path for path, stamp in file_stamps(question_content_files()).items() if old_stamps.get(path) != stamp]
+        if not changed and not force:
+            return []
+        started = time.time()
+        content = await asyncio.to_thread(load_question_content)
+        apply_question_content(bot_data, content)
+        logging.info(f"Question content reloaded in {time.time() - started:.2f}s (version {bot_data['question_bank_version']}), changed: {changed}")
+        return changed
+
+async def question_reload_job(context: ContextTypes.DEFAULT_TYPE):
+    """Repeating job: hot reloads question and phrase files that changed on disk."""
+    if 'questions' in context.bot_data.get('startup_pending', ()):
+        return
+    try:
+        await reload_question_content(context.bot_data)
+    except Exception as e:
+        logging.error(f"Question hot reload failed: {e}")
 
 # ------------------- إدارة الرسائل التوضيحية (تنظيف عند بدء الاختبار) -------------------
 
@@ -682,9 +846,8 @@ def save_menus(menus, conn=None):
     """Save menus to database if conn provided, otherwise to JSON file."""
     if conn:
         try:
-            from datetime import datetime
             cursor = conn.cursor()
-            now = datetime.now().isoformat()
+            now = int(time.time())
             menu_data = json.dumps(menus, ensure_ascii=False, indent=2)
             
             cursor.execute('''
@@ -782,48 +945,70 @@ def load_exams(conn=None):
             logging.error(f"Failed to load exams.json: {e}")
     return default_exams()
 
+def save_exam_row(cursor, exam_id, exam_data, now):
+    """Upserts one exam into dynamic_exams (created_at is kept for existing rows)."""
+    # Convert dict fields to JSON strings
+    mcq_files_by_id = json.dumps(exam_data.get("mcq_files_by_id", {}), ensure_ascii=False)
+    mcq_file_ids_by_id = json.dumps(exam_data.get("mcq_file_ids_by_id", {}), ensure_ascii=False)
+    narrative_files_by_id = json.dumps(exam_data.get("narrative_files_by_id", {}), ensure_ascii=False)
+    narrative_file_ids_by_id = json.dumps(exam_data.get("narrative_file_ids_by_id", {}), ensure_ascii=False)
+    media_attachments = json.dumps(exam_data.get("media_attachments", {}), ensure_ascii=False)
+
+    cursor.execute('''
+        INSERT INTO dynamic_exams 
+        (exam_id, button_text, question_type, explanation_file, explanation_file_id, 
+         mcq_file, mcq_file_id, narrative_file, narrative_file_id, 
+         mcq_files_by_id, mcq_file_ids_by_id, narrative_files_by_id, narrative_file_ids_by_id, 
+         media_attachments, is_hidden, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(exam_id) DO UPDATE SET
+            button_text = excluded.button_text,
+            question_type = excluded.question_type,
+            explanation_file = excluded.explanation_file,
+            explanation_file_id = excluded.explanation_file_id,
+            mcq_file = excluded.mcq_file,
+            mcq_file_id = excluded.mcq_file_id,
+            narrative_file = excluded.narrative_file,
+            narrative_file_id = excluded.narrative_file_id,
+            mcq_files_by_id = excluded.mcq_files_by_id,
+            mcq_file_ids_by_id = excluded.mcq_file_ids_by_id,
+            narrative_files_by_id = excluded.narrative_files_by_id,
+            narrative_file_ids_by_id = excluded.narrative_file_ids_by_id,
+            media_attachments = excluded.media_attachments,
+            is_hidden = excluded.is_hidden,
+            updated_at = excluded.updated_at
+    ''', (
+        exam_id,
+        exam_data.get("button_text", ""),
+        exam_data.get("question_type", "narrative"),
+        exam_data.get("explanation_file"),
+        exam_data.get("explanation_file_id"),
+        exam_data.get("mcq_file"),
+        exam_data.get("mcq_file_id"),
+        exam_data.get("narrative_file"),
+        exam_data.get("narrative_file_id"),
+        mcq_files_by_id,
+        mcq_file_ids_by_id,
+        narrative_files_by_id,
+        narrative_file_ids_by_id,
+        media_attachments,
+        1 if exam_data.get("is_hidden", False) else 0,
+        now,
+        now
+    ))
+
 def save_exams(exams, conn=None):
-    """Save exams to database if conn provided, otherwise to JSON file."""
+    """Save exams to database if conn provided, otherwise to JSON file.
+    Prefer exam_registry.put() to write a single exam."""
     if conn:
         try:
-            from datetime import datetime
             cursor = conn.cursor()
-            now = datetime.now().isoformat()
+            now = int(time.time())
             
             for exam_id, exam_data in exams.items():
-                # Convert dict fields to JSON strings
-                mcq_files_by_id = json.dumps(exam_data.get("mcq_files_by_id", {}), ensure_ascii=False)
-                mcq_file_ids_by_id = json.dumps(exam_data.get("mcq_file_ids_by_id", {}), ensure_ascii=False)
-                narrative_files_by_id = json.dumps(exam_data.get("narrative_files_by_id", {}), ensure_ascii=False)
-                narrative_file_ids_by_id = json.dumps(exam_data.get("narrative_file_ids_by_id", {}), ensure_ascii=False)
-                media_attachments = json.dumps(exam_data.get("media_attachments", {}), ensure_ascii=False)
-                
-                cursor.execute('''
-                    INSERT OR REPLACE INTO dynamic_exams 
-                    (exam_id, button_text, question_type, explanation_file, explanation_file_id, 
-                     mcq_file, mcq_file_id, narrative_file, narrative_file_id, 
-                     mcq_files_by_id, mcq_file_ids_by_id, narrative_files_by_id, narrative_file_ids_by_id, 
-                     media_attachments, is_hidden, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    exam_id,
-                    exam_data.get("button_text", ""),
-                    exam_data.get("question_type", "narrative"),
-                    exam_data.get("explanation_file"),
-                    exam_data.get("explanation_file_id"),
-                    exam_data.get("mcq_file"),
-                    exam_data.get("mcq_file_id"),
-                    exam_data.get("narrative_file"),
-                    exam_data.get("narrative_file_id"),
-                    mcq_files_by_id,
-                    mcq_file_ids_by_id,
-                    narrative_files_by_id,
-                    narrative_file_ids_by_id,
-                    media_attachments,
-                    1 if exam_data.get("is_hidden", False) else 0,
-                    now
-                ))
+                save_exam_row(cursor, exam_id, exam_data, now)
             conn.commit()
+            invalidate_dynamic_exam_cache()
             logging.info(f"Saved {len(exams)} exams to database")
             return
         except Exception as e:
@@ -833,15 +1018,15 @@ def save_exams(exams, conn=None):
     try:
         with open(EXAMS_FILE, "w", encoding="utf-8") as f:
             json.dump(exams, f, ensure_ascii=False, indent=2)
+        invalidate_dynamic_exam_cache()
     except Exception as e:
         logging.error(f"Failed to save exams.json: {e}")
 
 def migrate_exams_to_db(conn, exams_data):
     """Migrate exams from JSON to database."""
     try:
-        from datetime import datetime
         cursor = conn.cursor()
-        now = datetime.now().isoformat()
+        now = int(time.time())
         
         for exam_id, exam_data in exams_data.items():
             # Check if exam already exists in database
@@ -882,6 +1067,91 @@ def migrate_exams_to_db(conn, exams_data):
     except Exception as e:
         logging.error(f"Failed to migrate exams to database: {e}")
 
+class ExamRegistry:
+    """
+    In-memory copy of the dynamic_exams table. Loaded once (and again on
+    reload/import); reads are served from memory and every change is written
+    through to that exam's row only.
+    """
+
+    def __init__(self):
+        self.exams = {}
+        self.versions = {}
+        self.conn = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self, conn=None):
+        """(Re)loads every exam. Returns the live exams dict (also kept in bot_data['exams'])."""
+        exams = load_exams(conn)
+        versions = {}
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT exam_id, updated_at FROM dynamic_exams")
+                versions = dict(cursor.fetchall())
+            except Exception as e:
+                logging.error(f"Failed to read exam versions: {e}")
+        with self.lock:
+            self.exams.clear()
+            self.exams.update(exams)
+            self.versions = versions
+            self.conn = conn
+            self.loaded = True
+        invalidate_dynamic_exam_cache()
+        return self.exams
+
+    def all(self, conn=None):
+        """Returns the live {exam_id: exam} dict; treat it as read-only."""
+        if not self.loaded:
+            self.load(conn or self.conn)
+        return self.exams
+
+    def get(self, exam_id, conn=None):
+        return self.all(conn).get(exam_id)
+
+    def version(self, exam_id):
+        """updated_at of the exam's row (epoch seconds), used to tag cached exam data."""
+        return self.versions.get(exam_id)
+
+    def put(self, exam_id, exam, conn=None):
+        """
+        Adds or replaces one exam and writes only its row. Memory is only
+        changed once the row is committed. Returns the stored exam.
+        """
+        conn = conn or self.conn
+        self.all(conn)
+        with self.lock:
+            # Two edits within one second still get different versions
+            previous = self.versions.get(exam_id)
+            now = int(time.time())
+            if isinstance(previous, int) and previous >= now:
+                now = previous + 1
+            if conn:
+                try:
+                    save_exam_row(conn.cursor(), exam_id, exam, now)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logging.error(f"Failed to save exam {exam_id} to database: {e}")
+                    return self.exams.get(exam_id)
+            self.exams[exam_id] = exam
+            self.versions[exam_id] = now
+            if not conn:
+                save_exams(self.exams)
+        # dynamic_exam_cache is the only parsed copy, so students get the new version
+        invalidate_dynamic_exam_cache(exam_id)
+        return exam
+
+    def update(self, exam_id, conn=None, **fields):
+        """Changes some fields of an existing exam. Returns the updated exam or None."""
+        exam = self.get(exam_id, conn)
+        if exam is None:
+            return None
+        return self.put(exam_id, {**exam, **fields}, conn)
+
+exam_registry = ExamRegistry()
+
 def get_db_conn_from_context(context):
     """Helper function to get db_conn from context if available."""
     if context and hasattr(context, 'bot_data') and 'db_conn' in context.bot_data:
@@ -914,17 +1184,242 @@ async def load_csv_from_telegram(bot, file_id, file_path=None):
         logging.error(f"Error loading CSV from Telegram (file_id: {file_id}): {e}")
         return None
 
+# ------------------- ذاكرة الاختبارات المحملة (Parsed exam cache) -------------------
+
+class LRUCache(OrderedDict):
+    """Dict that keeps at most max_entries items, dropping the least recently used."""
+
+    def __init__(self, max_entries):
+        super().__init__()
+        self.max_entries = max(1, max_entries)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_entries:
+            self.popitem(last=False)
+
+# exam_id -> {"version", "exam", "exam_data", "question_type"}, shared by all users
+dynamic_exam_cache = LRUCache(DYNAMIC_EXAM_CACHE_SIZE)
+# (exam_id, version) -> asyncio.Task of the load in progress; concurrent callers await it
+dynamic_exam_loads = {}
+# Bumped on every invalidation so a load that was already running does not cache stale data
+dynamic_exam_generation = 0
+
+def cached_dynamic_exam_data(exam_id):
+    """exam_data of the cached copy of an exam, or None if it is not cached."""
+    entry = dynamic_exam_cache.get(exam_id)
+    return entry["exam_data"] if entry else None
+
+def invalidate_dynamic_exam_cache(exam_id=None):
+    """Drops one exam (or every exam) from the parsed cache."""
+    global dynamic_exam_generation
+    dynamic_exam_generation += 1
+    if exam_id is None:
+        dynamic_exam_cache.clear()
+        dynamic_exam_loads.clear()
+    else:
+        dynamic_exam_cache.pop(exam_id, None)
+        for key in [key for key in dynamic_exam_loads if key[0] == exam_id]:
+            del dynamic_exam_loads[key]
+
+async def get_dynamic_exam_data(context, exam_id):
+    """Returns exam_data from dynamic_exam_cache, reloading it if it was evicted or invalidated."""
+    exam_data = cached_dynamic_exam_data(exam_id)
+    if exam_data is None:
+        exam, exam_data, question_type = await load_dynamic_exam(exam_id, context.bot_data.get('db_conn'), context.bot)
+        if not exam or exam_data is None:
+            return {}
+    return exam_data
+
+async def read_exam_frame(file_path, file_id, bot, label, **read_options):
+    """Reads an exam CSV from disk, falling back to Telegram (file_id) when the
+    disk copy is missing or unreadable. Returns a DataFrame or None."""
+    if file_path and os.path.exists(file_path):
+        try:
+            import pandas as pd
+            return pd.read_csv(file_path, **read_options)
+        except Exception as e:
+            logging.error(f"Error loading {label} from disk ({file_path}): {e}")
+    if file_id and bot:
+        logging.info(f"{label} not found on disk, trying to load from Telegram using file_id: {file_id}")
+        return await load_csv_from_telegram(bot, file_id, file_path)
+    if file_id:
+        logging.warning(f"{label} not found on disk, file_id available: {file_id}, but bot not provided for Telegram download")
+    return None
+
+def build_exam_unit_index(exam, exam_data):
+    """
+    Groups a loaded exam by unit id so the flow handlers never rescan it.
+    Returns {str(unit_id): {"id", "mcq", "narrative", "levels", "next", "media"}}
+    where "next" is the following unit with explanation texts and "media"
+    maps str(level) to the unit's media attachment.
+    """
+    units = {}
+
+    def unit_for(unit_id):
+        key = str(unit_id)
+        if key not in units:
+            units[key] = {"id": unit_id, "mcq": [], "narrative": [], "levels": {}, "next": None, "media": {}}
+        return units[key]
+
+    texts = exam_data.get('texts', {})
+    try:
+        text_ids = sorted(texts.keys())
+    except TypeError:
+        text_ids = sorted(texts.keys(), key=str)
+    for unit_id in text_ids:
+        unit_for(unit_id)["levels"] = texts[unit_id]
+    for unit_id, next_id in zip(text_ids, text_ids[1:]):
+        units[str(unit_id)]["next"] = next_id
+
+    for question in exam_data.get('mcq_questions', []):
+        unit_for(question.get('id', ''))["mcq"].append(question)
+    for question in exam_data.get('narrative_questions', []):
+        unit_for(question.get('id', ''))["narrative"].append(question)
+
+    # media_attachments keys look like "<unit>_<level>"
+    for media_key, media_info in (exam.get('media_attachments') or {}).items():
+        unit_id, _, level = str(media_key).rpartition('_')
+        if unit_id:
+            unit_for(unit_id)["media"][level] = media_info
+
+    # Question lists are shared by every session on this exam version
+    for unit in units.values():
+        unit["mcq"] = tuple(unit["mcq"])
+        unit["narrative"] = tuple(unit["narrative"])
+    return units
+
+def get_exam_unit(exam_data, unit_id):
+    """Returns one unit from exam_data['units'] (see build_exam_unit_index), or None."""
+    if not exam_data or unit_id is None:
+        return None
+    return exam_data.get('units', {}).get(str(unit_id))
+
+def get_exam_unit_questions(exam_data, unit_id, kind):
+    """Returns the unit's "mcq" or "narrative" questions as a shared tuple."""
+    unit = get_exam_unit(exam_data, unit_id)
+    return unit[kind] if unit else ()
+
+# ------------------- عروض الأسئلة المشتركة (Shared question views) -------------------
+# A quiz session stores the key of the question list it is answering instead of
+# a copy of it. Dynamic exam keys are (exam_id, version, unit_id), unit_id None
+# meaning the whole exam; the view is the tuple already held by exam_data, so
+# starting a quiz copies nothing and sessions on other units are unaffected.
+
+# view key -> tuple of questions; keeps a replaced exam version alive for the
+# sessions that are still answering it
+question_views = LRUCache(DYNAMIC_EXAM_CACHE_SIZE * 10)
+
+def dynamic_exam_view_key(exam_id, version, unit_id=None):
+    return (str(exam_id), version, None if unit_id is None else str(unit_id))
+
+def dynamic_exam_view(exam_data, unit_id=None):
+    """Returns the shared MCQ tuple for one unit, or for the whole exam if unit_id is None."""
+    if unit_id is None:
+        return exam_data.get('mcq_questions', ())
+    return get_exam_unit_questions(exam_data, unit_id, "mcq")
+
+def open_dynamic_exam_view(context, exam_id, exam_data, unit_id=None):
+    """Registers the view a session is about to answer and points user_data at it."""
+    key = dynamic_exam_view_key(exam_id, exam_registry.version(exam_id), unit_id)
+    view = dynamic_exam_view(exam_data, unit_id)
+    question_views[key] = view
+    context.user_data['question_view'] = key
+    return view
+
+async def get_session_questions(context, difficulty=None):
+    """
+    Returns the question list of the current session (read-only). Dynamic exams
+    resolve user_data['question_view']; the static banks come from
+    bot_data['questions'][difficulty], pinned to the question_bank_version the
+    quiz started on so a hot reload does not shift a running quiz.
+    """
+    difficulty = difficulty or context.user_data.get('difficulty')
+    if not difficulty:
+        return None
+    if not difficulty.startswith('dynamic_exam_'):
+        key = context.user_data.get('question_view')
+        if key and key[0] == 'bank' and key[1] == difficulty:
+            view = question_views.get(key)
+            if view is not None:
+                return view
+        questions = context.bot_data.get('questions', {}).get(difficulty)
+        if questions:
+            key = ('bank', difficulty, context.bot_data.get('question_bank_version', 0))
+            question_views[key] = questions
+            context.user_data['question_view'] = key
+        return questions
+
+    exam_id = difficulty[len('dynamic_exam_'):]
+    key = context.user_data.get('question_view')
+    if not key or key[0] != exam_id:
+        key = dynamic_exam_view_key(exam_id, exam_registry.version(exam_id))
+        context.user_data['question_view'] = key
+    view = question_views.get(key)
+    if view is not None:
+        return view
+
+    # Evicted, or the session was restored after a restart
+    exam_data = await get_dynamic_exam_data(context, exam_id)
+    if not exam_data:
+        return None
+    version = exam_registry.version(exam_id)
+    if version != key[1]:
+        logging.warning(f"Exam {exam_id} changed during a session (version {key[1]} -> {version}), continuing on the new version")
+        key = dynamic_exam_view_key(exam_id, version, key[2])
+        context.user_data['question_view'] = key
+    view = dynamic_exam_view(exam_data, key[2])
+    question_views[key] = view
+    return view
+
 async def load_dynamic_exam(exam_id, conn=None, bot=None):
     """Load a dynamic exam's data from CSV files.
     Tries to load from disk first, then from Telegram using file_id if available.
-    bot parameter is optional - if provided, will try to load missing files from Telegram."""
+    bot parameter is optional - if provided, will try to load missing files from Telegram.
+    Complete loads are kept in dynamic_exam_cache until the exam is saved or data is reloaded.
+    Concurrent calls for the same exam version share a single load."""
     debug_log("load_dynamic_exam", "Function called", {"exam_id": exam_id, "has_conn": conn is not None, "has_bot": bot is not None}, "G")
-    exams = load_exams(conn)
+    cached = dynamic_exam_cache.get(exam_id)
+    if cached:
+        return cached["exam"], cached["exam_data"], cached["question_type"]
+
+    exam_registry.all(conn)
+    key = (exam_id, exam_registry.version(exam_id))
+    task = dynamic_exam_loads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(read_dynamic_exam(exam_id, conn, bot))
+        dynamic_exam_loads[key] = task
+
+        def forget(done_task):
+            if dynamic_exam_loads.get(key) is done_task:
+                del dynamic_exam_loads[key]
+        task.add_done_callback(forget)
+    else:
+        debug_log("load_dynamic_exam", "Joining load in progress", {"exam_id": exam_id}, "G")
+    # shield: a waiter that is cancelled must not cancel the load the others are waiting on
+    return await asyncio.shield(task)
+
+async def read_dynamic_exam(exam_id, conn=None, bot=None):
+    """Does the actual load for load_dynamic_exam; call that instead."""
+    generation = dynamic_exam_generation
+    exams = exam_registry.all(conn)
     exam = exams.get(exam_id)
+    version = exam_registry.version(exam_id)
     if not exam:
         debug_log("load_dynamic_exam", "Exam not found in exams", {"exam_id": exam_id, "available_exams": list(exams.keys())}, "G")
         return None, None, None
-    
+
     debug_log("load_dynamic_exam", "Exam found", {
         "exam_id": exam_id,
         "button_text": exam.get("button_text"),
@@ -935,433 +1430,105 @@ async def load_dynamic_exam(exam_id, conn=None, bot=None):
         "mcq_files_by_id": exam.get("mcq_files_by_id"),
         "narrative_files_by_id": exam.get("narrative_files_by_id")
     }, "G")
-    
+
     exam_data = {
         "texts": {},
         "mcq_questions": [],
         "narrative_questions": []
     }
-    
-    # Load explanation texts (similar to textlevels.csv)
-    # Method 1: Try loading from disk
+    # Set when a configured file could not be read; such partial loads are not cached
+    incomplete = False
+
+    # Load explanation texts (similar to textlevels.csv) - disk first, then Telegram
     explanation_file = exam.get("explanation_file")
     explanation_file_id = exam.get("explanation_file_id")
-    debug_log("load_dynamic_exam", "Checking explanation file", {
-        "explanation_file": explanation_file,
-        "explanation_file_id": explanation_file_id,
-        "file_exists": os.path.exists(explanation_file) if explanation_file else False
-    }, "G")
-    
-    explanation_loaded = False
-    if explanation_file and os.path.exists(explanation_file):
-        try:
-            df = pd.read_csv(explanation_file, encoding='utf-8')
-            df.columns = [c.strip().lower() for c in df.columns]
-            for _, row in df.iterrows():
-                id_val = row.get('id', 1)
-                level = row.get('level', 1)
-                text = row.get('text', '')
-                logging.info(f"Loading text: id={id_val}, level={level}, text_length={len(text)}")
-                if id_val not in exam_data["texts"]:
-                    exam_data["texts"][id_val] = {}
-                exam_data["texts"][id_val][level] = text
-            logging.info(f"Loaded explanation texts for exam {exam_id} from disk: {exam_data['texts']}")
-            explanation_loaded = True
-        except Exception as e:
-            logging.error(f"Error loading explanation file from disk for exam {exam_id}: {e}")
-    
-    # Method 2: If file not found on disk, try loading from Telegram using file_id
-    if not explanation_loaded and explanation_file_id and bot:
-        logging.info(f"Explanation file not found on disk, trying to load from Telegram using file_id: {explanation_file_id}")
+    df = await read_exam_frame(explanation_file, explanation_file_id, bot, f"Explanation file for exam {exam_id}", encoding='utf-8')
+    if df is None and (explanation_file or explanation_file_id):
+        incomplete = True
+    elif df is not None:
         try:
-            df = await load_csv_from_telegram(bot, explanation_file_id, explanation_file)
-            if df is not None:
-                df.columns = [c.strip().lower() for c in df.columns]
-                for _, row in df.iterrows():
-                    id_val = row.get('id', 1)
-                    level = row.get('level', 1)
-                    text = row.get('text', '')
-                    logging.info(f"Loading text from Telegram: id={id_val}, level={level}, text_length={len(text)}")
-                    if id_val not in exam_data["texts"]:
-                        exam_data["texts"][id_val] = {}
-                    exam_data["texts"][id_val][level] = text
-                logging.info(f"Loaded explanation texts for exam {exam_id} from Telegram: {exam_data['texts']}")
-                explanation_loaded = True
+            frame_to_texts(df, exam_data["texts"])
+            logging.info(f"Loaded explanation texts for exam {exam_id}: {len(exam_data['texts'])} ID(s)")
         except Exception as e:
-            logging.error(f"Error loading explanation file from Telegram for exam {exam_id}: {e}")
-    elif not explanation_loaded and explanation_file_id:
-        logging.warning(f"Explanation file not found on disk for exam {exam_id}, file_id available: {explanation_file_id}, but bot not provided for Telegram download")
-    
+            logging.error(f"Error processing explanation file for exam {exam_id}: {e}")
+
     # Load questions based on type - supports both MCQ and Narrative like Mazen test
     question_type = exam.get("question_type", "narrative")  # "mcq", "narrative", or "both"
     debug_log("load_dynamic_exam", "Question type", {"question_type": question_type}, "G")
-    
+
     # Load MCQ questions if available - support both single file and files by ID
     mcq_files_by_id = exam.get("mcq_files_by_id", {})
+    mcq_file_ids_by_id = exam.get("mcq_file_ids_by_id") or {}
     debug_log("load_dynamic_exam", "MCQ files by ID", {"mcq_files_by_id": mcq_files_by_id}, "G")
-    if mcq_files_by_id:
-        # Load MCQ questions for each ID
-        mcq_file_ids_by_id = exam.get("mcq_file_ids_by_id", {})
-        for question_id, mcq_file in mcq_files_by_id.items():
-            debug_log("load_dynamic_exam", "Checking MCQ file", {
-                "question_id": question_id,
-                "mcq_file": mcq_file,
-                "file_exists": os.path.exists(mcq_file) if mcq_file else False
-            }, "G")
-            mcq_file_id = mcq_file_ids_by_id.get(question_id) if mcq_file_ids_by_id else None
-            
-            # Method 1: Try loading from disk
-            if mcq_file and os.path.exists(mcq_file):
-                try:
-                    df = pd.read_csv(mcq_file, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, usecols=range(12), keep_default_na=False)
-                    df.columns = [str(c).strip().lower() for c in df.columns]
-                    for index, row in df.iterrows():
-                        try:
-                            options = [
-                                str(row.get('option_a', '')),
-                                str(row.get('option_b', '')),
-                                str(row.get('option_c', '')),
-                                str(row.get('option_d', ''))
-                            ]
-                            correct_option_char = str(row.get('correct_answer', '')).strip().upper()
-                            # Try to extract first character if it's a full text
-                            if len(correct_option_char) > 1:
-                                # If it's a full text, try to find which option matches
-                                option_texts = [
-                                    str(row.get('option_a', '')).strip(),
-                                    str(row.get('option_b', '')).strip(),
-                                    str(row.get('option_c', '')).strip(),
-                                    str(row.get('option_d', '')).strip()
-                                ]
-                                # Try to find matching option
-                                correct_index = None
-                                for idx, opt_text in enumerate(option_texts):
-                                    if opt_text == correct_option_char or opt_text.upper() == correct_option_char:
-                                        correct_index = idx
-                                        break
-                                # If not found, try first character
-                                if correct_index is None and len(correct_option_char) > 0:
-                                    first_char = correct_option_char[0]
-                                    if first_char in ['A', 'B', 'C', 'D']:
-                                        correct_index = ['A', 'B', 'C', 'D'].index(first_char)
-                                if correct_index is None:
-                                    raise ValueError(f"Could not determine correct answer from: {correct_option_char}")
-                            else:
-                                correct_index = ['A', 'B', 'C', 'D'].index(correct_option_char)
-                            
-                            option_explanations = [
-                                str(row.get('explanation_a', '')),
-                                str(row.get('explanation_b', '')),
-                                str(row.get('explanation_c', '')),
-                                str(row.get('explanation_d', ''))
-                            ]
-                            
-                            exam_data["mcq_questions"].append({
-                                "q": str(row.get('question', '')),
-                                "options": options,
-                                "correct": correct_index,
-                                "expl": str(row.get('correct_explanation', '')),
-                                "idea_expl": str(row.get('concept_explanation', '')),
-                                "option_explanations": option_explanations,
-                                "id": question_id  # Store which ID this question belongs to
-                            })
-                        except Exception as e:
-                            logging.error(f"Error processing MCQ row {index+2} in {mcq_file}: {e}")
-                    logging.info(f"Loaded MCQ questions for ID {question_id} from {mcq_file}")
-                except Exception as e:
-                    logging.error(f"Error loading MCQ file {mcq_file} for ID {question_id}: {e}")
-            # Method 2: If file not found on disk, try loading from Telegram using file_id
-            elif mcq_file_id and bot:
-                logging.info(f"MCQ file not found on disk for ID {question_id}, trying to load from Telegram using file_id: {mcq_file_id}")
-                try:
-                    df = await load_csv_from_telegram(bot, mcq_file_id, mcq_file)
-                    if df is not None:
-                        df.columns = [str(c).strip().lower() for c in df.columns]
-                        for index, row in df.iterrows():
-                            try:
-                                options = [
-                                    str(row.get('option_a', '')),
-                                    str(row.get('option_b', '')),
-                                    str(row.get('option_c', '')),
-                                    str(row.get('option_d', ''))
-                                ]
-                                correct_option_char = str(row.get('correct_answer', '')).strip().upper()
-                                # Try to extract first character if it's a full text
-                                if len(correct_option_char) > 1:
-                                    # If it's a full text, try to find which option matches
-                                    option_texts = [
-                                        str(row.get('option_a', '')).strip(),
-                                        str(row.get('option_b', '')).strip(),
-                                        str(row.get('option_c', '')).strip(),
-                                        str(row.get('option_d', '')).strip()
-                                    ]
-                                    # Try to find matching option
-                                    correct_index = None
-                                    for idx, opt_text in enumerate(option_texts):
-                                        if opt_text == correct_option_char or opt_text.upper() == correct_option_char:
-                                            correct_index = idx
-                                            break
-                                    # If not found, try first character
-                                    if correct_index is None and len(correct_option_char) > 0:
-                                        first_char = correct_option_char[0]
-                                        if first_char in ['A', 'B', 'C', 'D']:
-                                            correct_index = ['A', 'B', 'C', 'D'].index(first_char)
-                                    if correct_index is None:
-                                        raise ValueError(f"Could not determine correct answer from: {correct_option_char}")
-                                else:
-                                    correct_index = ['A', 'B', 'C', 'D'].index(correct_option_char)
-                                
-                                option_explanations = [
-                                    str(row.get('explanation_a', '')),
-                                    str(row.get('explanation_b', '')),
-                                    str(row.get('explanation_c', '')),
-                                    str(row.get('explanation_d', ''))
-                                ]
-                                
-                                exam_data["mcq_questions"].append({
-                                    "q": str(row.get('question', '')),
-                                    "options": options,
-                                    "correct": correct_index,
-                                    "expl": str(row.get('correct_explanation', '')),
-                                    "idea_expl": str(row.get('concept_explanation', '')),
-                                    "option_explanations": option_explanations,
-                                    "id": question_id
-                                })
-                            except Exception as e:
-                                logging.error(f"Error processing MCQ row {index+2} from Telegram: {e}")
-                        logging.info(f"Loaded MCQ questions for ID {question_id} from Telegram")
-                except Exception as e:
-                    logging.error(f"Error loading MCQ file from Telegram for ID {question_id}: {e}")
-            elif mcq_file_id:
-                logging.warning(f"MCQ file not found on disk for ID {question_id}, file_id available: {mcq_file_id}, but bot not provided for Telegram download")
-    
-    mcq_file = exam.get("mcq_file")
-    mcq_file_id = exam.get("mcq_file_id")
-    debug_log("load_dynamic_exam", "Checking single MCQ file", {
-        "mcq_file": mcq_file,
-        "mcq_file_id": mcq_file_id,
-        "file_exists": os.path.exists(mcq_file) if mcq_file else False
-    }, "G")
-    # Method 1: Try loading from disk
-    if mcq_file and os.path.exists(mcq_file):
+    for question_id, mcq_file in (mcq_files_by_id or {}).items():
+        df = await read_exam_frame(mcq_file, mcq_file_ids_by_id.get(question_id), bot, f"MCQ file for ID {question_id}", **MCQ_CSV_OPTIONS)
+        if df is None:
+            incomplete = True
+            continue
         try:
-            df = pd.read_csv(mcq_file, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, usecols=range(12), keep_default_na=False)
-            df.columns = [str(c).strip().lower() for c in df.columns]
-            for index, row in df.iterrows():
-                try:
-                    options = [
-                        str(row.get('option_a', '')),
-                        str(row.get('option_b', '')),
-                        str(row.get('option_c', '')),
-                        str(row.get('option_d', ''))
-                    ]
-                    correct_option_char = str(row.get('correct_answer', '')).strip().upper()
-                    # Try to extract first character if it's a full text
-                    if len(correct_option_char) > 1:
-                        # If it's a full text, try to find which option matches
-                        option_texts = [
-                            str(row.get('option_a', '')).strip(),
-                            str(row.get('option_b', '')).strip(),
-                            str(row.get('option_c', '')).strip(),
-                            str(row.get('option_d', '')).strip()
-                        ]
-                        # Try to find matching option
-                        correct_index = None
-                        for idx, opt_text in enumerate(option_texts):
-                            if opt_text == correct_option_char or opt_text.upper() == correct_option_char:
-                                correct_index = idx
-                                break
-                        # If not found, try first character
-                        if correct_index is None and len(correct_option_char) > 0:
-                            first_char = correct_option_char[0]
-                            if first_char in ['A', 'B', 'C', 'D']:
-                                correct_index = ['A', 'B', 'C', 'D'].index(first_char)
-                        if correct_index is None:
-                            raise ValueError(f"Could not determine correct answer from: {correct_option_char}")
-                    else:
-                        correct_index = ['A', 'B', 'C', 'D'].index(correct_option_char)
-                    
-                    option_explanations = [
-                        str(row.get('explanation_a', '')),
-                        str(row.get('explanation_b', '')),
-                        str(row.get('explanation_c', '')),
-                        str(row.get('explanation_d', ''))
-                    ]
-                    
-                    exam_data["mcq_questions"].append({
-                        "q": str(row.get('question', '')),
-                        "options": options,
-                        "correct": correct_index,
-                        "expl": str(row.get('correct_explanation', '')),
-                        "idea_expl": str(row.get('concept_explanation', '')),
-                        "option_explanations": option_explanations,
-                        "id": 1  # Default ID for single file
-                    })
-                except Exception as e:
-                    logging.error(f"Error processing MCQ row {index+2} in {mcq_file}: {e}")
-            logging.info(f"Loaded {len(exam_data['mcq_questions'])} MCQ questions from disk for exam {exam_id}")
+            # Store which ID each question belongs to
+            exam_data["mcq_questions"].extend(frame_to_mcq_questions(df, mcq_file or f"MCQ file for ID {question_id}", allow_first_letter=True, extra={"id": question_id}))
+            logging.info(f"Loaded MCQ questions for ID {question_id} from {mcq_file}")
         except Exception as e:
-            logging.error(f"Error loading MCQ file from disk for exam {exam_id}: {e}")
-    # Method 2: If file not found on disk, try loading from Telegram using file_id
-    elif mcq_file_id and bot:
-        logging.info(f"MCQ file not found on disk, trying to load from Telegram using file_id: {mcq_file_id}")
+            logging.error(f"Error loading MCQ file {mcq_file} for ID {question_id}: {e}")
+
+    mcq_file = exam.get("mcq_file")
+    mcq_file_id = exam.get("mcq_file_id")
+    df = await read_exam_frame(mcq_file, mcq_file_id, bot, f"MCQ file for exam {exam_id}", **MCQ_CSV_OPTIONS)
+    if df is None and (mcq_file or mcq_file_id):
+        incomplete = True
+    elif df is not None:
         try:
-            df = await load_csv_from_telegram(bot, mcq_file_id, mcq_file)
-            if df is not None:
-                df.columns = [str(c).strip().lower() for c in df.columns]
-                for index, row in df.iterrows():
-                    try:
-                        options = [
-                            str(row.get('option_a', '')),
-                            str(row.get('option_b', '')),
-                            str(row.get('option_c', '')),
-                            str(row.get('option_d', ''))
-                        ]
-                        correct_option_char = str(row.get('correct_answer', '')).strip()
-                        correct_index = ['A', 'B', 'C', 'D'].index(correct_option_char.upper())
-                        
-                        option_explanations = [
-                            str(row.get('explanation_a', '')),
-                            str(row.get('explanation_b', '')),
-                            str(row.get('explanation_c', '')),
-                            str(row.get('explanation_d', ''))
-                        ]
-                        
-                        exam_data["mcq_questions"].append({
-                            "q": str(row.get('question', '')),
-                            "options": options,
-                            "correct": correct_index,
-                            "expl": str(row.get('correct_explanation', '')),
-                            "idea_expl": str(row.get('concept_explanation', '')),
-                            "option_explanations": option_explanations,
-                            "id": 1
-                        })
-                    except Exception as e:
-                        logging.error(f"Error processing MCQ row {index+2} from Telegram: {e}")
-                logging.info(f"Loaded {len(exam_data['mcq_questions'])} MCQ questions from Telegram for exam {exam_id}")
+            # Default ID for single file
+            exam_data["mcq_questions"].extend(frame_to_mcq_questions(df, mcq_file or f"MCQ file for exam {exam_id}", allow_first_letter=True, extra={"id": 1}))
+            logging.info(f"Loaded {len(exam_data['mcq_questions'])} MCQ questions for exam {exam_id}")
         except Exception as e:
-            logging.error(f"Error loading MCQ file from Telegram for exam {exam_id}: {e}")
-    elif mcq_file_id:
-        logging.warning(f"MCQ file not found on disk for exam {exam_id}, file_id available: {mcq_file_id}, but bot not provided for Telegram download")
-    
+            logging.error(f"Error loading MCQ file for exam {exam_id}: {e}")
+
     # Load narrative questions if available - support both single file and files by ID
     narrative_files_by_id = exam.get("narrative_files_by_id", {})
+    narrative_file_ids_by_id = exam.get("narrative_file_ids_by_id") or {}
     debug_log("load_dynamic_exam", "Narrative files by ID", {"narrative_files_by_id": narrative_files_by_id}, "G")
-    if narrative_files_by_id:
-        # Load narrative questions for each ID
-        for question_id, narrative_file in narrative_files_by_id.items():
-            debug_log("load_dynamic_exam", "Checking narrative file", {
-                "question_id": question_id,
-                "narrative_file": narrative_file,
-                "file_exists": os.path.exists(narrative_file) if narrative_file else False
-            }, "G")
-            narrative_file_ids_by_id = exam.get("narrative_file_ids_by_id", {})
-            narrative_file_id = narrative_file_ids_by_id.get(question_id) if narrative_file_ids_by_id else None
-            
-            # Method 1: Try loading from disk
-            if narrative_file and os.path.exists(narrative_file):
-                try:
-                    df = pd.read_csv(narrative_file, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, keep_default_na=False)
-                    df.columns = [str(c).strip().lower() for c in df.columns]
-                    for _, row in df.iterrows():
-                        exam_data["narrative_questions"].append({
-                            "question": row.get('question', ''),
-                            "answer": row.get('answer', ''),
-                            "id": question_id  # Store which ID this question belongs to
-                        })
-                    logging.info(f"Loaded narrative questions for ID {question_id} from disk: {narrative_file}")
-                except Exception as e:
-                    logging.error(f"Error loading narrative file from disk {narrative_file} for ID {question_id}: {e}")
-            # Method 2: If file not found on disk, try loading from Telegram using file_id
-            elif narrative_file_id and bot:
-                logging.info(f"Narrative file not found on disk for ID {question_id}, trying to load from Telegram using file_id: {narrative_file_id}")
-                try:
-                    df = await load_csv_from_telegram(bot, narrative_file_id, narrative_file)
-                    if df is not None:
-                        df.columns = [str(c).strip().lower() for c in df.columns]
-                        for _, row in df.iterrows():
-                            exam_data["narrative_questions"].append({
-                                "question": row.get('question', ''),
-                                "answer": row.get('answer', ''),
-                                "id": question_id
-                            })
-                        logging.info(f"Loaded narrative questions for ID {question_id} from Telegram")
-                except Exception as e:
-                    logging.error(f"Error loading narrative file from Telegram for ID {question_id}: {e}")
-            elif narrative_file_id:
-                logging.warning(f"Narrative file not found on disk for ID {question_id}, file_id available: {narrative_file_id}, but bot not provided for Telegram download")
-    
-    narrative_file = exam.get("narrative_file")
-    narrative_file_id = exam.get("narrative_file_id")
-    # Method 1: Try loading from disk
-    if narrative_file and os.path.exists(narrative_file):
+    for question_id, narrative_file in (narrative_files_by_id or {}).items():
+        df = await read_exam_frame(narrative_file, narrative_file_ids_by_id.get(question_id), bot, f"Narrative file for ID {question_id}", **NARRATIVE_CSV_OPTIONS)
+        if df is None:
+            incomplete = True
+            continue
         try:
-            df = pd.read_csv(narrative_file, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, keep_default_na=False)
-            df.columns = [str(c).strip().lower() for c in df.columns]
-            for _, row in df.iterrows():
-                exam_data["narrative_questions"].append({
-                    "question": row.get('question', ''),
-                    "answer": row.get('answer', ''),
-                    "id": 1  # Default ID for legacy files
-                })
-            logging.info(f"Loaded {len(exam_data['narrative_questions'])} narrative questions from disk for exam {exam_id}")
+            exam_data["narrative_questions"].extend(frame_to_narrative_questions(df, extra={"id": question_id}))
+            logging.info(f"Loaded narrative questions for ID {question_id} from {narrative_file}")
         except Exception as e:
-            logging.error(f"Error loading narrative file from disk for exam {exam_id}: {e}")
-    # Method 2: If file not found on disk, try loading from Telegram using file_id
-    elif narrative_file_id and bot:
-        logging.info(f"Narrative file not found on disk, trying to load from Telegram using file_id: {narrative_file_id}")
+            logging.error(f"Error loading narrative file {narrative_file} for ID {question_id}: {e}")
+
+    narrative_file = exam.get("narrative_file")
+    narrative_file_id = exam.get("narrative_file_id")
+    df = await read_exam_frame(narrative_file, narrative_file_id, bot, f"Narrative file for exam {exam_id}", **NARRATIVE_CSV_OPTIONS)
+    if df is None and (narrative_file or narrative_file_id):
+        incomplete = True
+    elif df is not None:
         try:
-            df = await load_csv_from_telegram(bot, narrative_file_id, narrative_file)
-            if df is not None:
-                df.columns = [str(c).strip().lower() for c in df.columns]
-                for _, row in df.iterrows():
-                    exam_data["narrative_questions"].append({
-                        "question": row.get('question', ''),
-                        "answer": row.get('answer', ''),
-                        "id": 1
-                    })
-                logging.info(f"Loaded {len(exam_data['narrative_questions'])} narrative questions from Telegram for exam {exam_id}")
+            # Default ID for legacy files
+            exam_data["narrative_questions"].extend(frame_to_narrative_questions(df, extra={"id": 1}))
+            logging.info(f"Loaded {len(exam_data['narrative_questions'])} narrative questions for exam {exam_id}")
         except Exception as e:
-            logging.error(f"Error loading narrative file from Telegram for exam {exam_id}: {e}")
-    elif narrative_file_id:
-        logging.warning(f"Narrative file not found on disk for exam {exam_id}, file_id available: {narrative_file_id}, but bot not provided for Telegram download")
-    
+            logging.error(f"Error loading narrative file for exam {exam_id}: {e}")
+
     # Legacy support: old format with single questions_file
     questions_file = exam.get("questions_file")
     if questions_file and os.path.exists(questions_file) and not mcq_file and not narrative_file:
         try:
+            import pandas as pd
             if question_type == "mcq":
-                df = pd.read_csv(questions_file, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, usecols=range(12), keep_default_na=False)
-                df.columns = [str(c).strip().lower() for c in df.columns]
-                for index, row in df.iterrows():
-                    try:
-                        options = [str(row.get('option_a', '')), str(row.get('option_b', '')), str(row.get('option_c', '')), str(row.get('option_d', ''))]
-                        correct_option_char = str(row.get('correct_answer', '')).strip()
-                        correct_index = ['A', 'B', 'C', 'D'].index(correct_option_char.upper())
-                        option_explanations = [str(row.get('explanation_a', '')), str(row.get('explanation_b', '')), str(row.get('explanation_c', '')), str(row.get('explanation_d', ''))]
-                        exam_data["mcq_questions"].append({
-                            "q": str(row.get('question', '')),
-                            "options": options,
-                            "correct": correct_index,
-                            "expl": str(row.get('correct_explanation', '')),
-                            "idea_expl": str(row.get('concept_explanation', '')),
-                            "option_explanations": option_explanations
-                        })
-                    except Exception as e:
-                        logging.error(f"Error processing MCQ row {index+2} in {questions_file}: {e}")
+                df = pd.read_csv(questions_file, **MCQ_CSV_OPTIONS)
+                exam_data["mcq_questions"].extend(frame_to_mcq_questions(df, questions_file, allow_first_letter=True))
                 logging.info(f"Loaded {len(exam_data['mcq_questions'])} MCQ questions for exam {exam_id}")
             else:
-                df = pd.read_csv(questions_file, encoding='utf-8-sig', on_bad_lines='skip', dtype=str, keep_default_na=False)
-                df.columns = [str(c).strip().lower() for c in df.columns]
-                for _, row in df.iterrows():
-                    exam_data["narrative_questions"].append({
-                        "question": row.get('question', ''),
-                        "answer": row.get('answer', '')
-                    })
+                df = pd.read_csv(questions_file, **NARRATIVE_CSV_OPTIONS)
+                exam_data["narrative_questions"].extend(frame_to_narrative_questions(df))
                 logging.info(f"Loaded {len(exam_data['narrative_questions'])} narrative questions for exam {exam_id}")
         except Exception as e:
             logging.error(f"Error loading questions file for exam {exam_id}: {e}")
-    
+
     narrative_questions_count = len(exam_data.get('narrative_questions', []))
     mcq_questions_count = len(exam_data.get('mcq_questions', []))
     texts_count = sum(len(levels) for levels in exam_data.get('texts', {}).values())
@@ -1376,11 +1543,190 @@ async def load_dynamic_exam(exam_id, conn=None, bot=None):
         "question_type": question_type
     }, "G")
     logging.info(f"load_dynamic_exam returning for {exam_id}: exam={exam is not None}, exam_data={exam_data is not None}, narrative_questions_count={narrative_questions_count}, mcq_questions_count={mcq_questions_count}")
+    exam_data["units"] = build_exam_unit_index(exam, exam_data)
+    exam_data["mcq_questions"] = tuple(exam_data["mcq_questions"])
+    exam_data["narrative_questions"] = tuple(exam_data["narrative_questions"])
+    if not incomplete and generation == dynamic_exam_generation:
+        dynamic_exam_cache[exam_id] = {"version": version, "exam": exam, "exam_data": exam_data, "question_type": question_type}
     return exam, exam_data, question_type
 
+# ------------------- تنزيل ملفات الاختبارات مسبقاً (Exam file prefetch) -------------------
+# After a redeploy the exams/ folder may be empty while the database still has
+# the Telegram file_ids. Instead of downloading each file on the first
+# student's click, a startup job fetches everything that is missing.
+
+def missing_exam_files(exams):
+    """Returns [(exam_id, label, file_path, file_id)] for exam files that are not on disk but have a file_id."""
+    missing = []
+    for exam_id, exam in exams.items():
+        files = [
+            ("explanation", exam.get("explanation_file"), exam.get("explanation_file_id")),
+            ("mcq", exam.get("mcq_file"), exam.get("mcq_file_id")),
+            ("narrative", exam.get("narrative_file"), exam.get("narrative_file_id")),
+        ]
+        mcq_file_ids_by_id = exam.get("mcq_file_ids_by_id") or {}
+        for question_id, file_path in (exam.get("mcq_files_by_id") or {}).items():
+            files.append((f"mcq id {question_id}", file_path, mcq_file_ids_by_id.get(question_id)))
+        narrative_file_ids_by_id = exam.get("narrative_file_ids_by_id") or {}
+        for question_id, file_path in (exam.get("narrative_files_by_id") or {}).items():
+            files.append((f"narrative id {question_id}", file_path, narrative_file_ids_by_id.get(question_id)))
+        for label, file_path, file_id in files:
+            if file_path and file_id and not os.path.exists(file_path):
+                missing.append((exam_id, label, file_path, file_id))
+    return missing
+
+async def download_exam_file(bot, file_id, file_path):
+    """Downloads a Telegram file to file_path through a temporary file, so readers never see a partial CSV."""
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    tmp_path = f"{file_path}.part"
+    try:
+        file = await bot.get_file(file_id)
+        await file.download_to_drive(tmp_path)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+async def prefetch_exam_files(bot, exams, concurrency=EXAM_PREFETCH_CONCURRENCY, progress=None):
+    """
+    Downloads every missing exam file concurrently (at most `concurrency` at a
+    time). progress(done, total, failed) is awaited after each file.
+    Returns (downloaded, failed) lists of (exam_id, label, file_path).
+    """
+    missing = missing_exam_files(exams)
+    downloaded, failed = [], []
+    if not missing:
+        return downloaded, failed
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fetch(exam_id, label, file_path, file_id):
+        async with semaphore:
+            try:
+                await download_exam_file(bot, file_id, file_path)
+                downloaded.append((exam_id, label, file_path))
+            except Exception as e:
+                logging.error(f"Prefetch failed for exam {exam_id} ({label}, {file_path}): {e}")
+                failed.append((exam_id, label, file_path))
+        if progress:
+            await progress(len(downloaded) + len(failed), len(missing), len(failed))
+
+    await asyncio.gather(*(fetch(*item) for item in missing))
+    return downloaded, failed
+
+async def prefetch_exam_files_job(context: ContextTypes.DEFAULT_TYPE):
+    """One-off startup job: restores missing exam files and reports progress to the admin."""
+    conn = context.bot_data.get('db_conn')
+    exams = exam_registry.all(conn)
+    total = len(missing_exam_files(exams))
+    if not total:
+        logging.info("Exam prefetch: all exam files are on disk")
+        return
+
+    started = time.time()
+    status_msg = None
+    last_edit = 0
+    if ADMIN_TELEGRAM_ID:
+        try:
+            status_msg = await context.bot.send_message(chat_id=ADMIN_TELEGRAM_ID, text=f"⏳ جاري تنزيل {total} ملف اختبار مفقود من تيليجرام...")
+        except Exception as e:
+            logging.warning(f"Could not send prefetch status to admin: {e}")
+
+    async def progress(done, total, failed):
+        nonlocal last_edit
+        # Telegram rate-limits edits, so report at most every 3 seconds
+        if not status_msg or (done < total and time.time() - last_edit < 3):
+            return
+        last_edit = time.time()
+        try:
+            await status_msg.edit_text(f"⏳ تنزيل ملفات الاختبارات: {done}/{total}" + (f" (فشل {failed})" if failed else ""))
+        except Exception as e:
+            logging.debug(f"Could not update prefetch status: {e}")
+
+    downloaded, failed = await prefetch_exam_files(context.bot, exams, progress=progress)
+    elapsed = time.time() - started
+    logging.info(f"Exam prefetch: downloaded {len(downloaded)}/{total} file(s) in {elapsed:.1f}s, {len(failed)} failed")
+
+    # Partial loads are never cached, but drop anything loaded while files were missing
+    for exam_id in {item[0] for item in downloaded}:
+        invalidate_dynamic_exam_cache(exam_id)
+
+    if status_msg:
+        text = f"✅ تم تنزيل {len(downloaded)} من {total} ملف اختبار خلال {elapsed:.1f} ثانية."
+        if failed:
+            text += "\n\n❌ تعذر تنزيل:\n" + "\n".join(f"- {exam_id}: {label}" for exam_id, label, _ in failed[:20])
+        try:
+            await status_msg.edit_text(text)
+        except Exception as e:
+            logging.warning(f"Could not send prefetch summary to admin: {e}")
+
 # ------------------- دوال قاعدة البيانات -------------------
 
-def init_db(conn):
+# إعدادات أداء SQLite - تُطبق على كل اتصال بالقاعدة (قيمة فارغة = إعداد SQLite الافتراضي)
+# WAL lets the web dashboard read while the bot writes; NORMAL only syncs at checkpoints.
+SQLITE_PROFILE = {
+    # Only takes effect on a new file (before WAL and the first table); run_db_maintenance converts older ones
+    'auto_vacuum': os.getenv("SQLITE_AUTO_VACUUM", "INCREMENTAL"),
+    'busy_timeout': os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"),
+    'journal_mode': os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    'synchronous': os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    'mmap_size': os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)),
+    'cache_size': os.getenv("SQLITE_CACHE_SIZE", "-16000"),  # negative = KiB
+    'temp_store': os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+# كل كم ثانية يُدمج ملف WAL في القاعدة (0 = يترك لـ SQLite)
+SQLITE_CHECKPOINT_INTERVAL = int(os.getenv("SQLITE_CHECKPOINT_INTERVAL", "300") or 0)
+# نافذة التأخير المسموحة لحفظ تقدم المستخدم (بالميلي ثانية، 0 = حفظ فوري مع كل نقرة)
+PROGRESS_FLUSH_INTERVAL_MS = int(os.getenv("PROGRESS_FLUSH_INTERVAL_MS", "1000") or 0)
+# كل كم ساعة تعمل صيانة قاعدة البيانات (0 = معطلة)
+DB_MAINTENANCE_HOURS = float(os.getenv("DB_MAINTENANCE_HOURS", "24") or 0)
+# محاولات الاختبارات الأقدم من هذا العدد من الأيام تُجمع في إحصائيات يومية
+EXAM_STATS_RETENTION_DAYS = int(os.getenv("EXAM_STATS_RETENTION_DAYS", "90") or 90)
+# جلسات الاختبار غير المكتملة التي لم تُستخدم منذ هذا العدد من الأيام تُمسح
+STALE_SESSION_DAYS = int(os.getenv("STALE_SESSION_DAYS", "30") or 30)
+# يُحفظ فوراً إذا تجمّع هذا العدد من المستخدمين بانتظار الحفظ
+PROGRESS_FLUSH_MAX_UPDATES = int(os.getenv("PROGRESS_FLUSH_MAX_UPDATES", "100") or 1)
+
+def configure_db(conn, profile=None):
+    """Applies the SQLite performance profile (SQLITE_PROFILE by default) to a connection."""
+    profile = SQLITE_PROFILE if profile is None else profile
+    for pragma, value in profile.items():
+        if value is None or str(value).strip() == '':
+            continue
+        try:
+            conn.execute(f"PRAGMA {pragma}={value}")
+        except sqlite3.Error as e:
+            logging.warning(f"Could not set PRAGMA {pragma}={value}: {e}")
+    return conn
+
+def checkpoint_db(conn=None, mode="PASSIVE"):
+    """
+    Copies the WAL back into the database file. Use TRUNCATE before the raw
+    file is read or sent, so it contains every committed change.
+    Returns (busy, wal_frames, checkpointed_frames) or None.
+    """
+    own_conn = conn is None
+    try:
+        if own_conn:
+            if not os.path.exists(DB_FILE):
+                return None
+            conn = sqlite3.connect(DB_FILE)
+        return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"WAL checkpoint ({mode}) failed: {e}")
+        return None
+    finally:
+        if own_conn and conn is not None:
+            conn.close()
+
+async def wal_checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    """Repeating job: keeps the WAL file from growing between SQLite's automatic checkpoints."""
+    result = await db_write(context, checkpoint_db, mode="PASSIVE")
+    if result and result[0]:
+        logging.info(f"WAL checkpoint was busy: {result[2]}/{result[1]} frames copied")
+
+def init_db(conn, profile=None):
+    configure_db(conn, profile)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_progress (
@@ -1502,35 +1848,509 @@ def init_db(conn):
         )
     ''')
     conn.commit()
+    run_migrations(conn)
+
+# ------------------- ترحيل مخطط قاعدة البيانات (Schema migrations) -------------------
+# init_db only creates the baseline tables. Every later schema change is a
+# numbered migration in SCHEMA_MIGRATIONS; schema_version records what a
+# database already has and run_migrations applies the rest in order, each one
+# in its own transaction. Never edit a released migration - append a new one.
+
+def table_columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def add_column_if_missing(conn, table, column, definition):
+    if column not in table_columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migration_001_usernames_and_indexes(conn):
+    # get_top_scores and the admin results search read username
+    for table in ("user_progress", "lab_results", "mazen_results"):
+        add_column_if_missing(conn, table, "username", "TEXT")
+    # get_leaderboard: WHERE difficulty = ? ORDER BY best_score DESC, attempts
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_best_scores_leaderboard ON best_scores(difficulty, best_score DESC, attempts)")
+    # get_exam_statistics: the primary key already starts with exam_id, so the
+    # index also carries the aggregated columns and never touches the table
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_exam_statistics_exam ON exam_statistics(exam_id, score, time_taken)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_progress_difficulty ON user_progress(difficulty)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_progress_score ON user_progress(score DESC)")
+
+def migration_002_answer_events(conn):
+    # One row per answer, never updated or deleted; user_progress.attempt tells
+    # the sessions of the same quiz apart (reset_user_progress starts a new one)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS answer_events (
+            event_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            quiz_key TEXT NOT NULL,
+            attempt INTEGER NOT NULL DEFAULT 0,
+            question_index INTEGER NOT NULL,
+            chosen_option INTEGER,
+            is_correct INTEGER NOT NULL,
+            answered_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_events_session ON answer_events(user_id, quiz_key, attempt)")
+    add_column_if_missing(conn, "user_progress", "attempt", "INTEGER DEFAULT 0")
+
+# Quiz keys (difficulty values) shown as columns of the lab_results / mazen_results views
+LAB_QUIZ_KEYS = ['video1', 'video2', 'video2_mini', 'video3', 'video4']
+MAZEN_QUIZ_KEYS = [f'mazin_id{i}' for i in range(1, 7)]
+
+def create_results_view(conn, view, columns):
+    """(Re)creates a wide compatibility view over quiz_results; columns maps column name -> quiz key."""
+    pivots = ",\n".join(
+        f"            COALESCE(MAX(CASE WHEN r.quiz_key = '{quiz_key}' THEN r.score END), 0) AS {column}"
+        for column, quiz_key in columns.items()
+    )
+    keys = ", ".join(f"'{quiz_key}'" for quiz_key in columns.values())
+    conn.execute(f"DROP VIEW IF EXISTS {view}")
+    conn.execute(f'''
+        CREATE VIEW {view} AS
+        SELECT r.user_id, p.first_name,
+{pivots},
+            p.username
+        FROM quiz_results r LEFT JOIN user_progress p ON p.user_id = r.user_id
+        WHERE r.quiz_key IN ({keys})
+        GROUP BY r.user_id
+    ''')
 
-def get_user_state(user_id, first_name, conn):
+def migration_003_quiz_results(conn):
+    # One row per (user, quiz) instead of a column per quiz: any difficulty,
+    # dynamic exams included, is stored without a schema change
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS quiz_results (
+            user_id INTEGER NOT NULL,
+            quiz_key TEXT NOT NULL,
+            score INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            updated_at TEXT,
+            PRIMARY KEY (user_id, quiz_key)
+        )
+    ''')
+    # "All users on one quiz" (the primary key already serves "all results for a user")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_results_quiz ON quiz_results(quiz_key, score DESC)")
+
+    lab_columns = {key: key for key in LAB_QUIZ_KEYS}
+    mazen_columns = {key.replace('mazin_', ''): key for key in MAZEN_QUIZ_KEYS}
+    for table, columns in (("lab_results", lab_columns), ("mazen_results", mazen_columns)):
+        # Names now come from user_progress; keep the ones only the old table knew
+        conn.execute(f'''
+            INSERT OR IGNORE INTO user_progress (user_id, first_name, username)
+            SELECT user_id, first_name, username FROM {table}
+        ''')
+        for column, quiz_key in columns.items():
+            # 0 is a real score; only NULL means the quiz was never stored
+            conn.execute(f'''
+                INSERT OR IGNORE INTO quiz_results (user_id, quiz_key, score)
+                SELECT user_id, ?, {column} FROM {table} WHERE {column} IS NOT NULL
+            ''', (quiz_key,))
+        # The view lists the users that have a quiz_results row: a user whose
+        # columns were all NULL keeps a 0 on the first quiz so the row survives
+        keys = ", ".join(f"'{quiz_key}'" for quiz_key in columns.values())
+        first_key = next(iter(columns.values()))
+        conn.execute(f'''
+            INSERT OR IGNORE INTO quiz_results (user_id, quiz_key, score)
+            SELECT user_id, ?, 0 FROM {table}
+            WHERE user_id NOT IN (SELECT user_id FROM quiz_results WHERE quiz_key IN ({keys}))
+        ''', (first_key,))
+        old_rows = conn.execute(f"SELECT COUNT(DISTINCT user_id) FROM {table}").fetchone()[0]
+        new_rows = conn.execute(f"SELECT COUNT(DISTINCT user_id) FROM quiz_results WHERE quiz_key IN ({keys})").fetchone()[0]
+        if new_rows != old_rows:
+            raise RuntimeError(f"{table}: {old_rows} users before, {new_rows} in quiz_results; not dropping it")
+        conn.execute(f"DROP TABLE {table}")
+        create_results_view(conn, table, columns)
+
+# Tables whose changes the changelog triggers record: table -> primary key columns.
+# answer_events is append-only and is exported by event_id instead. A migration
+# that adds a table must also call create_changelog_triggers for it.
+CHANGELOG_TABLES = {
+    "user_progress": ("user_id",),
+    "quiz_results": ("user_id", "quiz_key"),
+    "best_scores": ("user_id", "difficulty"),
+    "user_badges": ("user_id", "badge_id"),
+    "exam_statistics": ("exam_id", "user_id", "completion_date"),
+    "dynamic_exams": ("exam_id",),
+    "exam_file_ids": ("exam_id", "file_type", "question_id", "media_key"),
+    "menus": ("menu_id",),
+    "exam_no_explanation_buttons": ("button_id",),
+    "exam_statistics_daily": ("exam_id", "day"),
+}
+
+def create_changelog_triggers(conn, table, key_columns):
+    """AFTER INSERT/UPDATE/DELETE triggers that append the row's key (a JSON array) to changelog."""
+    for op, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        key = ", ".join(f"{row}.{column}" for column in key_columns)
+        conn.execute(f"DROP TRIGGER IF EXISTS trg_changelog_{table}_{op.lower()}")
+        conn.execute(f'''
+            CREATE TRIGGER trg_changelog_{table}_{op.lower()} AFTER {op} ON {table}
+            BEGIN
+                INSERT INTO changelog (table_name, row_key, op, changed_at)
+                VALUES ('{table}', json_array({key}), '{op[0]}', CAST(strftime('%s', 'now') AS INTEGER));
+            END
+        ''')
+
+def migration_004_changelog(conn):
+    # Feeds the incremental hourly export; rows up to the last acknowledged
+    # export are deleted by acknowledge_export, so change_id must never be reused
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS changelog (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            op TEXT NOT NULL,
+            changed_at INTEGER NOT NULL
+        )
+    ''')
+    # name -> watermark: 'changelog' / 'answer_events' (last exported ids), 'full_backup_at' (epoch)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    # The tables of this version; later tables get their triggers in their own migration
+    for table in ("user_progress", "quiz_results", "best_scores", "user_badges", "exam_statistics",
+                  "dynamic_exams", "exam_file_ids", "menus", "exam_no_explanation_buttons"):
+        create_changelog_triggers(conn, table, CHANGELOG_TABLES[table])
+
+def migration_005_retention(conn):
+    # run_db_maintenance rolls exam_statistics rows older than
+    # EXAM_STATS_RETENTION_DAYS into one row per exam and day
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS exam_statistics_daily (
+            exam_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            total_score INTEGER NOT NULL,
+            max_score INTEGER,
+            min_score INTEGER,
+            total_time INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (exam_id, day)
+        )
+    ''')
+    create_changelog_triggers(conn, "exam_statistics_daily", CHANGELOG_TABLES["exam_statistics_daily"])
+    # Epoch seconds of the last saved answer or reset; finds stale sessions
+    add_column_if_missing(conn, "user_progress", "last_active", "INTEGER")
+    conn.execute("UPDATE user_progress SET last_active = CAST(strftime('%s', 'now') AS INTEGER) WHERE last_active IS NULL")
+
+def rebuild_table(conn, table, create_sql, conversions):
+    """
+    Recreates table from create_sql (which must create "{table}_new") and
+    copies every row, converting the columns in conversions (column -> SQL
+    expression). Indexes, triggers and views on the table must be recreated.
+    """
+    conn.execute(f"DROP TABLE IF EXISTS {table}_new")
+    conn.execute(create_sql)
+    new_columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table}_new)")]
+    columns = [column for column in new_columns if column in table_columns(conn, table)]
+    select = ", ".join(conversions.get(column, column) for column in columns)
+    conn.execute(f"INSERT OR IGNORE INTO {table}_new ({', '.join(columns)}) SELECT {select} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def iso_to_epoch(column):
+    """SQL expression: a datetime.now().isoformat() value (local time) as epoch seconds."""
+    return f"CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+
+def migration_006_epoch_timestamps(conn):
+    # Timestamps were local ISO strings; they become INTEGER epoch seconds,
+    # indexed where time ranges are queried. A table can only change a column
+    # type by being rebuilt, so the views and triggers on it are rebuilt too.
+    conn.execute("DROP VIEW IF EXISTS lab_results")
+    conn.execute("DROP VIEW IF EXISTS mazen_results")
+    tables = {
+        "best_scores": ('''
+            CREATE TABLE best_scores_new (
+                user_id INTEGER,
+                difficulty TEXT,
+                best_score INTEGER DEFAULT 0,
+                total_questions INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0,
+                last_attempt_date INTEGER,
+                PRIMARY KEY (user_id, difficulty)
+            )
+        ''', ("last_attempt_date",)),
+        "user_badges": ('''
+            CREATE TABLE user_badges_new (
+                user_id INTEGER,
+                badge_id TEXT,
+                earned_date INTEGER,
+                PRIMARY KEY (user_id, badge_id)
+            )
+        ''', ("earned_date",)),
+        "exam_statistics": ('''
+            CREATE TABLE exam_statistics_new (
+                exam_id TEXT,
+                user_id INTEGER,
+                score INTEGER,
+                total_questions INTEGER,
+                completion_date INTEGER,
+                time_taken INTEGER,
+                PRIMARY KEY (exam_id, user_id, completion_date)
+            )
+        ''', ("completion_date",)),
+        "dynamic_exams": ('''
+            CREATE TABLE dynamic_exams_new (
+                exam_id TEXT PRIMARY KEY,
+                button_text TEXT NOT NULL,
+                question_type TEXT,
+                explanation_file TEXT,
+                explanation_file_id TEXT,
+                mcq_file TEXT,
+                mcq_file_id TEXT,
+                narrative_file TEXT,
+                narrative_file_id TEXT,
+                mcq_files_by_id TEXT,
+                mcq_file_ids_by_id TEXT,
+                narrative_files_by_id TEXT,
+                narrative_file_ids_by_id TEXT,
+                media_attachments TEXT,
+                is_hidden INTEGER DEFAULT 0,
+                created_at INTEGER,
+                updated_at INTEGER
+            )
+        ''', ("created_at", "updated_at")),
+        "menus": ('''
+            CREATE TABLE menus_new (
+                menu_id TEXT PRIMARY KEY,
+                menu_data TEXT NOT NULL,
+                updated_at INTEGER
+            )
+        ''', ("updated_at",)),
+        "exam_no_explanation_buttons": ('''
+            CREATE TABLE exam_no_explanation_buttons_new (
+                button_id TEXT PRIMARY KEY,
+                exam_id TEXT NOT NULL,
+                button_text TEXT NOT NULL,
+                created_at INTEGER,
+                FOREIGN KEY (exam_id) REFERENCES dynamic_exams(exam_id)
+            )
+        ''', ("created_at",)),
+        "quiz_results": ('''
+            CREATE TABLE quiz_results_new (
+                user_id INTEGER NOT NULL,
+                quiz_key TEXT NOT NULL,
+                score INTEGER NOT NULL DEFAULT 0,
+                total INTEGER,
+                updated_at INTEGER,
+                PRIMARY KEY (user_id, quiz_key)
+            )
+        ''', ("updated_at",)),
+    }
+    for table, (create_sql, timestamp_columns) in tables.items():
+        rebuild_table(conn, table, create_sql, {column: iso_to_epoch(column) for column in timestamp_columns})
+        create_changelog_triggers(conn, table, CHANGELOG_TABLES[table])
+
+    # Indexes dropped with the old tables
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_best_scores_leaderboard ON best_scores(difficulty, best_score DESC, attempts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_exam_statistics_exam ON exam_statistics(exam_id, score, time_taken)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_results_quiz ON quiz_results(quiz_key, score DESC)")
+    # Time ranges: attempts in a period, active users, retention cut-offs
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_exam_statistics_completed ON exam_statistics(completion_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_best_scores_last_attempt ON best_scores(last_attempt_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_badges_earned ON user_badges(earned_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_results_updated ON quiz_results(updated_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_progress_last_active ON user_progress(last_active)")
+
+    create_results_view(conn, "lab_results", {key: key for key in LAB_QUIZ_KEYS})
+    create_results_view(conn, "mazen_results", {key.replace('mazin_', ''): key for key in MAZEN_QUIZ_KEYS})
+
+def migration_007_changelog_index(conn):
+    # build_incremental_export reads one table's keys in a change_id range;
+    # every progress flush adds user_progress rows, so this must not be a scan
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_changelog_table ON changelog(table_name, change_id)")
+
+# (version, description, function) - applied in this order
+SCHEMA_MIGRATIONS = [
+    (1, "username columns and indexes for leaderboard/statistics queries", migration_001_usernames_and_indexes),
+    (2, "append-only answer_events table", migration_002_answer_events),
+    (3, "quiz_results table with lab_results/mazen_results views", migration_003_quiz_results),
+    (4, "changelog triggers for incremental exports", migration_004_changelog),
+    (5, "exam_statistics_daily rollups and user_progress.last_active", migration_005_retention),
+    (6, "integer epoch timestamps with time-range indexes", migration_006_epoch_timestamps),
+    (7, "changelog (table_name, change_id) index", migration_007_changelog_index),
+]
+
+def get_schema_version(conn):
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def run_migrations(conn, migrations=None):
+    """Applies every migration newer than the database's schema_version. Returns the new version."""
+    migrations = SCHEMA_MIGRATIONS if migrations is None else migrations
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
+        )
+    ''')
+    conn.commit()
+    current = get_schema_version(conn)
+    for version, description, migrate in sorted(migrations, key=lambda m: m[0]):
+        if version <= current:
+            continue
+        from datetime import datetime
+        started = time.perf_counter()
+        try:
+            # sqlite3 does not open a transaction for DDL on its own
+            conn.execute("BEGIN")
+            migrate(conn)
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (version, description, datetime.now().isoformat()))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Schema migration {version} ({description}) failed: {e}")
+            raise
+        current = version
+        logging.info(f"Applied schema migration {version} ({description}) in {time.perf_counter() - started:.2f}s")
+    return current
+
+def get_user_state(user_id, first_name, conn, username=None):
+    if progress_buffer.has(user_id):
+        flush_user_progress(conn)
     cursor = conn.cursor()
-    cursor.execute("SELECT first_name, difficulty, current_question, score, answers, question_msg_id, status_msg_id FROM user_progress WHERE user_id = ?", (user_id,))
+    cursor.execute("SELECT first_name, difficulty, current_question, score, answers, question_msg_id, status_msg_id, username, attempt FROM user_progress WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
     if row:
-        answers = json.loads(row[4])
-        state = {'first_name': row[0], 'difficulty': row[1], 'q_index': row[2], 'score': row[3], 'answers': answers, 'question_msg_id': row[5], 'status_msg_id': row[6]}
-        if state['first_name'] != first_name:
-            cursor.execute("UPDATE user_progress SET first_name = ? WHERE user_id = ?", (first_name, user_id))
+        attempt = row[8] or 0
+        answers = get_session_answers(user_id, row[1], attempt, conn)
+        if not answers and row[4]:
+            # Sessions saved before answer_events existed
+            answers = json.loads(row[4])
+        state = {'first_name': row[0], 'difficulty': row[1], 'q_index': row[2], 'score': row[3], 'answers': answers, 'question_msg_id': row[5], 'status_msg_id': row[6], 'attempt': attempt}
+        if state['first_name'] != first_name or (username and row[7] != username):
+            cursor.execute("UPDATE user_progress SET first_name = ?, username = COALESCE(?, username) WHERE user_id = ?", (first_name, username, user_id))
             conn.commit()
             state['first_name'] = first_name
     else:
-        state = {'first_name': first_name, 'difficulty': None, 'q_index': 0, 'score': 0, 'answers': {}, 'question_msg_id': None, 'status_msg_id': None}
-        cursor.execute("INSERT INTO user_progress (user_id, first_name) VALUES (?, ?)", (user_id, first_name))
+        state = {'first_name': first_name, 'difficulty': None, 'q_index': 0, 'score': 0, 'answers': {}, 'question_msg_id': None, 'status_msg_id': None, 'attempt': 0}
+        cursor.execute("INSERT INTO user_progress (user_id, first_name, username) VALUES (?, ?, ?)", (user_id, first_name, username))
         conn.commit()
     return state
 
-def save_user_state(user_id, first_name, difficulty, q_index, score, answers, conn, question_msg_id=None, status_msg_id=None):
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE user_progress 
-        SET first_name = ?, difficulty = ?, current_question = ?, score = ?, answers = ?, question_msg_id = ?, status_msg_id = ?
-        WHERE user_id = ?
-    ''', (first_name, difficulty, q_index, score, json.dumps(answers), question_msg_id, status_msg_id, user_id))
-    conn.commit()
+class ProgressWriteBuffer:
+    """
+    Write-behind buffer for user_progress and answer_events. save_user_state
+    only records the latest state per user and record_answer_and_state also
+    queues the answer event; flush() writes all of them in a single transaction. It runs every PROGRESS_FLUSH_INTERVAL_MS (progress_flush_job),
+    as soon as PROGRESS_FLUSH_MAX_UPDATES users are pending, before anything
+    reads user_progress, and on shutdown. Until main() schedules the flush
+    job the buffer is write_through (every put is committed at once).
+    """
+
+    def __init__(self, max_updates=PROGRESS_FLUSH_MAX_UPDATES):
+        self.max_updates = max(1, max_updates)
+        self.write_through = True
+        self.pending = {}  # user_id -> UPDATE parameters
+        self.events = []  # answer_events INSERT parameters, in answer order
+        self.event_users = set()
+        self.lock = threading.Lock()
+
+    def put(self, user_id, params, conn):
+        with self.lock:
+            self.pending[user_id] = params
+            full = self.write_through or len(self.pending) >= self.max_updates
+        if full:
+            self.flush(conn)
+
+    def add_answer(self, user_id, event, params, conn):
+        """Queues one answer event and the user's new position, with at most one flush."""
+        with self.lock:
+            self.events.append(event)
+            self.event_users.add(user_id)
+            self.pending[user_id] = params
+            full = self.write_through or max(len(self.pending), len(self.events)) >= self.max_updates
+        if full:
+            self.flush(conn)
+
+    def discard(self, user_id):
+        with self.lock:
+            self.pending.pop(user_id, None)
+
+    def has(self, user_id):
+        return user_id in self.pending or user_id in self.event_users
+
+    def flush(self, conn):
+        """Writes everything pending in one transaction. Returns the number of rows written."""
+        with self.lock:
+            if (not self.pending and not self.events) or conn is None:
+                return 0
+            rows = list(self.pending.values())
+            try:
+                conn.executemany('''
+                    INSERT INTO answer_events (user_id, quiz_key, attempt, question_index, chosen_option, is_correct, answered_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', self.events)
+                conn.executemany('''
+                    UPDATE user_progress 
+                    SET first_name = ?, difficulty = ?, current_question = ?, score = ?, question_msg_id = ?, status_msg_id = ?,
+                        last_active = CAST(strftime('%s', 'now') AS INTEGER)
+                    WHERE user_id = ?
+                ''', rows)
+                conn.commit()
+            except sqlite3.Error as e:
+                # Keep everything so the next flush retries it
+                conn.rollback()
+                logging.error(f"Failed to flush {len(self.events)} answer event(s) and {len(rows)} user progress update(s): {e}")
+                return 0
+            written = len(rows) + len(self.events)
+            self.pending.clear()
+            self.events.clear()
+            self.event_users.clear()
+            return written
+
+progress_buffer = ProgressWriteBuffer()
+
+def flush_user_progress(conn):
+    """Writes buffered save_user_state calls; call before reading user_progress in bulk."""
+    return progress_buffer.flush(conn)
+
+async def progress_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    """Repeating job: bounds how long an answer can stay only in memory."""
+    await db_write(context, flush_user_progress)
+
+async def flush_on_shutdown(application):
+    """post_shutdown hook: nothing buffered is lost on a clean stop."""
+    db = application.bot_data.get('db')
+    if db is not None:
+        written = await db.write(flush_user_progress)
+        db.close()
+    else:
+        written = flush_user_progress(application.bot_data.get('db_conn'))
+    logging.info(f"Flushed {written} buffered user progress update(s) on shutdown")
+
+def save_user_state(user_id, first_name, difficulty, q_index, score, conn, question_msg_id=None, status_msg_id=None):
+    """Saves the quiz position; answers are answer_events (see record_answer_and_state)."""
+    params = (first_name, difficulty, q_index, score, question_msg_id, status_msg_id, user_id)
+    progress_buffer.put(user_id, params, conn)
+
+def record_answer_and_state(user_id, first_name, quiz_key, attempt, question_index, chosen_option, is_correct,
+                            q_index, score, conn, question_msg_id=None, status_msg_id=None):
+    """
+    One answer click: appends the answer to answer_events and saves the new
+    quiz position, batched with the progress updates in a single writer-thread job.
+    """
+    event = (user_id, quiz_key, attempt or 0, question_index, chosen_option, 1 if is_correct else 0, int(time.time()))
+    params = (first_name, quiz_key, q_index, score, question_msg_id, status_msg_id, user_id)
+    progress_buffer.add_answer(user_id, event, params, conn)
+
+def get_session_answers(user_id, quiz_key, attempt, conn):
+    """Rebuilds the {str(question_index): is_correct} answers of one quiz attempt from answer_events."""
+    if not quiz_key:
+        return {}
+    rows = conn.execute(
+        "SELECT question_index, is_correct FROM answer_events WHERE user_id = ? AND quiz_key = ? AND attempt = ? ORDER BY event_id",
+        (user_id, quiz_key, attempt or 0)
+    ).fetchall()
+    return {str(question_index): bool(is_correct) for question_index, is_correct in rows}
 
 def has_incomplete_quiz(user_id, difficulty, conn):
     """Check if user has an incomplete quiz for this difficulty."""
+    if progress_buffer.has(user_id):
+        flush_user_progress(conn)
     cursor = conn.cursor()
     cursor.execute("SELECT current_question, score FROM user_progress WHERE user_id = ? AND difficulty = ?", (user_id, difficulty))
     row = cursor.fetchone()
@@ -1538,66 +2358,60 @@ def has_incomplete_quiz(user_id, difficulty, conn):
         return True, row[0], row[1]  # q_index, score
     return False, 0, 0
 
-def reset_user_progress(user_id, difficulty, conn):
+def reset_user_progress(user_id, difficulty, conn, commit=True):
+    # The reset overwrites every buffered column except first_name
+    if progress_buffer.has(user_id):
+        flush_user_progress(conn)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE user_progress 
-        SET difficulty = ?, current_question = 0, score = 0, answers = '{}', question_msg_id = NULL, status_msg_id = NULL
+        SET difficulty = ?, current_question = 0, score = 0, answers = '{}', question_msg_id = NULL, status_msg_id = NULL,
+            attempt = COALESCE(attempt, 0) + 1, last_active = CAST(strftime('%s', 'now') AS INTEGER)
         WHERE user_id = ?
     ''', (difficulty, user_id))
-    conn.commit()
-
-def update_lab_score(user_id, first_name, difficulty, score, conn):
-    cursor = conn.cursor()
-    
-    # Handle Mazen Results
-    if difficulty.startswith('mazin_id'):
-        col_name = difficulty.replace('mazin_', '') # e.g. id1
-        if col_name in ['id1', 'id2', 'id3', 'id4', 'id5', 'id6']:
-            cursor.execute("INSERT OR IGNORE INTO mazen_results (user_id, first_name) VALUES (?, ?)", (user_id, first_name))
-            cursor.execute("UPDATE mazen_results SET first_name = ? WHERE user_id = ?", (first_name, user_id))
-            query = f"UPDATE mazen_results SET {col_name} = ? WHERE user_id = ?"
-            cursor.execute(query, (score, user_id))
-            conn.commit()
-        return
+    if commit:
+        conn.commit()
 
-    cursor.execute("INSERT OR IGNORE INTO lab_results (user_id, first_name) VALUES (?, ?)", (user_id, first_name))
-    cursor.execute("UPDATE lab_results SET first_name = ? WHERE user_id = ?", (first_name, user_id))
-    
-    valid_columns = ['video1', 'video2', 'video2_mini', 'video3', 'video4']
-    if difficulty in valid_columns:
-        query = f"UPDATE lab_results SET {difficulty} = ? WHERE user_id = ?"
-        cursor.execute(query, (score, user_id))
+def update_lab_score(user_id, difficulty, score, conn, total_questions=None, commit=True):
+    """
+    Stores the latest score of any quiz in quiz_results with one upsert; the
+    lab_results / mazen_results views show the video and Mazen ones.
+    Names are kept in user_progress by get_user_state.
+    """
+    conn.execute('''
+        INSERT INTO quiz_results (user_id, quiz_key, score, total, updated_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, quiz_key) DO UPDATE SET
+            score = excluded.score,
+            total = COALESCE(excluded.total, total),
+            updated_at = excluded.updated_at
+    ''', (user_id, difficulty, score, total_questions, int(time.time())))
+    if commit:
         conn.commit()
 
-def update_best_score(user_id, difficulty, score, total_questions, conn):
-    """Update best score and track attempts."""
+def get_user_results(user_id, conn):
+    """All quiz results of a user as (quiz_key, score, total, updated_at) rows."""
     cursor = conn.cursor()
-    from datetime import datetime
-    
-    # Get current best score
+    cursor.execute("SELECT quiz_key, score, total, updated_at FROM quiz_results WHERE user_id = ? ORDER BY quiz_key", (user_id,))
+    return cursor.fetchall()
+
+def update_best_score(user_id, difficulty, score, total_questions, conn, commit=True):
+    """Update best score and track attempts. Returns (best score including this attempt, attempts)."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO best_scores (user_id, difficulty, best_score, total_questions, attempts, last_attempt_date)
+        VALUES (?, ?, ?, ?, 1, ?)
+        ON CONFLICT(user_id, difficulty) DO UPDATE SET
+            best_score = MAX(best_score, excluded.best_score),
+            total_questions = excluded.total_questions,
+            attempts = attempts + 1,
+            last_attempt_date = excluded.last_attempt_date
+    ''', (user_id, difficulty, score, total_questions, int(time.time())))
+    # Primary-key lookup inside the same transaction (no RETURNING: needs SQLite 3.35)
     cursor.execute("SELECT best_score, attempts FROM best_scores WHERE user_id = ? AND difficulty = ?", (user_id, difficulty))
-    row = cursor.fetchone()
-    
-    current_best = row[0] if row else 0
-    attempts = (row[1] if row else 0) + 1
-    
-    # Update if this is a better score
-    if score > current_best:
-        cursor.execute('''
-            INSERT OR REPLACE INTO best_scores 
-            (user_id, difficulty, best_score, total_questions, attempts, last_attempt_date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, difficulty, score, total_questions, attempts, datetime.now().isoformat()))
-    else:
-        # Still update attempts and date
-        cursor.execute('''
-            INSERT OR REPLACE INTO best_scores 
-            (user_id, difficulty, best_score, total_questions, attempts, last_attempt_date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, difficulty, current_best, total_questions, attempts, datetime.now().isoformat()))
-    conn.commit()
-    return current_best, attempts
+    best_score, attempts = cursor.fetchone()
+    if commit:
+        conn.commit()
+    return best_score, attempts
 
 def get_best_score(user_id, difficulty, conn):
     """Get best score for a user and difficulty."""
@@ -1608,29 +2422,36 @@ def get_best_score(user_id, difficulty, conn):
         return {'best_score': row[0], 'total_questions': row[1], 'attempts': row[2]}
     return None
 
-def save_exam_statistics(exam_id, user_id, score, total_questions, time_taken, conn):
+def save_exam_statistics(exam_id, user_id, score, total_questions, time_taken, conn, commit=True):
     """Save detailed exam statistics."""
     cursor = conn.cursor()
-    from datetime import datetime
     cursor.execute('''
         INSERT INTO exam_statistics (exam_id, user_id, score, total_questions, completion_date, time_taken)
         VALUES (?, ?, ?, ?, ?, ?)
-    ''', (exam_id, user_id, score, total_questions, datetime.now().isoformat(), time_taken))
-    conn.commit()
+    ''', (exam_id, user_id, score, total_questions, int(time.time()), time_taken))
+    if commit:
+        conn.commit()
 
 def get_exam_statistics(exam_id, conn):
     """Get statistics for an exam."""
     cursor = conn.cursor()
+    # Recent attempts plus the per-day rollups of older ones (run_db_maintenance)
     cursor.execute('''
         SELECT 
-            COUNT(*) as total_attempts,
-            AVG(score) as avg_score,
-            MAX(score) as max_score,
-            MIN(score) as min_score,
-            AVG(time_taken) as avg_time
-        FROM exam_statistics 
-        WHERE exam_id = ?
-    ''', (exam_id,))
+            SUM(attempts) as total_attempts,
+            SUM(total_score) * 1.0 / SUM(attempts) as avg_score,
+            MAX(max_score) as max_score,
+            MIN(min_score) as min_score,
+            SUM(total_time) * 1.0 / SUM(attempts) as avg_time
+        FROM (
+            SELECT COUNT(*) AS attempts, SUM(score) AS total_score, MAX(score) AS max_score,
+                   MIN(score) AS min_score, COALESCE(SUM(time_taken), 0) AS total_time
+            FROM exam_statistics WHERE exam_id = ?
+            UNION ALL
+            SELECT attempts, total_score, max_score, min_score, total_time
+            FROM exam_statistics_daily WHERE exam_id = ?
+        )
+    ''', (exam_id, exam_id))
     row = cursor.fetchone()
     if row and row[0]:
         return {
@@ -1656,38 +2477,269 @@ def get_leaderboard(difficulty, limit=10, conn=None):
     ''', (difficulty, limit))
     return cursor.fetchall()
 
-def award_badge(user_id, badge_id, conn):
-    """Award a badge to a user."""
-    cursor = conn.cursor()
+# ------------------- الإنجازات (Badges) -------------------
+# A badge id is "<rule>_<difficulty>". Rules are checked against the score in
+# memory; each user's earned badges are cached, so finishing a quiz costs one
+# executemany for the badges that are actually new, however many rules exist.
+
+# (rule name, test(score, total_questions, percentage))
+BADGE_RULES = [
+    ("perfect", lambda score, total, percentage: score == total),
+    ("excellent", lambda score, total, percentage: percentage >= 90),
+    ("good", lambda score, total, percentage: 80 <= percentage < 90),
+    ("completed", lambda score, total, percentage: True),
+]
+
+# user_id -> set of earned badge ids (filled from user_badges on first use)
+user_badge_sets = LRUCache(BADGE_CACHE_USERS)
+user_badge_lock = threading.Lock()
+
+def forget_user_badges(user_id=None):
+    """Drops one user's (or every user's) cached badge set, e.g. after a database import."""
+    with user_badge_lock:
+        if user_id is None:
+            user_badge_sets.clear()
+        else:
+            user_badge_sets.pop(user_id, None)
+
+def earned_badges(user_id, conn):
+    """The user's earned badge ids, read from user_badges only on a cache miss."""
+    with user_badge_lock:
+        badges = user_badge_sets.get(user_id)
+    if badges is None:
+        cursor = conn.cursor()
+        cursor.execute("SELECT badge_id FROM user_badges WHERE user_id = ?", (user_id,))
+        badges = {row[0] for row in cursor.fetchall()}
+        with user_badge_lock:
+            user_badge_sets[user_id] = badges
+    return badges
+
+def evaluate_badges(difficulty, score, total_questions):
+    """Badge ids the score qualifies for under BADGE_RULES."""
+    percentage = (score / total_questions * 100) if total_questions > 0 else 0
+    return [f"{name}_{difficulty}" for name, test in BADGE_RULES if test(score, total_questions, percentage)]
+
+def check_and_award_badges(user_id, difficulty, score, total_questions, conn, commit=True):
+    """Check if user qualifies for badges and award them. Returns the newly earned badge ids."""
+    badges = earned_badges(user_id, conn)
+    new_badges = [badge_id for badge_id in evaluate_badges(difficulty, score, total_questions) if badge_id not in badges]
+    if new_badges:
+        earned_date = int(time.time())
+        conn.executemany(
+            "INSERT OR IGNORE INTO user_badges (user_id, badge_id, earned_date) VALUES (?, ?, ?)",
+            [(user_id, badge_id, earned_date) for badge_id in new_badges]
+        )
+        with user_badge_lock:
+            badges.update(new_badges)
+    if commit:
+        conn.commit()
+    return new_badges
+
+def save_quiz_result(user_id, difficulty, score, total_questions, conn, exam_id=None, time_taken=0):
+    """
+    All end-of-quiz writes of a finished quiz in one transaction: lab score,
+    best score, badges, exam statistics and the progress reset.
+    Returns (best_score, attempts, new_badges, quiz_badges); quiz_badges are
+    all of the user's badges for this difficulty.
+    """
+    # Buffered answers of this quiz are committed first, on their own
+    if progress_buffer.has(user_id):
+        flush_user_progress(conn)
+    try:
+        update_lab_score(user_id, difficulty, score, conn, total_questions=total_questions, commit=False)
+        best_score, attempts = update_best_score(user_id, difficulty, score, total_questions, conn, commit=False)
+        new_badges = check_and_award_badges(user_id, difficulty, score, total_questions, conn, commit=False)
+        if exam_id:
+            save_exam_statistics(exam_id, user_id, score, total_questions, time_taken, conn, commit=False)
+        reset_user_progress(user_id, None, conn, commit=False)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # The cached set may already hold badges that were rolled back
+        forget_user_badges(user_id)
+        raise
+    quiz_badges = new_badges + sorted(b for b in earned_badges(user_id, conn) if difficulty in b and b not in new_badges)
+    return best_score, attempts, new_badges, quiz_badges
+
+# ------------------- صيانة قاعدة البيانات (Retention & compaction) -------------------
+# Keeps the file small: old exam attempts become per-day rollups, abandoned
+# sessions and their old answer events are dropped, and the freed pages are
+# returned to the filesystem with incremental vacuum. Runs on the writer thread.
+
+def db_files_size(conn):
+    """Bytes used by the database file and its WAL."""
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    return sum(os.path.getsize(p) for p in (path, f"{path}-wal") if os.path.exists(p))
+
+def enable_incremental_vacuum(conn):
+    """
+    Switches an older database to auto_vacuum=INCREMENTAL. That needs a VACUUM
+    outside WAL mode, so it is done on a copy that is then written back with
+    the backup API (like a database import).
+    """
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    compact_path = f"{path}.compact"
+    if os.path.exists(compact_path):
+        os.remove(compact_path)
+    try:
+        conn.execute("VACUUM INTO ?", (compact_path,))
+        compact = sqlite3.connect(compact_path)
+        try:
+            compact.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            compact.execute("VACUUM")
+            compact.backup(conn)
+        finally:
+            compact.close()
+    finally:
+        if os.path.exists(compact_path):
+            os.remove(compact_path)
+
+def run_db_maintenance(conn, now=None):
+    """Retention + compaction. Returns a report dict (sizes in MB and row counts)."""
     from datetime import datetime
-    cursor.execute('''
-        INSERT OR IGNORE INTO user_badges (user_id, badge_id, earned_date)
-        VALUES (?, ?, ?)
-    ''', (user_id, badge_id, datetime.now().isoformat()))
-    conn.commit()
+    now = time.time() if now is None else now
+    flush_user_progress(conn)
+    size_before = db_files_size(conn)
+    stats_cutoff = int(now - EXAM_STATS_RETENTION_DAYS * 86400)
+    session_cutoff = int(now - STALE_SESSION_DAYS * 86400)
+    event_cutoff = int(now - EXAM_STATS_RETENTION_DAYS * 86400)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO exam_statistics_daily (exam_id, day, attempts, total_score, max_score, min_score, total_time)
+            SELECT exam_id, date(completion_date, 'unixepoch', 'localtime'), COUNT(*), SUM(score), MAX(score), MIN(score), COALESCE(SUM(time_taken), 0)
+            FROM exam_statistics WHERE completion_date < ?
+            GROUP BY exam_id, date(completion_date, 'unixepoch', 'localtime')
+            ON CONFLICT(exam_id, day) DO UPDATE SET
+                attempts = attempts + excluded.attempts,
+                total_score = total_score + excluded.total_score,
+                max_score = MAX(max_score, excluded.max_score),
+                min_score = MIN(min_score, excluded.min_score),
+                total_time = total_time + excluded.total_time
+        ''', (stats_cutoff,))
+        rolled_up = cursor.execute("DELETE FROM exam_statistics WHERE completion_date < ?", (stats_cutoff,)).rowcount
+
+        # Abandoned quizzes: the student keeps their row, the session is cleared
+        sessions = cursor.execute('''
+            UPDATE user_progress
+            SET difficulty = NULL, current_question = 0, score = 0, answers = '{}', question_msg_id = NULL, status_msg_id = NULL
+            WHERE difficulty IS NOT NULL AND last_active < ?
+        ''', (session_cutoff,)).rowcount
+        # Old answers outside a session in progress; the newest event always
+        # stays so event_id is never reused (incremental exports rely on it)
+        events = cursor.execute('''
+            DELETE FROM answer_events
+            WHERE answered_at < ?
+              AND event_id < (SELECT MAX(event_id) FROM answer_events)
+              AND NOT EXISTS (
+                  SELECT 1 FROM user_progress p
+                  WHERE p.user_id = answer_events.user_id AND p.difficulty = answer_events.quiz_key AND p.attempt = answer_events.attempt
+              )
+        ''', (event_cutoff,)).rowcount
+
+        # Changes nobody collected (no hourly export); the next export must then be a full copy
+        acked = get_export_state(conn).get('changelog', 0)
+        if cursor.execute("SELECT 1 FROM changelog WHERE changed_at < ? AND change_id > ? LIMIT 1", (event_cutoff, acked)).fetchone():
+            cursor.execute("DELETE FROM export_state WHERE name = 'full_backup_at'")
+        cursor.execute("DELETE FROM changelog WHERE changed_at < ?", (event_cutoff,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
-def get_user_badges(user_id, conn):
-    """Get all badges for a user."""
-    cursor = conn.cursor()
-    cursor.execute("SELECT badge_id, earned_date FROM user_badges WHERE user_id = ?", (user_id,))
-    return cursor.fetchall()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        enable_incremental_vacuum(conn)
+    else:
+        # Each result row is one freed page; the pragma only runs while it is stepped
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+        conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+
+    report = {
+        'at': datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M"),
+        'before_mb': size_before / (1024 * 1024),
+        'after_mb': db_files_size(conn) / (1024 * 1024),
+        'rolled_up': rolled_up,
+        'sessions': sessions,
+        'events': events,
+    }
+    logging.info(
+        f"Database maintenance: {report['before_mb']:.2f} MB -> {report['after_mb']:.2f} MB, "
+        f"{rolled_up} attempt(s) rolled up, {sessions} stale session(s), {events} answer event(s) removed"
+    )
+    return report
 
-def check_and_award_badges(user_id, difficulty, score, total_questions, conn):
-    """Check if user qualifies for badges and award them."""
-    percentage = (score / total_questions * 100) if total_questions > 0 else 0
-    
-    # Perfect score badge
-    if score == total_questions:
-        award_badge(user_id, f"perfect_{difficulty}", conn)
-    
-    # High score badges
-    if percentage >= 90:
-        award_badge(user_id, f"excellent_{difficulty}", conn)
-    elif percentage >= 80:
-        award_badge(user_id, f"good_{difficulty}", conn)
-    
-    # Completion badges
-    award_badge(user_id, f"completed_{difficulty}", conn)
+async def db_maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """Repeating job: run_db_maintenance; the report is shown in the admin stats panel."""
+    try:
+        context.bot_data['db_maintenance'] = await db_write(context, run_db_maintenance)
+    except Exception as e:
+        logging.error(f"Database maintenance failed: {e}")
+
+# ------------------- طبقة قاعدة البيانات غير المتزامنة (Async DB layer) -------------------
+# Handlers never run the DB helpers on the event loop. Writes, and the
+# progress reads that must see them in order, run on one writer thread;
+# plain reads run on a small pool. Every thread has its own connection (WAL
+# lets the readers run alongside the writer). The helpers receive it as conn=.
+
+# عدد الخيوط المخصصة للقراءة من قاعدة البيانات
+DB_READER_THREADS = int(os.getenv("DB_READER_THREADS", "2") or 1)
+
+class AsyncDB:
+    """Awaitable front for the synchronous DB helpers (see db_write / db_read)."""
+
+    def __init__(self, db_file=DB_FILE, readers=DB_READER_THREADS):
+        from concurrent.futures import ThreadPoolExecutor
+        self.db_file = db_file
+        self.local = threading.local()
+        self.conns = []
+        self.lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.readers = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="db-reader")
+
+    def thread_conn(self):
+        """The calling thread's connection (imports rewrite the file in place, so it stays valid)."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = configure_db(sqlite3.connect(self.db_file, check_same_thread=False))
+            self.local.conn = conn
+            with self.lock:
+                self.conns.append(conn)
+        return conn
+
+    def call(self, func, args, kwargs):
+        return func(*args, conn=self.thread_conn(), **kwargs)
+
+    async def write(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self.call, func, args, kwargs)
+
+    async def read(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self.call, func, args, kwargs)
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        with self.lock:
+            for conn in self.conns:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self.conns.clear()
+
+async def db_write(context, func, *args, **kwargs):
+    """Runs a DB helper on the writer thread. Falls back to bot_data['db_conn'] if there is no AsyncDB."""
+    db = context.bot_data.get('db')
+    if db is None:
+        return func(*args, conn=context.bot_data['db_conn'], **kwargs)
+    return await db.write(func, *args, **kwargs)
+
+async def db_read(context, func, *args, **kwargs):
+    """Runs a read-only DB helper on the reader pool."""
+    db = context.bot_data.get('db')
+    if db is None:
+        return func(*args, conn=context.bot_data['db_conn'], **kwargs)
+    return await db.read(func, *args, **kwargs)
 
 # ------------------- صلاحيات الأدمن -------------------
 
@@ -1709,8 +2761,10 @@ def get_user_counts(conn):
             return 0
 
     total_users = safe_count("SELECT COUNT(DISTINCT user_id) FROM user_progress")
-    lab_users = safe_count("SELECT COUNT(DISTINCT user_id) FROM lab_results")
-    mazen_users = safe_count("SELECT COUNT(DISTINCT user_id) FROM mazen_results")
+    lab_keys = ", ".join(f"'{key}'" for key in LAB_QUIZ_KEYS)
+    mazen_keys = ", ".join(f"'{key}'" for key in MAZEN_QUIZ_KEYS)
+    lab_users = safe_count(f"SELECT COUNT(DISTINCT user_id) FROM quiz_results WHERE quiz_key IN ({lab_keys})")
+    mazen_users = safe_count(f"SELECT COUNT(DISTINCT user_id) FROM quiz_results WHERE quiz_key IN ({mazen_keys})")
     return {
         "total_users": total_users,
         "lab_users": lab_users,
@@ -2026,7 +3080,7 @@ async def handle_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not is_admin_user(user.id):
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
-    counts = get_user_counts(context.bot_data['db_conn'])
+    counts = await db_read(context, get_user_counts)
     size_mb, last_update = get_db_meta()
     text = (
         "📊 إحصائيات سريعة\n"
@@ -2036,6 +3090,12 @@ async def handle_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"- حجم قاعدة البيانات: {size_mb:.2f} MB\n"
         f"- آخر تحديث للملف: {escape_markdown(str(last_update), version=2)}"
     )
+    maintenance = context.bot_data.get('db_maintenance')
+    if maintenance:
+        text += (
+            f"\n- آخر صيانة ({maintenance['at']}): {maintenance['before_mb']:.2f} MB → {maintenance['after_mb']:.2f} MB"
+            f" (محاولات مجمّعة: {maintenance['rolled_up']}، جلسات منتهية: {maintenance['sessions']}، إجابات محذوفة: {maintenance['events']})"
+        )
     await update.callback_query.edit_message_text(text, reply_markup=build_admin_keyboard())
 
 async def handle_admin_results_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2043,9 +3103,10 @@ async def handle_admin_results_view(update: Update, context: ContextTypes.DEFAUL
     if not is_admin_user(user.id):
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
-    conn = context.bot_data['db_conn']
-    counts = get_user_counts(conn)
-    top = get_top_scores(conn, limit=5)
+    # Buffered answers are part of the scores
+    await db_write(context, flush_user_progress)
+    counts = await db_read(context, get_user_counts)
+    top = await db_read(context, get_top_scores, limit=5)
     top_lines_parts = []
     for i, (uid, name, username, score, diff) in enumerate(top):
         name_link = _user_link_html(uid, name, username)
@@ -2118,7 +3179,8 @@ async def render_admin_results_page(update: Update, context: ContextTypes.DEFAUL
         await update.callback_query.answer("لا توجد جلسة تصفح نشطة.", show_alert=True)
         return
     page_size = context.user_data.get('admin_results', {}).get('page_size', 10) or 10
-    rows, cols, total = fetch_paginated_rows(context.bot_data['db_conn'], table, page=page, page_size=page_size)
+    await db_write(context, flush_user_progress)
+    rows, cols, total = await db_read(context, fetch_paginated_rows, table=table, page=page, page_size=page_size)
     text = f"📚 {escape_markdown(table, version=2)}\n" + format_rows_as_md(table, rows, cols, page, page_size, total)
     kb = []
     nav_row = []
@@ -2188,6 +3250,227 @@ async def handle_admin_edit_main(update: Update, context: ContextTypes.DEFAULT_T
         f"تحرير القائمة الرئيسية:\n{overview}",
         reply_markup=kb
     )
+# ------------------- النسخ الاحتياطي لقاعدة البيانات (Online backup) -------------------
+# Exports never send the live file: a snapshot is taken with the SQLite backup
+# API on a reader thread (WAL readers do not block the answer writes), then
+# gzip-compressed into a temp folder and uploaded from there.
+
+# عدد الصفحات التي تُنسخ في كل خطوة من النسخة الاحتياطية
+DB_BACKUP_PAGES = int(os.getenv("DB_BACKUP_PAGES", "1024") or 1024)
+# Telegram doc limit ~50MB
+DB_SEND_MAX_MB = 45
+# كل كم ساعة تُرسل نسخة كاملة من قاعدة البيانات (بينها تُرسل التغييرات فقط)
+DB_FULL_BACKUP_HOURS = float(os.getenv("DB_FULL_BACKUP_HOURS", "24") or 24)
+
+def snapshot_db(dest_path, conn):
+    """Writes a consistent copy of the database to dest_path, DB_BACKUP_PAGES pages per step."""
+    target = sqlite3.connect(dest_path)
+    try:
+        conn.backup(target, pages=DB_BACKUP_PAGES, sleep=0.005)
+        # A standalone file: no -wal next to it when it is opened or imported
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+
+def compress_db_snapshot(snapshot_path):
+    """gzips the snapshot next to itself. Returns (gz_path, sha256 of the snapshot)."""
+    import hashlib
+    digest = hashlib.sha256()
+    gz_path = snapshot_path + ".gz"
+    with open(snapshot_path, "rb") as src, gzip.open(gz_path, "wb", compresslevel=6) as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            digest.update(chunk)
+            dst.write(chunk)
+    return gz_path, digest.hexdigest()
+
+async def create_db_backup(context):
+    """
+    Snapshot + gzip of the database in a new temp folder.
+    Returns (gz_path, sha256); remove os.path.dirname(gz_path) when done.
+    """
+    # Buffered answers belong in the snapshot
+    await db_write(context, flush_user_progress)
+    folder = tempfile.mkdtemp(prefix="db_backup_")
+    snapshot_path = os.path.join(folder, os.path.basename(DB_FILE))
+    try:
+        await db_read(context, snapshot_db, snapshot_path)
+        gz_path, digest = await asyncio.to_thread(compress_db_snapshot, snapshot_path)
+        os.remove(snapshot_path)
+        return gz_path, digest
+    except Exception:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+
+async def send_db_backup(context, chat_id, caption, skip_if_unchanged=False):
+    """
+    Uploads a gzipped snapshot to chat_id. With skip_if_unchanged nothing is
+    sent when the content hash matches the last successful send.
+    Returns "sent", "unchanged" or "too_large".
+    """
+    gz_path, digest = await create_db_backup(context)
+    try:
+        if skip_if_unchanged and digest == context.bot_data.get('db_backup_sent_hash'):
+            return "unchanged"
+        if os.path.getsize(gz_path) / (1024 * 1024) > DB_SEND_MAX_MB:
+            return "too_large"
+        with open(gz_path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=f,
+                filename=os.path.basename(gz_path),
+                caption=caption
+            )
+        context.bot_data['db_backup_sent_hash'] = digest
+        return "sent"
+    finally:
+        shutil.rmtree(os.path.dirname(gz_path), ignore_errors=True)
+
+# ---- Incremental exports (change data capture) ----
+# Between full copies the hourly job only ships the rows whose keys the
+# changelog triggers recorded (their current values, or a delete) and the new
+# answer_events, as a gzipped JSON file. apply_incremental_export replays one
+# on top of the previous full copy; files must be applied in order. An admin
+# restores by importing the full copy, then each changes_*.json.gz after it.
+
+def get_export_state(conn):
+    return dict(conn.execute("SELECT name, value FROM export_state").fetchall())
+
+def export_watermark(conn):
+    """(last change_id, last event_id) right now: what a full copy taken next contains."""
+    # sqlite_sequence keeps the last change_id even after the changelog was emptied
+    change_id = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'changelog'").fetchone()[0]
+    event_id = conn.execute("SELECT COALESCE(MAX(event_id), 0) FROM answer_events").fetchone()[0]
+    return change_id, event_id
+
+def build_incremental_export(path, conn):
+    """
+    Writes the changes since the last acknowledged export to path.
+    Returns (change_id, event_id, rows) to pass to acknowledge_export, or None if nothing changed.
+    """
+    from datetime import datetime
+    # One read transaction, so the rows match the watermark
+    conn.execute("BEGIN")
+    try:
+        state = get_export_state(conn)
+        since_change, since_event = state.get('changelog', 0), state.get('answer_events', 0)
+        change_id, event_id = export_watermark(conn)
+        if change_id <= since_change and event_id <= since_event:
+            return None
+
+        tables = {}
+        rows_total = 0
+        cursor = conn.cursor()
+        for table, key_columns in CHANGELOG_TABLES.items():
+            keys = [json.loads(row[0]) for row in cursor.execute(
+                "SELECT DISTINCT row_key FROM changelog WHERE table_name = ? AND change_id > ? AND change_id <= ?",
+                (table, since_change, change_id)
+            ).fetchall()]
+            if not keys:
+                continue
+            where = " AND ".join(f"{column} = ?" for column in key_columns)
+            columns, rows, deleted = None, [], []
+            for key in keys:
+                row = cursor.execute(f"SELECT * FROM {table} WHERE {where}", key).fetchone()
+                columns = columns or [d[0] for d in cursor.description]
+                if row is None:
+                    deleted.append(key)
+                else:
+                    rows.append(list(row))
+            tables[table] = {"columns": columns, "rows": rows, "deleted": deleted}
+            rows_total += len(rows) + len(deleted)
+
+        events = cursor.execute("SELECT * FROM answer_events WHERE event_id > ? AND event_id <= ?", (since_event, event_id)).fetchall()
+        if events:
+            tables["answer_events"] = {"columns": [d[0] for d in cursor.description], "rows": [list(row) for row in events], "deleted": []}
+            rows_total += len(events)
+    finally:
+        conn.rollback()
+
+    export = {
+        "format": "incremental",
+        "created_at": datetime.now().isoformat(),
+        "from": {"change_id": since_change, "event_id": since_event},
+        "to": {"change_id": change_id, "event_id": event_id},
+        "tables": tables,
+    }
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(export, f, ensure_ascii=False, separators=(",", ":"))
+    return change_id, event_id, rows_total
+
+def acknowledge_export(change_id, event_id, conn, full=False):
+    """Moves the export watermarks after a successful send and drops the changelog rows it covered."""
+    values = [("changelog", change_id), ("answer_events", event_id)]
+    if full:
+        values.append(("full_backup_at", int(time.time())))
+    try:
+        conn.executemany(
+            "INSERT INTO export_state (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            values
+        )
+        conn.execute("DELETE FROM changelog WHERE change_id <= ?", (change_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def apply_incremental_export(path, conn):
+    """
+    Writer thread: replays an incremental export on the database it was made
+    against (after its full copy was imported). Raises ValueError for a file
+    that is not an export or was already applied. Returns the number of rows applied.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        export = json.load(f)
+    if export.get("format") != "incremental":
+        raise ValueError("not an incremental export")
+    flush_user_progress(conn)
+    state = get_export_state(conn)
+    to = export["to"]
+    if to["change_id"] <= state.get('restored_changelog', 0) and to["event_id"] <= state.get('restored_answer_events', 0):
+        raise ValueError("this export was already applied")
+    applied = 0
+    try:
+        for table, change in export["tables"].items():
+            key_columns = CHANGELOG_TABLES.get(table, ("event_id",))
+            columns = change["columns"]
+            if change["rows"]:
+                placeholders = ", ".join("?" for _ in columns)
+                conn.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", change["rows"])
+            if change["deleted"]:
+                where = " AND ".join(f"{column} = ?" for column in key_columns)
+                conn.executemany(f"DELETE FROM {table} WHERE {where}", change["deleted"])
+            applied += len(change["rows"]) + len(change["deleted"])
+        conn.executemany(
+            "INSERT INTO export_state (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            [("restored_changelog", to["change_id"]), ("restored_answer_events", to["event_id"])]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+async def send_incremental_export(context, chat_id, caption):
+    """Uploads the changes since the last acknowledged export. Returns "sent", "unchanged" or "too_large"."""
+    await db_write(context, flush_user_progress)
+    folder = tempfile.mkdtemp(prefix="db_changes_")
+    try:
+        path = os.path.join(folder, "changes.json.gz")
+        result = await db_read(context, build_incremental_export, path)
+        if result is None:
+            return "unchanged"
+        change_id, event_id, rows = result
+        if os.path.getsize(path) / (1024 * 1024) > DB_SEND_MAX_MB:
+            return "too_large"
+        from datetime import datetime
+        filename = f"changes_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{change_id}_{event_id}.json.gz"
+        with open(path, "rb") as f:
+            await context.bot.send_document(chat_id=chat_id, document=f, filename=filename, caption=f"{caption}\n\n🔁 التغييرات فقط: {rows} صف")
+        await db_write(context, acknowledge_export, change_id, event_id)
+        return "sent"
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
 async def handle_admin_export_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not is_admin_user(user.id):
@@ -2197,27 +3480,72 @@ async def handle_admin_export_db(update: Update, context: ContextTypes.DEFAULT_T
         await update.callback_query.edit_message_text("⚠️ قاعدة البيانات غير موجودة.", reply_markup=build_admin_keyboard())
         return
     try:
-        size_mb = os.path.getsize(DB_FILE) / (1024 * 1024)
-        if size_mb > 45:  # Telegram doc limit ~50MB
-            await update.callback_query.edit_message_text("⚠️ حجم الملف كبير جداً للإرسال.", reply_markup=build_admin_keyboard())
-            return
-    except Exception as e:
-        logging.error(f"Failed to stat DB file: {e}")
-        await update.callback_query.edit_message_text("حدث خطأ أثناء قراءة الملف.", reply_markup=build_admin_keyboard())
-        return
-    try:
-        await context.bot.send_document(
-            chat_id=user.id,
-            document=open(DB_FILE, "rb"),
-            filename=os.path.basename(DB_FILE),
-            caption="📥 نسخة من قاعدة البيانات"
-        )
+        result = await send_db_backup(context, user.id, "📥 نسخة من قاعدة البيانات (مضغوطة gzip)")
     except Exception as e:
         logging.error(f"Failed to send DB: {e}")
         await update.callback_query.edit_message_text("حدث خطأ أثناء إرسال الملف.", reply_markup=build_admin_keyboard())
         return
+    if result == "too_large":
+        await update.callback_query.edit_message_text("⚠️ حجم الملف كبير جداً للإرسال.", reply_markup=build_admin_keyboard())
+        return
     await update.callback_query.answer("✅ تم إرسال الملف في الخاص.", show_alert=True)
 
+# ------------------- استيراد قاعدة البيانات (Database import) -------------------
+# An upload is downloaded next to DB_FILE, checked and migrated there, then
+# copied into the live database with the backup API on the writer thread. No
+# write runs meanwhile, the file is never replaced under an open connection,
+# and every connection sees either the old or the new content.
+
+# الجداول والأعمدة التي يجب أن تحتويها قاعدة البيانات المرفوعة
+IMPORT_REQUIRED_COLUMNS = {
+    "user_progress": {"user_id", "first_name", "difficulty", "current_question", "score"},
+}
+
+def prepare_import_db(path, page_size):
+    """
+    integrity_check and schema check of an uploaded database, then migrates it
+    and matches the live page size (the backup API needs it for a WAL target).
+    Raises ValueError or sqlite3.Error when the file cannot be imported.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+        if problems != ["ok"]:
+            raise ValueError("integrity_check: " + "; ".join(str(p) for p in problems[:5]))
+        for table, columns in IMPORT_REQUIRED_COLUMNS.items():
+            missing = columns - table_columns(conn, table)
+            if missing:
+                raise ValueError(f"{table}: missing {', '.join(sorted(missing))}")
+        # Older exports may miss tables or migrations
+        init_db(conn, profile={'journal_mode': 'DELETE', 'synchronous': 'OFF'})
+        if conn.execute("PRAGMA page_size").fetchone()[0] != page_size:
+            conn.execute(f"PRAGMA page_size={page_size}")
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+def swap_in_database(import_path, backup_path, conn):
+    """Writer thread: saves the live database to backup_path, then copies import_path over it."""
+    flush_user_progress(conn)
+    snapshot_db(backup_path, conn)
+    source = sqlite3.connect(import_path)
+    try:
+        # One step: a single write transaction on the live file
+        source.backup(conn)
+    finally:
+        source.close()
+    # The next hourly copy has to be a full one
+    conn.execute("DELETE FROM export_state WHERE name = 'full_backup_at'")
+    conn.commit()
+
+def reload_db_caches(bot_data, conn):
+    """Rebuilds everything kept in memory from the database, after an import."""
+    forget_user_badges()
+    bot_data.pop('db_backup_sent_hash', None)
+    bot_data['exams'] = exam_registry.load(conn)
+    bot_data['menus'] = load_menus(conn)
+    invalidate_dynamic_exam_cache()
+
 async def handle_admin_import_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Prompt admin to upload database file."""
     user = update.effective_user
@@ -2231,6 +3559,7 @@ async def handle_admin_import_db(update: Update, context: ContextTypes.DEFAULT_T
         "📤 رفع قاعدة البيانات\n\n"
         "⚠️ تحذير: سيتم استبدال قاعدة البيانات الحالية بالملف المرفوع!\n\n"
         "أرسل ملف قاعدة البيانات (user_progress.db):\n"
+        "أو ملف تغييرات (changes_*.json.gz) لتطبيقه على القاعدة الحالية.\n"
         "أو اضغط 'إلغاء' للرجوع.",
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("❌ إلغاء", callback_data="admin_menu")]
@@ -2252,40 +3581,38 @@ async def handle_admin_import_db_file(update: Update, context: ContextTypes.DEFA
     
     # Check if it's a database file
     file_name = update.message.document.file_name or ""
-    if not file_name.endswith('.db'):
-        await update.message.reply_text("❌ الملف يجب أن يكون ملف قاعدة بيانات (.db)")
+    if file_name.endswith('.json.gz'):
+        await handle_admin_import_changes_file(update, context)
+        return
+    if not file_name.endswith(('.db', '.db.gz')):
+        await update.message.reply_text("❌ الملف يجب أن يكون ملف قاعدة بيانات (.db أو نسخة التصدير .db.gz) أو ملف تغييرات (.json.gz)")
         return
     
+    backup_file = f"{DB_FILE}.backup"
+    import_file = f"{DB_FILE}.import"
+    gz_file = f"{import_file}.gz"
     try:
-        # Download the file
+        # Download the file next to the live database, never over it
         file = await context.bot.get_file(update.message.document.file_id)
-        backup_file = f"{DB_FILE}.backup"
-        
-        # Create backup of current database
-        if os.path.exists(DB_FILE):
-            import shutil
-            shutil.copy2(DB_FILE, backup_file)
-            logging.info(f"Created backup of current database: {backup_file}")
-        
-        # Download new database
-        await file.download_to_drive(DB_FILE)
-        
-        # Verify the database is valid by trying to connect
-        test_conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        test_conn.execute("SELECT 1")
-        test_conn.close()
-        
-        # Reload database connection in bot_data
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        context.bot_data['db_conn'] = conn
+        if file_name.endswith('.gz'):
+            # Exports are gzip-compressed
+            await file.download_to_drive(gz_file)
+            def gunzip():
+                with gzip.open(gz_file, "rb") as src, open(import_file, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            await asyncio.to_thread(gunzip)
+        else:
+            await file.download_to_drive(import_file)
         
-        # Reload exams and menus from new database
-        context.bot_data['exams'] = load_exams(conn)
-        context.bot_data['menus'] = load_menus(conn)
+        # Check and migrate the upload; the live database is untouched until this passes
+        conn = context.bot_data['db_conn']
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        await asyncio.to_thread(prepare_import_db, import_file, page_size)
         
-        # Clear cached dynamic exam data
-        if 'dynamic_exams_data' in context.bot_data:
-            context.bot_data['dynamic_exams_data'] = {}
+        # Swap it in on the writer thread (queued writes wait), then rebuild the caches
+        await db_write(context, swap_in_database, import_file, backup_file)
+        logging.info(f"Created backup of current database: {backup_file}")
+        reload_db_caches(context.bot_data, conn)
         
         context.user_data.pop('admin_importing_db', None)
         
@@ -2298,17 +3625,12 @@ async def handle_admin_import_db_file(update: Update, context: ContextTypes.DEFA
         
         logging.info(f"Database imported successfully by admin {user.id}")
         
-    except sqlite3.Error as e:
-        # Restore backup if database is invalid
-        if os.path.exists(backup_file):
-            import shutil
-            shutil.copy2(backup_file, DB_FILE)
-            os.remove(backup_file)
-        
+    except (sqlite3.Error, ValueError) as e:
+        # The live database was not modified
         await update.message.reply_text(
             f"❌ خطأ: الملف المرفوع ليس قاعدة بيانات صالحة.\n\n"
             f"التفاصيل: {str(e)}\n\n"
-            "تم استعادة قاعدة البيانات القديمة.",
+            "لم يتم تعديل قاعدة البيانات الحالية.",
             reply_markup=build_admin_keyboard()
         )
         context.user_data.pop('admin_importing_db', None)
@@ -2321,9 +3643,213 @@ async def handle_admin_import_db_file(update: Update, context: ContextTypes.DEFA
         )
         context.user_data.pop('admin_importing_db', None)
         logging.error(f"Failed to import database: {e}")
+    finally:
+        for path in (import_file, f"{import_file}-journal", gz_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+async def handle_admin_import_changes_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Applies an uploaded incremental export (changes_*.json.gz) to the live database."""
+    user = update.effective_user
+    changes_file = f"{DB_FILE}.changes.json.gz"
+    context.user_data.pop('admin_importing_db', None)
+    try:
+        file = await context.bot.get_file(update.message.document.file_id)
+        await file.download_to_drive(changes_file)
+        # One transaction on the writer thread; a bad file leaves the database as it was
+        applied = await db_write(context, apply_incremental_export, changes_file)
+        reload_db_caches(context.bot_data, context.bot_data['db_conn'])
+        await update.message.reply_text(
+            f"✅ تم تطبيق ملف التغييرات ({applied} صف).\n\n"
+            "طبّق ملفات التغييرات التالية بالترتيب.",
+            reply_markup=build_admin_keyboard()
+        )
+        logging.info(f"Incremental export {update.message.document.file_name} applied by admin {user.id}: {applied} rows")
+    except (sqlite3.Error, ValueError, KeyError, OSError) as e:
+        await update.message.reply_text(
+            f"❌ خطأ: ملف التغييرات غير صالح.\n\n"
+            f"التفاصيل: {str(e)}\n\n"
+            "لم يتم تعديل قاعدة البيانات الحالية.",
+            reply_markup=build_admin_keyboard()
+        )
+        logging.error(f"Failed to apply incremental export: {e}")
+    except Exception as e:
+        await update.message.reply_text(
+            f"❌ حدث خطأ أثناء تطبيق ملف التغييرات: {str(e)}",
+            reply_markup=build_admin_keyboard()
+        )
+        logging.error(f"Failed to apply incremental export: {e}")
+    finally:
+        if os.path.exists(changes_file):
+            os.remove(changes_file)
+
+# ------------------- دمج قواعد البيانات القديمة (Legacy merge) -------------------
+# /merge_db <file> folds an old database (user_progressold.db, an earlier
+# export...) into the live one instead of replacing it. A copy of the file is
+# checked and migrated like an import, ATTACHed as "legacy" and merged with one
+# INSERT ... SELECT per table inside a single transaction. Without "apply" the
+# transaction is rolled back, so the report shows exactly what would change.
+# Attempts and rollups are added, so an applied file is remembered in
+# export_state ("merged:<sha1 of the file>") and cannot be merged twice.
+
+# Scores: the higher one wins (rows moved out of the old wide tables carry no
+# total/updated_at, so those keep the live value); attempts and daily rollups
+# add up; badges and statistics rows are unioned; exams, menus and names only
+# fill what is missing
+LEGACY_MERGE_STATEMENTS = [
+    ("user_progress", '''
+        INSERT INTO main.user_progress (user_id, first_name, username)
+        SELECT user_id, first_name, username FROM legacy.user_progress WHERE true
+        ON CONFLICT(user_id) DO UPDATE SET
+            first_name = COALESCE(first_name, excluded.first_name),
+            username = COALESCE(username, excluded.username)
+        WHERE (first_name IS NULL AND excluded.first_name IS NOT NULL)
+           OR (username IS NULL AND excluded.username IS NOT NULL)
+    '''),
+    ("quiz_results", '''
+        INSERT INTO main.quiz_results (user_id, quiz_key, score, total, updated_at)
+        SELECT user_id, quiz_key, score, total, updated_at FROM legacy.quiz_results WHERE true
+        ON CONFLICT(user_id, quiz_key) DO UPDATE SET
+            score = excluded.score,
+            total = COALESCE(excluded.total, total),
+            updated_at = COALESCE(excluded.updated_at, updated_at)
+        WHERE excluded.score > score
+    '''),
+    ("best_scores", '''
+        INSERT INTO main.best_scores (user_id, difficulty, best_score, total_questions, attempts, last_attempt_date)
+        SELECT user_id, difficulty, best_score, total_questions, attempts, last_attempt_date FROM legacy.best_scores WHERE true
+        ON CONFLICT(user_id, difficulty) DO UPDATE SET
+            best_score = MAX(best_score, excluded.best_score),
+            total_questions = CASE WHEN excluded.best_score > best_score THEN COALESCE(excluded.total_questions, total_questions) ELSE total_questions END,
+            attempts = attempts + excluded.attempts,
+            last_attempt_date = MAX(COALESCE(last_attempt_date, 0), COALESCE(excluded.last_attempt_date, 0))
+    '''),
+    ("user_badges", '''
+        INSERT OR IGNORE INTO main.user_badges (user_id, badge_id, earned_date)
+        SELECT user_id, badge_id, earned_date FROM legacy.user_badges
+    '''),
+    ("exam_statistics", '''
+        INSERT OR IGNORE INTO main.exam_statistics (exam_id, user_id, score, total_questions, completion_date, time_taken)
+        SELECT exam_id, user_id, score, total_questions, completion_date, time_taken FROM legacy.exam_statistics
+    '''),
+    ("exam_statistics_daily", '''
+        INSERT INTO main.exam_statistics_daily (exam_id, day, attempts, total_score, max_score, min_score, total_time)
+        SELECT exam_id, day, attempts, total_score, max_score, min_score, total_time FROM legacy.exam_statistics_daily WHERE true
+        ON CONFLICT(exam_id, day) DO UPDATE SET
+            attempts = attempts + excluded.attempts,
+            total_score = total_score + excluded.total_score,
+            max_score = MAX(max_score, excluded.max_score),
+            min_score = MIN(min_score, excluded.min_score),
+            total_time = total_time + excluded.total_time
+    '''),
+    ("dynamic_exams", None),
+    ("exam_file_ids", None),
+    ("exam_no_explanation_buttons", None),
+    ("menus", None),
+]
+
+def merge_legacy_db(legacy_path, fingerprint, conn, apply=False):
+    """
+    Writer thread: merges a migrated legacy database into the live one.
+    fingerprint identifies the original file. Returns ({table: (legacy rows,
+    added, updated)}, when that file was merged before or None); nothing is
+    kept unless apply, and a file that was already merged raises ValueError.
+    """
+    flush_user_progress(conn)
+    conn.commit()
+    conn.execute("ATTACH DATABASE ? AS legacy", (legacy_path,))
+    try:
+        report = {}
+        state_name = f"merged:{fingerprint}"
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT value FROM export_state WHERE name = ?", (state_name,)).fetchone()
+            merged_at = row[0] if row else None
+            if merged_at and apply:
+                raise ValueError(f"this file was already merged on {time.strftime('%Y-%m-%d %H:%M', time.localtime(merged_at))}")
+            for table, statement in LEGACY_MERGE_STATEMENTS:
+                if statement is None:
+                    # Configuration rows: copy the ones the live database does not have
+                    columns = ", ".join(row[1] for row in conn.execute(f"PRAGMA main.table_info({table})"))
+                    statement = f"INSERT OR IGNORE INTO main.{table} ({columns}) SELECT {columns} FROM legacy.{table}"
+                legacy_rows = conn.execute(f"SELECT COUNT(*) FROM legacy.{table}").fetchone()[0]
+                before = conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+                changed = conn.execute(statement).rowcount
+                added = conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0] - before
+                report[table] = (legacy_rows, added, changed - added)
+            if apply:
+                conn.execute("INSERT INTO export_state (name, value) VALUES (?, ?)", (state_name, int(time.time())))
+                conn.commit()
+            else:
+                conn.rollback()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute("DETACH DATABASE legacy")
+    if apply:
+        forget_user_badges()
+    return report, merged_at
+
+async def handle_merge_db_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/merge_db <file> [apply] - dry run by default."""
+    user = update.effective_user
+    if not is_admin_user(user.id):
+        await update.message.reply_text("❌ غير مسموح.")
+        return
+    if not context.args:
+        await update.message.reply_text(
+            "الاستخدام: /merge_db <ملف قاعدة البيانات> [apply]\n"
+            "بدون apply يتم عرض التقرير فقط دون تعديل قاعدة البيانات."
+        )
+        return
+
+    db_dir = os.path.dirname(os.path.abspath(DB_FILE))
+    legacy_path = os.path.join(db_dir, context.args[0])
+    apply = len(context.args) > 1 and context.args[1].lower() == "apply"
+    if not os.path.isfile(legacy_path) or os.path.abspath(legacy_path) == os.path.abspath(DB_FILE):
+        await update.message.reply_text(f"❌ الملف غير موجود: {context.args[0]}")
+        return
+
+    merge_file = f"{DB_FILE}.merge"
+    try:
+        # Migrate a copy, never the legacy file itself
+        await asyncio.to_thread(shutil.copyfile, legacy_path, merge_file)
+        fingerprint = (await asyncio.to_thread(question_source_fingerprint, merge_file))[2]
+        conn = context.bot_data['db_conn']
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        await asyncio.to_thread(prepare_import_db, merge_file, page_size)
+
+        report, merged_at = await db_write(context, merge_legacy_db, merge_file, fingerprint, apply=apply)
+        if apply:
+            reload_db_caches(context.bot_data, conn)
+        logging.info(f"Legacy database {legacy_path} merged by admin {user.id} (apply={apply}): {report}")
+
+        lines = [f"🔀 دمج {os.path.basename(legacy_path)}"]
+        lines.append("✅ تم حفظ الدمج." if apply else "🔍 تجربة فقط - لم يتم تعديل شيء. أعد الأمر مع apply للتنفيذ.")
+        if merged_at:
+            lines.append(f"⚠️ تم دمج هذا الملف سابقاً ({time.strftime('%Y-%m-%d %H:%M', time.localtime(merged_at))}) ولا يمكن دمجه مرة أخرى.")
+        lines.append("")
+        for table, (legacy_rows, added, updated) in report.items():
+            if legacy_rows:
+                lines.append(f"- {table}: {legacy_rows} صف، جديد {added}، محدّث {updated}")
+        await update.message.reply_text("\n".join(lines))
+
+    except (sqlite3.Error, ValueError) as e:
+        await update.message.reply_text(
+            f"❌ لا يمكن دمج الملف.\n\nالتفاصيل: {str(e)}\n\nلم يتم تعديل قاعدة البيانات الحالية."
+        )
+        logging.error(f"Failed to merge database {legacy_path}: {e}")
+    finally:
+        for path in (merge_file, f"{merge_file}-journal"):
+            if os.path.exists(path):
+                os.remove(path)
 
 async def export_user_progress_to_csv(conn):
-    """Export user_progress table to CSV file and return the file path."""
+    """
+    Export user_progress table to CSV file and return the file path.
+    Flush buffered progress on the writer thread before calling it.
+    """
     import csv
     from datetime import datetime
     
@@ -2360,7 +3886,10 @@ async def export_user_progress_to_csv(conn):
         return None
 
 async def send_user_progress_to_admin(context: ContextTypes.DEFAULT_TYPE):
-    """Send database file to admin every hour."""
+    """
+    Hourly copy for the admin: a full gzipped snapshot every DB_FULL_BACKUP_HOURS
+    (or when the changes would not fit), otherwise only the changes since the last copy.
+    """
     if not ADMIN_TELEGRAM_ID:
         logging.warning("ADMIN_TELEGRAM_ID not set, cannot send database")
         return
@@ -2370,24 +3899,26 @@ async def send_user_progress_to_admin(context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Check file size
-        file_size_mb = os.path.getsize(DB_FILE) / (1024 * 1024)
-        if file_size_mb > 45:  # Telegram doc limit ~50MB
-            logging.warning(f"Database file too large ({file_size_mb:.2f} MB), skipping send")
-            return
-        
-        # Send to admin
         from datetime import datetime
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        await context.bot.send_document(
-            chat_id=ADMIN_TELEGRAM_ID,
-            document=open(DB_FILE, "rb"),
-            filename=os.path.basename(DB_FILE),
-            caption=f"📥 نسخة من قاعدة البيانات - {timestamp}\n\nتم التصدير تلقائياً كل ساعة"
-        )
-        
-        logging.info(f"Successfully sent database file to admin at {timestamp}")
+        caption = f"📥 نسخة من قاعدة البيانات - {timestamp}\n\nتم التصدير تلقائياً كل ساعة"
+        state = await db_read(context, get_export_state)
+        result = None
+        if time.time() - state.get('full_backup_at', 0) < DB_FULL_BACKUP_HOURS * 3600:
+            result = await send_incremental_export(context, ADMIN_TELEGRAM_ID, caption)
+        if result in (None, "too_large"):
+            # Taken before the snapshot: later changes go into the next incremental export
+            change_id, event_id = await db_read(context, export_watermark)
+            result = await send_db_backup(context, ADMIN_TELEGRAM_ID, caption, skip_if_unchanged=True)
+            if result in ("sent", "unchanged"):
+                await db_write(context, acknowledge_export, change_id, event_id, full=True)
+        if result == "unchanged":
+            logging.info("Database unchanged since the last hourly copy, skipping send")
+        elif result == "too_large":
+            logging.warning(f"Compressed database is larger than {DB_SEND_MAX_MB} MB, skipping send")
+        else:
+            logging.info(f"Successfully sent database file to admin at {timestamp}")
     except Exception as e:
         logging.error(f"Error sending database to admin: {e}")
 
@@ -2400,7 +3931,7 @@ async def handle_admin_exams_manage(update: Update, context: ContextTypes.DEFAUL
     if not is_admin_user(user.id):
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
-    exams = load_exams()
+    exams = exam_registry.all()
     exam_list = []
     for exam_id, exam in exams.items():
         status = "✅" if exam.get("explanation_file") and exam.get("questions_file") else "⚠️"
@@ -2427,7 +3958,7 @@ async def handle_admin_exam_toggle_visibility(update: Update, context: ContextTy
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     if not exams:
         await update.callback_query.edit_message_text("لا توجد اختبارات.", reply_markup=admin_back_markup())
         return
@@ -2453,7 +3984,7 @@ async def handle_admin_exam_visibility_select(update: Update, context: ContextTy
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     exam = exams.get(exam_id)
     if not exam:
         await update.callback_query.edit_message_text("❌ الاختبار غير موجود.", reply_markup=admin_back_markup())
@@ -2486,20 +4017,15 @@ async def handle_admin_exam_hide(update: Update, context: ContextTypes.DEFAULT_T
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     exam = exams.get(exam_id)
     if not exam:
         await update.callback_query.edit_message_text("❌ الاختبار غير موجود.", reply_markup=admin_back_markup())
         return
     
     # Hide the exam
-    exam['is_hidden'] = True
-    exams[exam_id] = exam
     conn = context.bot_data.get('db_conn')
-    save_exams(exams, conn)
-    
-    # Reload exams in bot_data
-    context.bot_data['exams'] = load_exams(conn)
+    exam = exam_registry.update(exam_id, conn, is_hidden=True)
     
     exam_name = exam.get('button_text', exam_id)
     await update.callback_query.edit_message_text(
@@ -2514,7 +4040,7 @@ async def handle_admin_exam_show(update: Update, context: ContextTypes.DEFAULT_T
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     exam = exams.get(exam_id)
     if not exam:
         await update.callback_query.edit_message_text("❌ الاختبار غير موجود.", reply_markup=admin_back_markup())
@@ -2539,7 +4065,7 @@ async def handle_admin_exam_notify_users(update: Update, context: ContextTypes.D
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     exam = exams.get(exam_id)
     if not exam:
         await update.callback_query.edit_message_text("❌ الاختبار غير موجود.", reply_markup=admin_back_markup())
@@ -2548,13 +4074,8 @@ async def handle_admin_exam_notify_users(update: Update, context: ContextTypes.D
     exam_name = exam.get('button_text', exam_id)
     
     # Show the exam
-    exam['is_hidden'] = False
-    exams[exam_id] = exam
     conn = context.bot_data.get('db_conn')
-    save_exams(exams, conn)
-    
-    # Reload exams in bot_data
-    context.bot_data['exams'] = load_exams(conn)
+    exam = exam_registry.update(exam_id, conn, is_hidden=False)
     
     # Notify all users
     conn = context.bot_data['db_conn']
@@ -2591,7 +4112,7 @@ async def handle_admin_exam_show_final(update: Update, context: ContextTypes.DEF
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     exam = exams.get(exam_id)
     if not exam:
         await update.callback_query.edit_message_text("❌ الاختبار غير موجود.", reply_markup=admin_back_markup())
@@ -2600,13 +4121,8 @@ async def handle_admin_exam_show_final(update: Update, context: ContextTypes.DEF
     exam_name = exam.get('button_text', exam_id)
     
     # Show the exam
-    exam['is_hidden'] = False
-    exams[exam_id] = exam
     conn = context.bot_data.get('db_conn')
-    save_exams(exams, conn)
-    
-    # Reload exams in bot_data
-    context.bot_data['exams'] = load_exams(conn)
+    exam = exam_registry.update(exam_id, conn, is_hidden=False)
     
     await update.callback_query.edit_message_text(
         f"✅ تم إظهار الاختبار '{exam_name}' بنجاح.\n\nالاختبار متاح الآن في القائمة الرئيسية.",
@@ -2620,7 +4136,7 @@ async def handle_admin_exam_add_no_explanation(update: Update, context: ContextT
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     if not exams:
         await update.callback_query.edit_message_text("لا توجد اختبارات.", reply_markup=admin_back_markup())
         return
@@ -2645,7 +4161,7 @@ async def handle_admin_exam_select_no_explanation(update: Update, context: Conte
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     exam = exams.get(exam_id)
     if not exam:
         await update.callback_query.edit_message_text("❌ الاختبار غير موجود.", reply_markup=admin_back_markup())
@@ -2691,8 +4207,7 @@ async def handle_admin_exam_save_no_explanation(update: Update, context: Context
     # Save to database
     conn = context.bot_data.get('db_conn')
     cursor = conn.cursor()
-    from datetime import datetime
-    now = datetime.now().isoformat()
+    now = int(time.time())
     
     cursor.execute('''
         INSERT INTO exam_no_explanation_buttons (button_id, exam_id, button_text, created_at)
@@ -2787,25 +4302,18 @@ async def handle_admin_exam_create_explanation(update: Update, context: ContextT
     
     # Analyze the CSV structure
     try:
-        df = pd.read_csv(explanation_file, encoding='utf-8')
-        df.columns = [c.strip().lower() for c in df.columns]
-        
-        # Group by ID and count levels
-        structure = {}
-        for _, row in df.iterrows():
-            try:
-                id_val = int(row.get('id', 1))
-                level = int(row.get('level', 1))
-            except (ValueError, TypeError):
-                continue
-            if id_val not in structure:
-                structure[id_val] = []
-            if level not in structure[id_val]:
-                structure[id_val].append(level)
-        
-        # Sort levels for each ID
-        for id_val in structure:
-            structure[id_val].sort()
+        import pandas as pd
+        df = normalize_frame_columns(pd.read_csv(explanation_file, encoding='utf-8'))
+
+        # Group by ID and count levels (rows with non-numeric id/level are skipped)
+        pairs = pd.DataFrame({
+            'id': pd.to_numeric(pd.Series(frame_column_values(df, 'id', 1)), errors='coerce'),
+            'level': pd.to_numeric(pd.Series(frame_column_values(df, 'level', 1)), errors='coerce')
+        }).dropna().astype(int).drop_duplicates()
+        structure = {
+            int(id_val): sorted(int(level) for level in levels)
+            for id_val, levels in pairs.groupby('id')['level']
+        }
         
         # Store structure for media addition
         context.user_data['admin_exam_create']['explanation_structure'] = structure
@@ -3174,9 +4682,7 @@ async def finalize_exam_creation(update: Update, context: ContextTypes.DEFAULT_T
     
     # Save exam
     conn = context.bot_data.get('db_conn')
-    exams = load_exams(conn)
-    exams[exam_id] = exam_data
-    save_exams(exams, conn)
+    exam_registry.put(exam_id, exam_data, conn)
     
     # Add to main menu
     conn = context.bot_data.get('db_conn')
@@ -3188,9 +4694,6 @@ async def finalize_exam_creation(update: Update, context: ContextTypes.DEFAULT_T
     })
     set_main_menu_buttons(context, buttons)
     
-    # Reload exams in bot_data
-    context.bot_data["exams"] = exams
-    
     # Summary
     type_desc = {
         "mcq": "MCQ فقط",
@@ -3569,6 +5072,13 @@ async def handle_admin_results_search_receive(update: Update, context: ContextTy
                 if rows:
                     col_names = [d[0] for d in cursor.description]
                     results.append((table, rows, col_names))
+            # Every quiz, dynamic exams included
+            rows = [
+                (quiz_key, score, total, time.strftime("%Y-%m-%d %H:%M", time.localtime(updated_at)) if updated_at else "-")
+                for quiz_key, score, total, updated_at in get_user_results(uid, conn)
+            ]
+            if rows:
+                results.append(("quiz_results", rows, ["quiz_key", "score", "total", "updated_at"]))
         else:
             like_q = f"%{query}%"
             for table in ["user_progress", "lab_results", "mazen_results"]:
@@ -3905,8 +5415,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user = update.effective_user
 
-    conn = context.bot_data['db_conn']
-    context.user_data.update(get_user_state(user.id, user.first_name, conn))
+    context.user_data.update(await db_write(context, get_user_state, user.id, user.first_name, username=user.username))
     debug_log("start", "User state loaded", {}, "E")
     
     # Maintenance mode gate
@@ -4094,7 +5603,6 @@ async def handle_mazen_mcq_start(update: Update, context: ContextTypes.DEFAULT_T
     """Starts the multiple-choice quiz for the current Mazen test ID."""
     query = update.callback_query
     user = query.from_user
-    conn = context.bot_data['db_conn']
     mazen_state = context.user_data.get('mazen_test', {})
     current_id = mazen_state.get('current_id', 1)
     
@@ -4107,10 +5615,10 @@ async def handle_mazen_mcq_start(update: Update, context: ContextTypes.DEFAULT_T
     # Delete the message with the 'start mcq' button
     await query.delete_message()
 
-    reset_user_progress(user.id, difficulty, conn)
+    await db_write(context, reset_user_progress, user.id, difficulty)
     # We need to clear and update user_data for the quiz
     context.user_data.clear()
-    state = get_user_state(user.id, user.first_name, conn)
+    state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
     context.user_data.update(state)
     context.user_data['difficulty'] = difficulty
     # VERY IMPORTANT: Persist the mazen_test state across the quiz
@@ -4138,11 +5646,6 @@ async def start_dynamic_exam(update: Update, context: ContextTypes.DEFAULT_TYPE,
         'question_type': question_type
     }
     
-    # Store exam data in context for later use
-    if 'dynamic_exams_data' not in context.bot_data:
-        context.bot_data['dynamic_exams_data'] = {}
-    context.bot_data['dynamic_exams_data'][exam_id] = exam_data
-    
     # Delete the button message first
     await query.delete_message()
     
@@ -4169,11 +5672,6 @@ async def start_dynamic_exam_no_explanation(update: Update, context: ContextType
         'no_explanation': True  # Flag to indicate this exam started without explanation
     }
     
-    # Store exam data in context for later use
-    if 'dynamic_exams_data' not in context.bot_data:
-        context.bot_data['dynamic_exams_data'] = {}
-    context.bot_data['dynamic_exams_data'][exam_id] = exam_data
-    
     # Don't send "no cheating" message for no-explanation exams (no explanation messages to delete)
     # Start MCQ quiz directly (handle_dynamic_exam_mcq_start will delete the button message)
     await handle_dynamic_exam_mcq_start(update, context, exam_id, None)
@@ -4212,9 +5710,6 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
             'state': 'intro_text',
             'question_type': question_type
         }
-        if 'dynamic_exams_data' not in context.bot_data:
-            context.bot_data['dynamic_exams_data'] = {}
-        context.bot_data['dynamic_exams_data'][exam_id] = exam_data
         exam_state = context.user_data['dynamic_exam']
     elif exam_state.get('exam_id') != exam_id:
         # Different exam, reinitialize
@@ -4236,9 +5731,6 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
             'state': 'intro_text',
             'question_type': question_type
         }
-        if 'dynamic_exams_data' not in context.bot_data:
-            context.bot_data['dynamic_exams_data'] = {}
-        context.bot_data['dynamic_exams_data'][exam_id] = exam_data
         exam_state = context.user_data['dynamic_exam']
     
     current_id = exam_state.get('current_id', 1)
@@ -4261,47 +5753,23 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
     if not exam_data:
         exam_data = {"texts": {}, "mcq_questions": [], "narrative_questions": []}
 
-    # Store exam data in context for later use
-    if 'dynamic_exams_data' not in context.bot_data:
-        context.bot_data['dynamic_exams_data'] = {}
-    context.bot_data['dynamic_exams_data'][exam_id] = exam_data
-
     all_texts = exam_data.get('texts', {})
+    unit = get_exam_unit(exam_data, current_id)
+    current_id_texts = unit["levels"] if unit else {}
 
     # Debug logging for texts
     logging.info(f"all_texts keys: {list(all_texts.keys()) if all_texts else 'empty'}")
-    if all_texts and current_id in all_texts:
-        logging.info(f"texts for current_id {current_id}: {list(all_texts[current_id].keys())}")
-        logging.info(f"next_level_exists check: current_level={current_level}, next_level={current_level + 1}, exists={(current_level + 1) in all_texts.get(current_id, {})}")
+    if current_id_texts:
+        logging.info(f"texts for current_id {current_id}: {list(current_id_texts.keys())}")
 
     # Check if there are any texts at all
-    conn = context.bot_data.get('db_conn')
-    exam, exam_data, question_type = await load_dynamic_exam(exam_id, conn, context.bot)
-    if not exam:
-        if query:
-            try:
-                await query.answer("❌ الاختبار غير موجود.", show_alert=True)
-            except:
-                pass
-        return
-    
-    if not exam_data:
-        exam_data = {"texts": {}, "mcq_questions": [], "narrative_questions": []}
-    
-    # Store exam data in context for later use
-    if 'dynamic_exams_data' not in context.bot_data:
-        context.bot_data['dynamic_exams_data'] = {}
-    context.bot_data['dynamic_exams_data'][exam_id] = exam_data
-    
-    all_texts = exam_data.get('texts', {})
-    
     if not all_texts:
         # No explanation texts at all, go directly to questions
         logging.info("No explanation texts at all, going to quiz automatically")
         exam_state['state'] = 'mcq_quiz' if exam_state.get('question_type') == 'mcq' else 'srd_quiz'
         
         # Get exam data to check available questions
-        exam_data = context.bot_data.get('dynamic_exams_data', {}).get(exam_id, {})
+        exam_data = await get_dynamic_exam_data(context, exam_id)
         mcq_questions = exam_data.get('mcq_questions', [])
         narrative_questions = exam_data.get('narrative_questions', [])
         
@@ -4329,13 +5797,11 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
             await handle_dynamic_exam_srd_start(update, context, exam_id, None)
         return
 
-    if current_id not in all_texts:
+    if not current_id_texts:
         # No texts for this specific ID, skip to next ID
         logging.info(f"No texts found for current_id {current_id}, all_texts keys: {list(all_texts.keys())}")
-        all_ids = sorted(all_texts.keys())
-        current_id_index = all_ids.index(current_id) if current_id in all_ids else -1
-        if current_id_index >= 0 and current_id_index < len(all_ids) - 1:
-            next_id = all_ids[current_id_index + 1]
+        next_id = unit["next"] if unit else None
+        if next_id is not None:
             context.user_data['dynamic_exam']['current_id'] = next_id
             context.user_data['dynamic_exam']['text_level'] = 1
             keyboard = [[InlineKeyboardButton("نكمل شرح للوحدة التالية 📖", callback_data=f"dynamic_exam_continue_{exam_id}")]]
@@ -4360,10 +5826,10 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     try:
-        text_to_send = all_texts[current_id][current_level]
+        text_to_send = current_id_texts[current_level]
         logging.info(f"Found text for ID {current_id}, level {current_level}: length={len(text_to_send)}")
     except KeyError:
-        logging.error(f"Text not found for ID {current_id}, level {current_level}. Available: {all_texts.get(current_id, {})}")
+        logging.error(f"Text not found for ID {current_id}, level {current_level}. Available: {current_id_texts}")
         if query:
             try:
                 await query.answer("⚠️ المحتوى غير متوفر حالياً.", show_alert=True)
@@ -4372,7 +5838,6 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     # Check if there is a next level for the current ID
-    current_id_texts = all_texts.get(current_id, {})
     next_level_exists = (current_level + 1) in current_id_texts
 
     logging.info(f"current_id_texts for id {current_id}: {list(current_id_texts.keys()) if current_id_texts else 'empty'}")
@@ -4388,13 +5853,9 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
         has_narrative = False
     else:
         # This is the last text level for current ID
-        # Check what question types are available for this ID from pre-loaded data
-        mcq_questions = exam_data.get('mcq_questions', [])
-        narrative_questions = exam_data.get('narrative_questions', [])
-
-        # Filter questions for current ID
-        mcq_for_id = [q for q in mcq_questions if str(q.get('id', '')) == str(current_id)]
-        narrative_for_id = [q for q in narrative_questions if str(q.get('id', '')) == str(current_id)]
+        # Check what question types are available for this ID from the unit index
+        mcq_for_id = unit["mcq"]
+        narrative_for_id = unit["narrative"]
 
         logging.info(f"MCQ questions for ID {current_id}: {len(mcq_for_id)} questions")
         logging.info(f"Narrative questions for ID {current_id}: {len(narrative_for_id)} questions")
@@ -4449,13 +5910,10 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
         else:
             # No questions for this ID, check if there's a next ID
             logging.info(f"No questions found for ID {current_id}, checking next ID")
-            all_ids = sorted(all_texts.keys())
-            current_id_index = all_ids.index(current_id) if current_id in all_ids else -1
-            next_id_exists = current_id_index >= 0 and current_id_index < len(all_ids) - 1
+            next_id = unit["next"]
             
-            if next_id_exists:
+            if next_id is not None:
                 # Move to next ID
-                next_id = all_ids[current_id_index + 1]
                 context.user_data['dynamic_exam']['current_id'] = next_id
                 context.user_data['dynamic_exam']['text_level'] = 1
                 keyboard = [[InlineKeyboardButton("نكمل شرح للوحدة التالية 📖", callback_data=f"dynamic_exam_continue_{exam_id}")]]
@@ -4471,9 +5929,7 @@ async def send_dynamic_exam_text(update: Update, context: ContextTypes.DEFAULT_T
                 return
     
     # Check if there's media attached to this ID and level
-    media_attachments = exam.get('media_attachments', {})
-    media_key = f"{current_id}_{current_level}"
-    media_info = media_attachments.get(media_key)
+    media_info = unit["media"].get(str(current_level))
     
     # Answer the callback query first
     if query:
@@ -4581,12 +6037,10 @@ async def handle_dynamic_exam_mcq_start(update: Update, context: ContextTypes.DE
     no_explanation = exam_state.get('no_explanation', False)
     
     if question_id is not None and not no_explanation:
-        # Filter questions for this ID - convert both to string for comparison
+        # Questions for this ID come from the unit index
         # Only filter if NOT no_explanation mode (in no_explanation mode, use all questions)
-        question_id_str = str(question_id)
-        questions = [q for q in all_questions if str(q.get('id', '')) == question_id_str]
-        debug_log("handle_dynamic_exam_mcq_start", "Filtered questions", {"filtered_count": len(questions), "question_id": question_id, "question_id_str": question_id_str, "sample_filtered": questions[0] if questions else None}, "F")
-        debug_log("handle_dynamic_exam_mcq_start", "All question IDs", {"all_ids": [q.get('id') for q in all_questions[:5]]}, "F")
+        questions = get_exam_unit_questions(exam_data, question_id, "mcq")
+        debug_log("handle_dynamic_exam_mcq_start", "Filtered questions", {"filtered_count": len(questions), "question_id": question_id, "sample_filtered": questions[0] if questions else None}, "F")
     else:
         # Use all questions (either no question_id specified OR no_explanation mode)
         questions = all_questions
@@ -4602,12 +6056,9 @@ async def handle_dynamic_exam_mcq_start(update: Update, context: ContextTypes.DE
 
     debug_log("handle_dynamic_exam_mcq_start", "Questions ready", {"final_questions_count": len(questions)}, "F")
     
-    # Store questions in bot_data for the quiz system
+    # The session points at the shared view; nothing is written to bot_data['questions']
     difficulty = f"dynamic_exam_{exam_id}"
-    if 'questions' not in context.bot_data:
-        context.bot_data['questions'] = {}
-    context.bot_data['questions'][difficulty] = questions
-    debug_log("handle_dynamic_exam_mcq_start", "Questions stored in bot_data", {"difficulty": difficulty, "stored_count": len(questions)}, "F")
+    view_unit_id = question_id if question_id is not None and not no_explanation else None
 
     # Ensure user_id is in context.user_data for send_question_view
     context.user_data['user_id'] = user.id
@@ -4655,9 +6106,12 @@ async def handle_dynamic_exam_mcq_start(update: Update, context: ContextTypes.DE
         debug_log("handle_dynamic_exam_mcq_start", "No explanation mode - skipping cleanup and 'no cheating' message", {}, "F")
         logging.info(f"Starting MCQ for exam {exam_id} without explanation (no cleanup needed)")
 
+    # Resume / retry below keep using this view
+    open_dynamic_exam_view(context, exam_id, exam_data, view_unit_id)
+
     # Check if user has incomplete quiz
     logging.info(f"Checking for incomplete quiz for user {user.id}, difficulty {difficulty}")
-    has_incomplete, saved_q_idx, saved_score = has_incomplete_quiz(user.id, difficulty, conn)
+    has_incomplete, saved_q_idx, saved_score = await db_write(context, has_incomplete_quiz, user.id, difficulty)
     logging.info(f"has_incomplete: {has_incomplete}, saved_q_idx: {saved_q_idx}, saved_score: {saved_score}")
     if has_incomplete:
         keyboard = [
@@ -4678,18 +6132,20 @@ async def handle_dynamic_exam_mcq_start(update: Update, context: ContextTypes.DE
         return
         return
     
-    reset_user_progress(user.id, difficulty, conn)
+    await db_write(context, reset_user_progress, user.id, difficulty)
     logging.info("After reset_user_progress")
     # Preserve dynamic_exam state before clearing
     preserved_exam_state = context.user_data.get('dynamic_exam', {})
+    question_view = context.user_data.get('question_view')
     context.user_data.clear()
     logging.info("After context.user_data.clear()")
-    state = get_user_state(user.id, user.first_name, conn)
+    state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
     logging.info(f"Got state: {state}")
     context.user_data.update(state)
     context.user_data['difficulty'] = difficulty
     # Restore preserved exam state (including no_explanation flag)
     context.user_data['dynamic_exam'] = preserved_exam_state if preserved_exam_state else exam_state
+    context.user_data['question_view'] = question_view
     context.user_data['quiz_start_time'] = time.time()  # Track time for statistics
 
     debug_log("handle_dynamic_exam_mcq_start", "About to call send_question_view", {"difficulty": difficulty, "questions_count": len(questions)}, "F")
@@ -4737,11 +6193,7 @@ async def handle_dynamic_exam_srd_start(update: Update, context: ContextTypes.DE
             await query.answer("❌ الاختبار غير موجود.", show_alert=True)
         return
     
-    # Store exam_data in bot_data for future use
-    if 'dynamic_exams_data' not in context.bot_data:
-        context.bot_data['dynamic_exams_data'] = {}
-    context.bot_data['dynamic_exams_data'][exam_id] = exam_data
-    debug_log("handle_dynamic_exam_srd_start", "Stored exam_data in bot_data", {"narrative_questions_count": len(exam_data.get('narrative_questions', []))}, "F")
+    debug_log("handle_dynamic_exam_srd_start", "Loaded exam_data", {"narrative_questions_count": len(exam_data.get('narrative_questions', []))}, "F")
     
     # Get questions - filter by question_id if provided
     all_questions = exam_data.get('narrative_questions', [])
@@ -4751,11 +6203,10 @@ async def handle_dynamic_exam_srd_start(update: Update, context: ContextTypes.DE
     no_explanation = exam_state.get('no_explanation', False)
 
     if question_id is not None and not no_explanation:
-        # Filter questions for this ID - convert both to string for comparison
+        # Questions for this ID come from the unit index
         # Only filter if NOT no_explanation mode (in no_explanation mode, use all questions)
-        question_id_str = str(question_id)
-        questions = [q for q in all_questions if str(q.get('id', '')) == question_id_str]
-        debug_log("handle_dynamic_exam_srd_start", "Filtered narrative questions", {"filtered_count": len(questions), "question_id": question_id, "question_id_str": question_id_str}, "F")
+        questions = get_exam_unit_questions(exam_data, question_id, "narrative")
+        debug_log("handle_dynamic_exam_srd_start", "Filtered narrative questions", {"filtered_count": len(questions), "question_id": question_id}, "F")
     else:
         # Use all questions (either no question_id specified OR no_explanation mode)
         questions = all_questions
@@ -4854,11 +6305,11 @@ async def send_dynamic_exam_srd_question(update: Update, context: ContextTypes.D
     debug_log("send_dynamic_exam_srd_question", "Questions from exam_state", {"srd_questions_count": len(srd_questions)}, "F")
 
     if not srd_questions:
-        # Try to get from bot_data first
-        exam_data = context.bot_data.get('dynamic_exams_data', {}).get(exam_id)
+        # Try the parsed exam cache first
+        exam_data = cached_dynamic_exam_data(exam_id)
         if not exam_data:
             # Reload exam data if not in memory
-            debug_log("send_dynamic_exam_srd_question", "No exam_data in bot_data, reloading", {"exam_id": exam_id}, "F")
+            debug_log("send_dynamic_exam_srd_question", "No exam_data in the exam cache, reloading", {"exam_id": exam_id}, "F")
             conn = context.bot_data.get('db_conn')
             exam, exam_data, question_type = await load_dynamic_exam(exam_id, conn, context.bot)
             if not exam or not exam_data:
@@ -4866,16 +6317,10 @@ async def send_dynamic_exam_srd_question(update: Update, context: ContextTypes.D
                 if query:
                     await query.answer("❌ الاختبار غير موجود.", show_alert=True)
                 return
-            # Store in bot_data for future use
-            if 'dynamic_exams_data' not in context.bot_data:
-                context.bot_data['dynamic_exams_data'] = {}
-            context.bot_data['dynamic_exams_data'][exam_id] = exam_data
         
-        # Filter questions by current_id
-        all_questions = exam_data.get('narrative_questions', [])
-        current_id_str = str(current_id)
-        srd_questions = [q for q in all_questions if str(q.get('id', '')) == current_id_str]
-        debug_log("send_dynamic_exam_srd_question", "Filtered questions from exam_data", {"all_questions_count": len(all_questions), "filtered_count": len(srd_questions), "current_id_str": current_id_str}, "F")
+        # Questions for current_id from the unit index
+        srd_questions = get_exam_unit_questions(exam_data, current_id, "narrative")
+        debug_log("send_dynamic_exam_srd_question", "Filtered questions from exam_data", {"filtered_count": len(srd_questions), "current_id": current_id}, "F")
         
         if not srd_questions:
             debug_log("send_dynamic_exam_srd_question", "No questions found after filtering", {}, "F")
@@ -4972,16 +6417,16 @@ async def show_dynamic_exam_srd_answer(update: Update, context: ContextTypes.DEF
     debug_log("show_dynamic_exam_srd_answer", "Questions from exam_state", {"srd_questions_count": len(srd_questions)}, "F")
 
     if not srd_questions:
-        # Try to get from bot_data first
-        logging.info(f"show_dynamic_exam_srd_answer: No questions in state, checking bot_data for exam_id={exam_id}")
-        debug_log("show_dynamic_exam_srd_answer", "No questions in state, checking bot_data", {"exam_id": exam_id}, "F")
-        exam_data = context.bot_data.get('dynamic_exams_data', {}).get(exam_id)
-        logging.info(f"show_dynamic_exam_srd_answer: exam_data from bot_data={exam_data is not None}")
+        # Try the parsed exam cache first
+        logging.info(f"show_dynamic_exam_srd_answer: No questions in state, checking the exam cache for exam_id={exam_id}")
+        debug_log("show_dynamic_exam_srd_answer", "No questions in state, checking the exam cache", {"exam_id": exam_id}, "F")
+        exam_data = cached_dynamic_exam_data(exam_id)
+        logging.info(f"show_dynamic_exam_srd_answer: exam_data from the exam cache={exam_data is not None}")
         if exam_data:
-            debug_log("show_dynamic_exam_srd_answer", "Found exam_data in bot_data", {"narrative_questions_count": len(exam_data.get('narrative_questions', [])), "exam_data_keys": list(exam_data.keys()) if exam_data else [], "sample_questions": [{"id": str(q.get('id', '')), "has_question": 'question' in q, "has_answer": 'answer' in q} for q in exam_data.get('narrative_questions', [])[:3]] if exam_data else []}, "F")
+            debug_log("show_dynamic_exam_srd_answer", "Found exam_data in the exam cache", {"narrative_questions_count": len(exam_data.get('narrative_questions', [])), "exam_data_keys": list(exam_data.keys()) if exam_data else [], "sample_questions": [{"id": str(q.get('id', '')), "has_question": 'question' in q, "has_answer": 'answer' in q} for q in exam_data.get('narrative_questions', [])[:3]] if exam_data else []}, "F")
         else:
             # Reload exam data if not in memory
-            debug_log("show_dynamic_exam_srd_answer", "No exam_data in bot_data, reloading exam data", {"exam_id": exam_id}, "F")
+            debug_log("show_dynamic_exam_srd_answer", "No exam_data in the exam cache, reloading exam data", {"exam_id": exam_id}, "F")
             conn = context.bot_data.get('db_conn')
             exam, exam_data, question_type = await load_dynamic_exam(exam_id, conn, context.bot)
             debug_log("show_dynamic_exam_srd_answer", "load_dynamic_exam returned", {"exam": exam is not None, "exam_data": exam_data is not None, "narrative_questions_count": len(exam_data.get('narrative_questions', [])) if exam_data else 0}, "F")
@@ -4993,27 +6438,19 @@ async def show_dynamic_exam_srd_answer(update: Update, context: ContextTypes.DEF
                     await query.answer("❌ الاختبار غير موجود.", show_alert=True)
                 return
             
-            # Store in bot_data for future use
-            if 'dynamic_exams_data' not in context.bot_data:
-                context.bot_data['dynamic_exams_data'] = {}
-            context.bot_data['dynamic_exams_data'][exam_id] = exam_data
-        
-        # Filter questions by current_id
-        all_questions = exam_data.get('narrative_questions', [])
-        current_id_str = str(current_id)
-        debug_log("show_dynamic_exam_srd_answer", "Before filtering", {"all_questions_count": len(all_questions), "current_id": current_id, "current_id_str": current_id_str, "exam_id": exam_id, "sample_questions": [{"id": str(q.get('id', '')), "has_question": 'question' in q, "has_answer": 'answer' in q} for q in all_questions[:3]] if all_questions else []}, "F")
-        srd_questions = [q for q in all_questions if str(q.get('id', '')) == current_id_str]
-        debug_log("show_dynamic_exam_srd_answer", "Filtered questions", {"all_questions_count": len(all_questions), "filtered_count": len(srd_questions), "current_id_str": current_id_str, "sample_ids": [str(q.get('id', '')) for q in all_questions[:5]] if all_questions else []}, "F")
+        # Questions for current_id from the unit index
+        srd_questions = get_exam_unit_questions(exam_data, current_id, "narrative")
+        debug_log("show_dynamic_exam_srd_answer", "Filtered questions", {"filtered_count": len(srd_questions), "current_id": current_id, "exam_id": exam_id}, "F")
         
         if not srd_questions:
-            debug_log("show_dynamic_exam_srd_answer", "No questions found after filtering", {"all_questions_count": len(all_questions), "current_id_str": current_id_str}, "F")
+            debug_log("show_dynamic_exam_srd_answer", "No questions found after filtering", {"current_id": current_id}, "F")
             if query:
                 await query.answer("عذراً، لا توجد أسئلة سردية لهذه الوحدة.", show_alert=True)
             return
         
         exam_state['narrative_questions'] = srd_questions
         context.user_data['dynamic_exam'] = exam_state
-        debug_log("show_dynamic_exam_srd_answer", "Reloaded and filtered questions", {"srd_questions_count": len(srd_questions), "current_id_str": current_id_str}, "F")
+        debug_log("show_dynamic_exam_srd_answer", "Reloaded and filtered questions", {"srd_questions_count": len(srd_questions), "current_id": current_id}, "F")
 
     if q_index >= len(srd_questions):
         debug_log("show_dynamic_exam_srd_answer", "All questions finished, calling finish_dynamic_exam", {}, "F")
@@ -5126,7 +6563,7 @@ async def finish_dynamic_exam(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Note: We can't track all messages, but we'll delete the ones we track
     
     conn = context.bot_data.get('db_conn')
-    exam = load_exams(conn).get(exam_id, {})
+    exam = exam_registry.get(exam_id, conn) or {}
     exam_name = exam.get('button_text', 'الاختبار')
     exam_state = context.user_data.get('dynamic_exam', {})
     current_id = exam_state.get('current_id', 1)
@@ -5151,11 +6588,11 @@ async def finish_dynamic_exam(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     # Check if there are more IDs (for future multi-ID support)
-    exam_data = context.bot_data.get('dynamic_exams_data', {}).get(exam_id, {})
-    all_texts = exam_data.get('texts', {})
-    next_id = current_id + 1
+    exam_data = await get_dynamic_exam_data(context, exam_id)
+    unit = get_exam_unit(exam_data, current_id)
+    next_id = unit["next"] if unit else None
 
-    if next_id in all_texts:
+    if next_id is not None:
         # There is a next ID to move to (like Mazen test)
         context.user_data['dynamic_exam'] = {
             'exam_id': exam_id,
@@ -5190,10 +6627,9 @@ async def handle_retry_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Handle quiz retry - start fresh but keep best score."""
     query = update.callback_query
     user = query.from_user
-    conn = context.bot_data['db_conn']
     
     # Get best score info
-    best_info = get_best_score(user.id, difficulty, conn)
+    best_info = await db_read(context, get_best_score, user.id, difficulty)
     best_msg = ""
     if best_info:
         best_msg = f"\n🏆 أفضل نتيجة سابقة: {best_info['best_score']} من {best_info['total_questions']} ({best_info['attempts']} محاولة)\n"
@@ -5214,9 +6650,10 @@ async def handle_retry_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE,
             logging.warning(f"Could not delete incomplete quiz message: {e}")
     
     # Reset progress and start fresh
-    reset_user_progress(user.id, difficulty, conn)
+    await db_write(context, reset_user_progress, user.id, difficulty)
+    question_view = context.user_data.get('question_view')
     context.user_data.clear()
-    state = get_user_state(user.id, user.first_name, conn)
+    state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
     context.user_data.update(state)
     context.user_data['difficulty'] = difficulty
     context.user_data['quiz_start_time'] = time.time()
@@ -5224,7 +6661,7 @@ async def handle_retry_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE,
     # Handle dynamic exam state if needed
     if difficulty.startswith('dynamic_exam_'):
         exam_id = difficulty.replace('dynamic_exam_', '')
-        exam_data = context.bot_data.get('dynamic_exams_data', {}).get(exam_id, {})
+        context.user_data['question_view'] = question_view
         context.user_data['dynamic_exam'] = {
             'exam_id': exam_id,
             'current_id': 1,
@@ -5238,10 +6675,9 @@ async def handle_resume_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Resume incomplete quiz."""
     query = update.callback_query
     user = query.from_user
-    conn = context.bot_data['db_conn']
     
     # Get saved state
-    state = get_user_state(user.id, user.first_name, conn)
+    state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
     if state['difficulty'] != difficulty or state['q_index'] == 0:
         await query.answer("❌ لا يوجد اختبار غير مكتمل.", show_alert=True)
         return
@@ -5262,6 +6698,7 @@ async def handle_resume_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE,
             logging.warning(f"Could not delete incomplete quiz message: {e}")
     
     # Restore state
+    question_view = context.user_data.get('question_view')
     context.user_data.clear()
     context.user_data.update(state)
     context.user_data['difficulty'] = difficulty
@@ -5270,6 +6707,7 @@ async def handle_resume_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE,
     # Handle dynamic exam state if needed
     if difficulty.startswith('dynamic_exam_'):
         exam_id = difficulty.replace('dynamic_exam_', '')
+        context.user_data['question_view'] = question_view
         context.user_data['dynamic_exam'] = {
             'exam_id': exam_id,
             'current_id': 1,
@@ -5283,9 +6721,8 @@ async def handle_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Show leaderboard for a difficulty."""
     query = update.callback_query
     user = query.from_user
-    conn = context.bot_data['db_conn']
     
-    leaderboard = get_leaderboard(difficulty, limit=10, conn=conn)
+    leaderboard = await db_read(context, get_leaderboard, difficulty, limit=10)
     
     if not leaderboard:
         await query.answer("لا توجد نتائج بعد.", show_alert=True)
@@ -5303,7 +6740,7 @@ async def handle_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE,
             lines.append(f"{idx}. مستخدم {uid}: {best_score}/{total} ({attempts} محاولة)")
     
     # Get user's rank
-    user_best = get_best_score(user.id, difficulty, conn)
+    user_best = await db_read(context, get_best_score, user.id, difficulty)
     user_rank = None
     for idx, (uid, _, _, _) in enumerate(leaderboard, 1):
         if uid == user.id:
@@ -5352,7 +6789,7 @@ async def handle_admin_exam_preview(update: Update, context: ContextTypes.DEFAUL
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     if not exams:
         await update.callback_query.edit_message_text("لا توجد اختبارات للمعاينة.", reply_markup=admin_back_markup())
         return
@@ -5393,11 +6830,6 @@ async def start_exam_preview(update: Update, context: ContextTypes.DEFAULT_TYPE,
         'is_preview': True
     }
     
-    # Store exam data
-    if 'dynamic_exams_data' not in context.bot_data:
-        context.bot_data['dynamic_exams_data'] = {}
-    context.bot_data['dynamic_exams_data'][exam_id] = exam_data
-    
     await query.edit_message_text(
         f"👁️ معاينة الاختبار: {exam.get('button_text', exam_id)}\n\n"
         f"⚠️ هذا معاينة - لن يتم حفظ النتائج.\n\n"
@@ -5415,7 +6847,7 @@ async def handle_admin_exam_stats(update: Update, context: ContextTypes.DEFAULT_
         await update.callback_query.answer("❌ غير مسموح.", show_alert=True)
         return
     
-    exams = load_exams()
+    exams = exam_registry.all()
     if not exams:
         await update.callback_query.edit_message_text("لا توجد اختبارات.", reply_markup=admin_back_markup())
         return
@@ -5453,7 +6885,7 @@ async def handle_admin_exam_stats_detail(update: Update, context: ContextTypes.D
     
     # Get leaderboard
     difficulty = f"dynamic_exam_{exam_id}"
-    leaderboard = get_leaderboard(difficulty, limit=5, conn=conn)
+    leaderboard = await db_read(context, get_leaderboard, difficulty, limit=5)
     
     leaderboard_text = ""
     if leaderboard:
@@ -5501,6 +6933,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("⚠️ البوت في وضع اختبار حالياً.", show_alert=True)
         return
 
+    # Readiness gate: questions are still loading in the background after a restart
+    if await reply_if_loading(update, context, data):
+        return
+
     if data == "admin_simulate_user":
         if not is_admin_user(user.id):
             await query.answer("❌ غير مسموح.", show_alert=True)
@@ -5751,12 +7187,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         # Reload data from database/files
         conn = context.bot_data.get('db_conn')
-        context.bot_data['exams'] = load_exams(conn)
+        context.bot_data['exams'] = exam_registry.load(conn)
         context.bot_data['menus'] = load_menus(conn)
 
         # Clear cached dynamic exam data to force reload
-        if 'dynamic_exams_data' in context.bot_data:
-            context.bot_data['dynamic_exams_data'] = {}
+        invalidate_dynamic_exam_cache()
+        # Questions, Mazen data and phrases
+        await reload_question_content(context.bot_data, force=True)
 
         await query.edit_message_text("✅ تم إعادة تحميل البيانات من الملفات!", reply_markup=build_admin_keyboard())
         return
@@ -6269,9 +7706,9 @@ DCE (الشبكة): هي المقسمات (Switches) التي تنقل البي
             await context.bot.send_message(chat_id=chat_id, text=f"عذراً، أسئلة هذا الاختبار غير متاحة حالياً.")
             return
 
-        reset_user_progress(user.id, difficulty, conn)
+        await db_write(context, reset_user_progress, user.id, difficulty)
         context.user_data.clear()
-        state = get_user_state(user.id, user.first_name, conn)
+        state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
         context.user_data.update(state)
         context.user_data['difficulty'] = difficulty
         
@@ -6640,9 +8077,9 @@ FCS: فحص الأخطاء، الحرف G يعني Good (الإطار سليم).
             await context.bot.send_message(chat_id=chat_id, text=f"عذراً، أسئلة هذا الاختبار غير متاحة حالياً.")
             return
 
-        reset_user_progress(user.id, difficulty, conn)
+        await db_write(context, reset_user_progress, user.id, difficulty)
         context.user_data.clear()
-        state = get_user_state(user.id, user.first_name, conn)
+        state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
         context.user_data.update(state)
         context.user_data['difficulty'] = difficulty
         
@@ -6686,9 +8123,9 @@ FCS: فحص الأخطاء، الحرف G يعني Good (الإطار سليم).
             await context.bot.send_message(chat_id=chat_id, text=f"عذراً، أسئلة هذا الاختبار غير متاحة حالياً.")
             return
 
-        reset_user_progress(user.id, difficulty, conn)
+        await db_write(context, reset_user_progress, user.id, difficulty)
         context.user_data.clear()
-        state = get_user_state(user.id, user.first_name, conn)
+        state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
         context.user_data.update(state)
         context.user_data['difficulty'] = difficulty
         
@@ -6708,9 +8145,9 @@ FCS: فحص الأخطاء، الحرف G يعني Good (الإطار سليم).
             await context.bot.send_message(chat_id=chat_id, text=f"عذراً، أسئلة هذا الاختبار غير متاحة حالياً.")
             return
 
-        reset_user_progress(user.id, difficulty, conn)
+        await db_write(context, reset_user_progress, user.id, difficulty)
         context.user_data.clear()
-        state = get_user_state(user.id, user.first_name, conn)
+        state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
         context.user_data.update(state)
         context.user_data['difficulty'] = difficulty
         
@@ -6902,9 +8339,9 @@ FCS: فحص الأخطاء، الحرف G يعني Good (الإطار سليم).
             await context.bot.send_message(chat_id=chat_id, text=f"عذراً، أسئلة هذا الاختبار غير متاحة حالياً.")
             return
 
-        reset_user_progress(user.id, difficulty, conn)
+        await db_write(context, reset_user_progress, user.id, difficulty)
         context.user_data.clear()
-        state = get_user_state(user.id, user.first_name, conn)
+        state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
         context.user_data.update(state)
         context.user_data['difficulty'] = difficulty
 
@@ -6923,9 +8360,9 @@ FCS: فحص الأخطاء، الحرف G يعني Good (الإطار سليم).
 
         await query.delete_message()
 
-        reset_user_progress(user.id, difficulty, conn)
+        await db_write(context, reset_user_progress, user.id, difficulty)
         context.user_data.clear()
-        state = get_user_state(user.id, user.first_name, conn)
+        state = await db_write(context, get_user_state, user.id, user.first_name, username=user.username)
         context.user_data.update(state)
         context.user_data['difficulty'] = difficulty
 
@@ -6939,7 +8376,10 @@ FCS: فحص الأخطاء، الحرف G يعني Good (الإطار سليم).
             await query.edit_message_text("⚠️ **حدث تحديث للسيرفر وتم إعادة ضبط البيانات.**\n\nيرجى الضغط على /start للبدء من جديد.", parse_mode="Markdown")
             return
 
-        questions_for_level = context.bot_data['questions'][difficulty]
+        questions_for_level = await get_session_questions(context, difficulty)
+        if not questions_for_level:
+            await query.answer("⚠️ انتهت صلاحية الجلسة.", show_alert=True)
+            return
         
         _, q_idx, ans_idx = data.split("_")
         q_idx = int(q_idx)
@@ -6970,7 +8410,11 @@ FCS: فحص الأخطاء، الحرف G يعني Good (الإطار سليم).
 
         context.user_data['q_index'] += 1
         
-        save_user_state(user.id, user.first_name, difficulty, context.user_data['q_index'], context.user_data['score'], context.user_data['answers'], conn, context.user_data['question_msg_id'], context.user_data['status_msg_id'])
+        await db_write(
+            context, record_answer_and_state, user.id, user.first_name, difficulty, context.user_data.get('attempt', 0),
+            q_idx, ans_idx, ans_idx == correct_ans, context.user_data['q_index'], context.user_data['score'],
+            question_msg_id=context.user_data['question_msg_id'], status_msg_id=context.user_data['status_msg_id']
+        )
 
         explanation = ""
         if ans_idx == correct_ans:
@@ -7063,10 +8507,13 @@ async def send_question_view(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if not difficulty:
         logging.error("No difficulty in context.user_data!")
         return
+    # A new static quiz starts on the current question bank, not a pinned older one
+    if is_new_quiz and (context.user_data.get('question_view') or ('',))[0] == 'bank':
+        context.user_data.pop('question_view', None)
 
-    questions = context.bot_data.get('questions', {}).get(difficulty)
+    questions = await get_session_questions(context, difficulty)
     if not questions:
-        logging.error(f"No questions found for difficulty {difficulty}")
+        logging.error(f"No questions found for difficulty {difficulty} (view: {context.user_data.get('question_view')})")
         logging.info(f"Available difficulties: {list(context.bot_data.get('questions', {}).keys())}")
         return
 
@@ -7141,7 +8588,7 @@ async def send_question_view(update: Update, context: ContextTypes.DEFAULT_TYPE,
             context.user_data['question_msg_id'] = q_msg.message_id
             context.user_data['status_msg_id'] = status_msg.message_id
 
-    save_user_state(user_id, update.effective_user.first_name, difficulty, q_idx, context.user_data['score'], context.user_data['answers'], context.bot_data['db_conn'], context.user_data['question_msg_id'], context.user_data['status_msg_id'])
+    await db_write(context, save_user_state, user_id, update.effective_user.first_name, difficulty, q_idx, context.user_data['score'], question_msg_id=context.user_data['question_msg_id'], status_msg_id=context.user_data['status_msg_id'])
 
 
 async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -7197,13 +8644,16 @@ async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     score = context.user_data.get('score', 0)
     difficulty = context.user_data.get('difficulty', '')
     
-    if not difficulty or not context.bot_data['questions'].get(difficulty):
+    questions = await get_session_questions(context, difficulty) if difficulty else None
+    if not questions:
         # Avoids error if quiz data is missing
         await context.bot.send_message(chat_id=update.effective_chat.id, text="انتهى الاختبار. شكراً لمشاركتك!")
         return
 
-    total = len(context.bot_data['questions'][difficulty])
-    update_lab_score(update.effective_user.id, update.effective_user.first_name, difficulty, score, context.bot_data['db_conn'])
+    total = len(questions)
+    # A finished quiz (the else branch below) writes its lab score with the rest of its results
+    if difficulty.startswith(('mazin_id', 'dynamic_exam_')) or difficulty == 'video2_mini':
+        await db_write(context, update_lab_score, update.effective_user.id, difficulty, score, total_questions=total)
     
     # Check if this was a Mazen test MCQ quiz
     if difficulty.startswith('mazin_id'):
@@ -7224,7 +8674,7 @@ async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if difficulty.startswith('dynamic_exam_'):
         exam_id = difficulty.replace('dynamic_exam_', '')
         exam_state = context.user_data.get('dynamic_exam', {})
-        exam_data = context.bot_data.get('dynamic_exams_data', {}).get(exam_id, {})
+        exam_data = await get_dynamic_exam_data(context, exam_id)
         
         # Check if there are narrative questions for this ID
         all_narrative_questions = exam_data.get('narrative_questions', [])
@@ -7234,9 +8684,8 @@ async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
         debug_log("finish_quiz", "Checking for narrative questions", {"current_quiz_id": current_quiz_id, "all_narrative_count": len(all_narrative_questions)}, "F")
 
         if all_narrative_questions and len(all_narrative_questions) > 0 and isinstance(all_narrative_questions[0], dict) and 'id' in all_narrative_questions[0]:
-            current_quiz_id_str = str(current_quiz_id)
-            narrative_questions = [q for q in all_narrative_questions if str(q.get('id', '')) == current_quiz_id_str]
-            debug_log("finish_quiz", "Filtered narrative questions", {"filtered_count": len(narrative_questions), "current_quiz_id_str": current_quiz_id_str}, "F")
+            narrative_questions = get_exam_unit_questions(exam_data, current_quiz_id, "narrative")
+            debug_log("finish_quiz", "Filtered narrative questions", {"filtered_count": len(narrative_questions), "current_quiz_id": current_quiz_id}, "F")
         else:
             narrative_questions = all_narrative_questions
             debug_log("finish_quiz", "Using all narrative questions", {"narrative_count": len(narrative_questions)}, "F")
@@ -7278,27 +8727,21 @@ async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("العودة لقائمة الفيديوهات ⬅️", callback_data="lab_test_menu")
         ]]
         await context.bot.send_message(chat_id=update.effective_chat.id, text=final_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-        reset_user_progress(update.effective_user.id, None, context.bot_data['db_conn'])
+        await db_write(context, reset_user_progress, update.effective_user.id, None)
 
     else:
         user = update.effective_user
-        conn = context.bot_data['db_conn']
-        
-        # Update best score
-        best_info = update_best_score(user.id, difficulty, score, total, conn)
-        best_score = best_info[0]
-        attempts = best_info[1]
         
-        # Check and award badges
-        check_and_award_badges(user.id, difficulty, score, total, conn)
-        
-        # Save exam statistics (if it's a dynamic exam)
+        # Exam statistics (if it's a dynamic exam)
+        exam_id, time_taken = None, 0
         if difficulty.startswith('dynamic_exam_'):
             exam_id = difficulty.replace('dynamic_exam_', '')
             time_taken = context.user_data.get('quiz_start_time', 0)
             if time_taken:
                 time_taken = int(time.time() - time_taken)
-            save_exam_statistics(exam_id, user.id, score, total, time_taken, conn)
+        
+        # Lab score, best score, badges, statistics and progress reset: one transaction
+        best_score, attempts, new_badges, quiz_badges = await db_write(context, save_quiz_result, user.id, difficulty, score, total, exam_id=exam_id, time_taken=time_taken)
         
         # Build final message with best score and retry option
         percentage = int((score / total * 100)) if total > 0 else 0
@@ -7311,12 +8754,9 @@ async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
             final_msg += f"🏆 أفضل نتيجة: {best_score} من {total}\n"
             final_msg += f"🔄 عدد المحاولات: {attempts}\n"
         
-        # Get badges
-        badges = get_user_badges(user.id, conn)
-        if badges:
-            badge_names = [b[0] for b in badges if difficulty in b[0]]
-            if badge_names:
-                final_msg += f"\n🏅 الإنجازات: {', '.join(badge_names[:3])}\n"
+        # Badges (newly earned ones first), returned by save_quiz_result
+        if quiz_badges:
+            final_msg += f"\n🏅 الإنجازات: {', '.join(quiz_badges[:3])}\n"
         
         final_msg += "\nشكراً لمشاركتك!"
         
@@ -7328,7 +8768,6 @@ async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         
         await context.bot.send_message(chat_id=update.effective_chat.id, text=final_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-        reset_user_progress(update.effective_user.id, None, context.bot_data['db_conn'])
 
 
 
@@ -7398,6 +8837,66 @@ def setup_course_files():
             print(f"⚠️ Warning: {zip_file} not found in root directory.")
     print("--- File Extraction Finished ---")
 
+# ------------------- مراحل الإقلاع (Startup pipeline) -------------------
+# main() runs the independent startup stages in a thread pool and starts
+# polling as soon as the critical ones (database, exams, menus) are done.
+# Course files + questions finish in the background; until then callbacks
+# that need them get a short "loading" reply (see reply_if_loading).
+
+STARTUP_LOADING_TEXT = "⏳ البوت قيد التحميل، حاول مرة أخرى بعد لحظات."
+# Callbacks that need the question bank, Mazen data or phrases
+QUESTION_CALLBACK_PREFIXES = (
+    "ans_", "next_q", "level_", "video_", "mazin_", "restart_quiz",
+    "retry_quiz_", "resume_quiz_", "start_theory_test", "start_video_2_main_quiz",
+)
+
+def timed_stage(name, func, *args):
+    """Runs one startup stage and logs how long it took."""
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        logging.info(f"Startup stage '{name}' took {time.perf_counter() - started:.2f}s")
+
+def open_database():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    init_db(conn)
+    return conn
+
+def load_question_stage():
+    """Course files first (the video question CSVs come from the zips), then the question content."""
+    timed_stage("course_files", setup_course_files)
+    return timed_stage("questions", load_question_content)
+
+async def finish_question_stage(bot_data, future):
+    """
+    Waits for the background question stage on the event loop, then publishes
+    the content (on the same thread as the hot reload job) and opens the gate.
+    """
+    try:
+        content = await asyncio.wrap_future(future)
+    except Exception as e:
+        logging.error(f"Startup stage 'questions' failed: {e}")
+        # Empty stamps make the hot reload job retry every file on its next run
+        content = {**{key: {} for key in QUESTION_CONTENT_KEYS}, **{key: [] for key in PHRASE_FILES}, 'stamps': {}}
+    apply_question_content(bot_data, content)
+    bot_data.get('startup_pending', set()).discard('questions')
+
+async def start_question_stage(application):
+    """post_init hook: publishes the question stage once it is done, without holding up polling."""
+    future = application.bot_data.pop('startup_questions_future')
+    application.create_task(finish_question_stage(application.bot_data, future))
+
+async def reply_if_loading(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    """Answers a callback that needs content which is still loading. Returns True if it did."""
+    if 'questions' not in context.bot_data.get('startup_pending', ()) or not data.startswith(QUESTION_CALLBACK_PREFIXES):
+        return False
+    try:
+        await update.callback_query.message.reply_text(STARTUP_LOADING_TEXT)
+    except Exception as e:
+        logging.warning(f"Could not send loading reply: {e}")
+    return True
+
 # #region agent log
 import json
 import time
@@ -7462,30 +8961,24 @@ def main():
         print("Error: Please set BOT_TOKEN in environment variables.")
         return
 
-    # 2. إعداد الملفات وقاعدة البيانات
-    setup_course_files()
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    init_db(conn)
+    # 2. مراحل الإقلاع بالتوازي: فك ضغط الملفات ثم الأسئلة بالخلفية، وقاعدة البيانات معها
+    from concurrent.futures import ThreadPoolExecutor
+    startup_started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup")
+    questions_future = executor.submit(load_question_stage)
+    db_future = executor.submit(timed_stage, "database", open_database)
 
     # 3. بناء التطبيق
-    application = Application.builder().token(TOKEN).build()
+    application = timed_stage("application", lambda: Application.builder().token(TOKEN).post_init(start_question_stage).post_shutdown(flush_on_shutdown).build())
 
-    # 4. تحميل كافة البيانات (يجب أن يتم قبل التشغيل)
+    # 4. تحميل البيانات: قاعدة البيانات ضرورية قبل التشغيل، أما الأسئلة والعبارات
+    # (من اللقطة المحفوظة إن لم تتغير الملفات) فتُنشر عند اكتمالها
+    application.bot_data['startup_pending'] = {'questions'}
+    application.bot_data['startup_questions_future'] = questions_future
+    conn = db_future.result()
     application.bot_data['db_conn'] = conn
-    application.bot_data['questions'] = load_all_questions()
-    
-    # تحميل بيانات مازن
-    try:
-        mazen_texts, mazen_srd = load_mazen_test_data()
-        application.bot_data['mazen_texts'] = mazen_texts
-        application.bot_data['mazen_srd'] = mazen_srd
-    except Exception as e:
-        logging.warning(f"Could not load Mazen data: {e}")
-
-    # تحميل العبارات
-    application.bot_data['correct_phrases'] = load_phrases('Correct_Phrases.csv')
-    application.bot_data['wrong_phrases'] = load_phrases('Wrong_Phrases.csv')
-    application.bot_data['thinking_phrases'] = load_phrases('Thinking_Phrases.csv')
+    # أوامر قاعدة البيانات الخاصة بالطلاب تعمل على خيوط منفصلة عن حلقة الأحداث
+    application.bot_data['db'] = AsyncDB(DB_FILE)
 
     # 5. إضافة كل الهاندلرز (Handlers)
     application.add_handler(CommandHandler("start", start))
@@ -7494,6 +8987,7 @@ def main():
     if ADMIN_TELEGRAM_ID:
         application.add_handler(CommandHandler("admin", handle_admin_command))
         application.add_handler(CommandHandler("getid", handle_video_and_get_id))
+        application.add_handler(CommandHandler("merge_db", handle_merge_db_command))
         application.add_handler(MessageHandler(filters.VIDEO & ~filters.COMMAND, handle_video_and_get_id))
         # أمر النصوص الخاص بالأدمن (يجب أن يكون قبل معالج الأزرار العادية)
         application.add_handler(MessageHandler(filters.TEXT & filters.User(ADMIN_TELEGRAM_ID) & ~filters.COMMAND, handle_admin_text))
@@ -7505,10 +8999,11 @@ def main():
     application.add_handler(CallbackQueryHandler(button_handler))
 
     # 6. تحميل الاختبارات والقوائم من قاعدة البيانات
-    application.bot_data['exams'] = load_exams(conn)
-    application.bot_data['menus'] = load_menus(conn)
+    application.bot_data['exams'] = timed_stage("exams", exam_registry.load, conn)
+    application.bot_data['menus'] = timed_stage("menus", load_menus, conn)
     
     # --- كود استعادة الأزرار المفقودة (Restoring Buttons Logic) ---
+    restore_started = time.perf_counter()
     try:
         exams = application.bot_data.get('exams', {})
         menus = application.bot_data.get('menus', default_menus())
@@ -7559,8 +9054,55 @@ def main():
 
     except Exception as e:
         logging.error(f"Error restoring buttons: {e}")
+    logging.info(f"Startup stage 'restore_buttons' took {time.perf_counter() - restore_started:.2f}s")
+    executor.shutdown(wait=False)
+    logging.info(f"Critical startup stages ready in {time.perf_counter() - startup_started:.2f}s"
+                 + (" (questions still loading)" if 'questions' in application.bot_data['startup_pending'] else ""))
+
+    # 7. جدولة المهام (Job Queue)
+    # تنزيل ملفات الاختبارات المفقودة من تيليجرام في الخلفية بعد الإقلاع مباشرة
+    if application.job_queue:
+        try:
+            application.job_queue.run_once(prefetch_exam_files_job, when=1)
+            logging.info("Scheduled exam file prefetch.")
+        except Exception as e:
+            logging.warning(f"Job queue error: {e}")
+
+    # مراقبة ملفات الأسئلة والعبارات وإعادة تحميلها عند التعديل
+    if QUESTION_RELOAD_INTERVAL > 0 and application.job_queue:
+        try:
+            application.job_queue.run_repeating(question_reload_job, interval=QUESTION_RELOAD_INTERVAL, first=QUESTION_RELOAD_INTERVAL)
+            logging.info("Scheduled question hot reload.")
+        except Exception as e:
+            logging.warning(f"Job queue error: {e}")
+
+    # حفظ تقدم المستخدمين المؤجل كل PROGRESS_FLUSH_INTERVAL_MS
+    if PROGRESS_FLUSH_INTERVAL_MS > 0 and application.job_queue:
+        try:
+            interval = PROGRESS_FLUSH_INTERVAL_MS / 1000
+            application.job_queue.run_repeating(progress_flush_job, interval=interval, first=interval)
+            progress_buffer.write_through = False
+            logging.info("Scheduled user progress flush job.")
+        except Exception as e:
+            logging.warning(f"Job queue error: {e}")
+
+    # دمج ملف WAL في قاعدة البيانات بشكل دوري
+    if SQLITE_CHECKPOINT_INTERVAL > 0 and application.job_queue:
+        try:
+            application.job_queue.run_repeating(wal_checkpoint_job, interval=SQLITE_CHECKPOINT_INTERVAL, first=SQLITE_CHECKPOINT_INTERVAL)
+            logging.info("Scheduled WAL checkpoint job.")
+        except Exception as e:
+            logging.warning(f"Job queue error: {e}")
+
+    # صيانة قاعدة البيانات (تجميع الإحصائيات القديمة وتصغير الملف)
+    if DB_MAINTENANCE_HOURS > 0 and application.job_queue:
+        try:
+            application.job_queue.run_repeating(db_maintenance_job, interval=DB_MAINTENANCE_HOURS * 3600, first=600)
+            logging.info("Scheduled database maintenance job.")
+        except Exception as e:
+            logging.warning(f"Job queue error: {e}")
 
-    # 7. جدولة المهام (Job Queue) - تصدير البيانات كل ساعة
+    # تصدير البيانات كل ساعة
     if ADMIN_TELEGRAM_ID and application.job_queue:
         try:
             application.job_queue.run_repeating(